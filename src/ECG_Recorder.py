@@ -1,15 +1,20 @@
+import time
+STARTUP_TIME = time.perf_counter()  # before the other imports, so they are counted in the startup
 from PyQt5 import QtWidgets, QtCore, QtGui
 from PyQt5.QtCore import QObject
 import pyqtgraph as pg
+import argparse
 import os
 import sys
+import threading
 from datetime import datetime
 from pathlib import Path
-import serial
 import numpy as np
 
-from port_handler import read_from_serial_port, write_data_point_to_file, find_available_ports, convert_units_to_volts
-from signal_processor import SignalProcessor
+from port_handler import find_available_ports, convert_units_to_volts
+from ring_buffer import RingBuffer
+from plot_decimation import decimate_min_max
+from instrumentation import metrics, MetricsDumper
 from gui.ECG_Recorder_ui import Ui_MainWindow
 
 
@@ -17,35 +22,112 @@ def create_default_filename():
     this_file_path = os.path.realpath(__file__)
     folder_name = os.path.dirname(this_file_path)
     data_folder = Path(os.path.join(folder_name, '../data/'))
-    return data_folder/f'{datetime.now().strftime("%Y-%m-%d_%H%M%S")}.txt'
+    return data_folder/f'{datetime.now().strftime("%Y-%m-%d_%H%M%S")}{Configuration.recording_extension}'
 
 
 class Configuration:
     baudrate = 38400
     port = None
+    # None for the serial port chosen in the window, otherwise 'synthetic',
+    # 'stream:host:port' or a recording file to replay
+    input_source = None
+    replay_speed = 1.0  # also the speed of the synthetic ECG
     adc_resolution = 12
     max_voltage = 3.3
     Fs = 200
+    channels = 1  # values of many channels are sent in one line separated with commas
+    detection_channel = 0  # channel used for R peaks detection
     data_points_number_in_the_plot = 3*Fs
     data_points_number_in_the_buffer = 10*Fs
+    hr_rr_intervals_number = 10  # HR is averaged over that many last RR intervals
+    adaptive_threshold = False  # R peaks threshold following the signal amplitude
+    accelerated_kernels = False  # compiled filters and detection loops, needs numba
     filtering = False
-
-
-class PortMonitor(QObject):
-    data_signal = QtCore.pyqtSignal(float)
-
-    @QtCore.pyqtSlot()
-    def monitor_port(self):
-        while True:
-            try:
-                baudrate = Configuration.baudrate
-                port = Configuration.port
-                for x in read_from_serial_port(port, baudrate):
-                    self.data_signal.emit(x)
-                    if (baudrate, port) != (Configuration.baudrate, Configuration.port):
-                        break
-            except serial.serialutil.SerialException as e:
-                print(e)
+    data_block_interval = 0.02  # in seconds, how often the samples are sent to the GUI
+    plot_refresh_rate = 30  # frames per second
+    recording_extension = '.txt'  # '.ecg' for the binary format
+    recording_queue_size = 1000  # in blocks
+    fsync_interval = 5.0  # in seconds
+    recording_index = True  # sidecar index of the R peaks and the blocks for fast random access
+    show_metrics = False  # status panel with the performance metrics
+    metrics_file = None  # .json or .csv file the metrics are dumped to every metrics_interval
+    metrics_interval = 1.0  # in seconds
+    profile_startup = False  # prints the startup stages times and quits after the first plotted sample
+
+
+class StartupProfiler:
+    '''Prints the time of every startup stage counted
+    from the start of the imports, only the first time'''
+
+    def __init__(self, enabled, start_time=STARTUP_TIME):
+        self.enabled = enabled
+        self.start_time = start_time
+        self.stages = set()
+
+    def mark(self, stage):
+        if self.enabled and stage not in self.stages:
+            self.stages.add(stage)
+            print(f'{stage:25s} {(time.perf_counter() - self.start_time) * 1000:8.1f} ms')
+
+
+class PortsFinder(QObject):
+    '''Enumerates the serial ports in a thread, as it may take long'''
+    ports_signal = QtCore.pyqtSignal(list)
+
+    def start(self):
+        threading.Thread(target=lambda: self.ports_signal.emit(find_available_ports()),
+                         name='PortsFinder', daemon=True).start()
+
+
+class EngineBridge(QObject):
+    '''Subscriber of the AcquisitionEngine passing the processed
+    blocks from the engine thread to the GUI thread'''
+    block_signal = QtCore.pyqtSignal(object)
+
+    def __init__(self):
+        super().__init__()
+        # blocks emitted but not handled yet by the GUI thread, it is
+        # updated from both threads, so only under the lock
+        self.pending_blocks_number = 0
+        self.pending_blocks_lock = threading.Lock()
+
+    def __call__(self, processed_block):
+        with self.pending_blocks_lock:
+            self.pending_blocks_number += 1
+            pending_blocks_number = self.pending_blocks_number
+        metrics.set_gauge('gui.queue_depth', pending_blocks_number)
+        self.block_signal.emit(processed_block)
+
+    def block_handled(self):
+        with self.pending_blocks_lock:
+            self.pending_blocks_number -= 1
+
+
+class FrameRateMeter:
+    '''Counts the plot frames and their drawing time,
+    the results are reported once per period in seconds'''
+
+    def __init__(self, period=1.0):
+        self.period = period
+        self.start_time = time.perf_counter()
+        self.frames_number = 0
+        self.frames_time = 0.0
+        self.fps = 0.0
+        self.frame_time = 0.0
+
+    def add_frame(self, frame_time):
+        '''Returns True when the new results are ready'''
+        self.frames_number += 1
+        self.frames_time += frame_time
+        elapsed_time = time.perf_counter() - self.start_time
+        if elapsed_time < self.period:
+            return False
+        self.fps = self.frames_number / elapsed_time
+        self.frame_time = self.frames_time / self.frames_number
+        self.start_time = time.perf_counter()
+        self.frames_number = 0
+        self.frames_time = 0.0
+        return True
 
 
 class MainWindow(QtWidgets.QMainWindow):
@@ -60,25 +142,27 @@ class MainWindow(QtWidgets.QMainWindow):
         self.ui.lcdNumber_HR.display('---')
         self.setupGraphWidget()
 
-        self.file = None
         self.user_filename = None
         self.filename = None
         self.recording = False
-        self.ports = find_available_ports()
-        self.sp = SignalProcessor(Configuration.Fs)
-        self.buffer = [0]
-        self.neverending_buffer = [0]
+        self.ports = []
+        self.hr = np.nan
+        self.measures = None
+        self.engine = None
+        self.startup_profiler = StartupProfiler(Configuration.profile_startup)
 
-        self.updatePortsList()
-        Configuration.port = self.ports[0]
         self.setActions()
-
-        self.port_monitor = PortMonitor()
-        self.thread = QtCore.QThread(self)
-        self.port_monitor.data_signal.connect(self.update_data)
-        self.port_monitor.moveToThread(self.thread)
-        self.thread.started.connect(self.port_monitor.monitor_port)
-        self.thread.start()
+        self.setupMetrics()
+        self.ports_finder = PortsFinder()
+        self.ports_finder.ports_signal.connect(self.setPorts)
+        self.ports_finder.start()
+        # the processing modules are imported after the window is shown
+        QtCore.QTimer.singleShot(0, self.startAcquisition)
+
+        self.plot_timer = QtCore.QTimer(self)
+        self.plot_timer.setInterval(int(1000 / Configuration.plot_refresh_rate))
+        self.plot_timer.timeout.connect(self.refreshPlot)
+        self.plot_timer.start()
 
     def setupGraphWidget(self):
         self.graphWidget = pg.PlotWidget(self.ui.centralwidget)
@@ -102,13 +186,88 @@ class MainWindow(QtWidgets.QMainWindow):
 
         self.ui.verticalLayout_1.addWidget(self.graphWidget)
 
-        self.x = [0]
-        self.y = [0]
+        self.samples_number = 0
+        self.previous_samples_number = 0
+        # x-axis in seconds and y-axis in volts
+        self.x = RingBuffer(Configuration.data_points_number_in_the_plot)
+        self.y = RingBuffer(Configuration.data_points_number_in_the_plot, channels=Configuration.channels)
 
         self.graphWidget.setBackground('w')
 
-        pen = pg.mkPen(color=(0, 0, 255), width=1)
-        self.data_line = self.graphWidget.plot(self.x, self.y, pen=pen)
+        # one line per channel, the first one is blue
+        self.data_lines = []
+        for channel in range(Configuration.channels):
+            color = (0, 0, 255) if channel == 0 else pg.intColor(channel, hues=Configuration.channels)
+            pen = pg.mkPen(color=color, width=1)
+            self.data_lines.append(self.graphWidget.plot(self.x.view(), self.y.view()[:, channel], pen=pen))
+        self.plotted_samples_number = 0
+        # when the oldest sample not plotted yet was received
+        self.oldest_unplotted_time = None
+        self.frame_rate_meter = FrameRateMeter()
+        self.label_frame_rate = QtWidgets.QLabel()
+        self.ui.statusbar.addPermanentWidget(self.label_frame_rate)
+
+    def setupMetrics(self):
+        self.metrics_dumper = None
+        self.label_metrics = None
+        if Configuration.show_metrics or Configuration.metrics_file is not None:
+            metrics.enable()
+        if Configuration.metrics_file is not None:
+            self.metrics_dumper = MetricsDumper(metrics, Configuration.metrics_file, Configuration.metrics_interval)
+        if Configuration.show_metrics:
+            self.label_metrics = QtWidgets.QLabel()
+            font = QtGui.QFont()
+            font.setPointSize(8)
+            self.label_metrics.setFont(font)
+            self.ui.verticalLayout_1.addWidget(self.label_metrics)
+            self.metrics_timer = QtCore.QTimer(self)
+            self.metrics_timer.setInterval(int(1000 * Configuration.metrics_interval))
+            self.metrics_timer.timeout.connect(self.showMetrics)
+            self.metrics_timer.start()
+
+    def showMetrics(self):
+        self.label_metrics.setText(metrics.summary())
+
+    def startAcquisition(self):
+        self.startup_profiler.mark('window shown')
+        from acquisition_engine import AcquisitionEngine
+        # acquisition and analysis run in the engine thread, the window only displays the results
+        self.engine = AcquisitionEngine(
+            self.create_input_source(), Configuration.Fs, Configuration.channels,
+            Configuration.detection_channel, Configuration.adc_resolution, Configuration.max_voltage,
+            Configuration.data_block_interval, Configuration.adaptive_threshold,
+            Configuration.hr_rr_intervals_number, Configuration.recording_queue_size, Configuration.fsync_interval,
+            Configuration.accelerated_kernels, Configuration.recording_index)
+        self.engine_bridge = EngineBridge()
+        self.engine_bridge.block_signal.connect(self.update_data)
+        self.engine.subscribe(self.engine_bridge)
+        self.engine.start()
+        self.startup_profiler.mark('acquisition started')
+
+    @staticmethod
+    def create_input_source():
+        '''None when the serial port is not known yet or the source
+        cannot be opened, e.g. the stream server sends another Fs'''
+        from input_sources import SerialSource, create_input_source
+        if Configuration.input_source is None:
+            if Configuration.port is None:
+                return None
+            return SerialSource(Configuration.port, Configuration.baudrate, Configuration.channels)
+        try:
+            return create_input_source(Configuration.input_source, Configuration.baudrate, Configuration.Fs,
+                                       Configuration.channels, Configuration.replay_speed)
+        except (OSError, ValueError) as e:
+            print(e)
+            return None
+
+    def setPorts(self, ports):
+        self.ports = ports
+        self.updatePortsList()
+        if len(self.ports) > 0 and Configuration.port is None:
+            Configuration.port = self.ports[0]
+            if self.engine is not None and Configuration.input_source is None:
+                self.engine.set_source(self.create_input_source())
+        self.startup_profiler.mark('ports found')
 
     def updatePortsList(self):
         for i in range(len(self.ports)):
@@ -131,16 +290,21 @@ class MainWindow(QtWidgets.QMainWindow):
             print(f'Saving data to file {self.filename}')
             self.recording = True
         else:
-            self.close_file()
+            dropped_samples_number = self.close_file(wait=False)
             self.ui.pushButton_recording.setText(self._translate("MainWindow", "Start Recording"))
-            self.ui.statusbar.showMessage(f'Data saved in {self.filename}', 5000)
-            print(f'Data saved in {self.filename}')
+            message = f'Data saved in {self.filename}'
+            if dropped_samples_number > 0:
+                message += f', {dropped_samples_number} samples dropped'
+            self.ui.statusbar.showMessage(message, 5000)
+            print(message)
             self.recording = False
 
     def choosePort(self):
         for port in self.ports:
             if self.ui.comboBox_port.currentText() == port:
                 Configuration.port = port
+                if self.engine is not None:
+                    self.engine.set_source(self.create_input_source())
                 self.ui.statusbar.showMessage(f'Setting port to {port}', 5000)
                 print(f'Setting port to {port}')
 
@@ -149,6 +313,8 @@ class MainWindow(QtWidgets.QMainWindow):
         for baudrate in all_baudrates:
             if self.ui.comboBox_baudrate.currentText() == baudrate:
                 Configuration.baudrate = int(baudrate)
+                if self.engine is not None:
+                    self.engine.set_source(self.create_input_source())
                 self.ui.statusbar.showMessage(f'Setting baudrate to {baudrate}', 5000)
                 print(f'Setting baudrate to {baudrate}')
 
@@ -168,93 +334,145 @@ class MainWindow(QtWidgets.QMainWindow):
             print(f'Filtering off')
 
     def open_file(self):
-        if self.file is None:
+        if self.engine is not None and not self.engine.is_recording():
             if self.user_filename is None or self.user_filename == '':
                 self.filename = create_default_filename()
             else:
                 self.filename = self.user_filename
-            self.file = open(self.filename, 'w')
+            self.engine.start_recording(self.filename)
 
-    def close_file(self):
-        if self.file is not None:
-            self.file.close()
-            self.file = None
+    def close_file(self, wait=True):
+        '''Returns the number of samples dropped while recording'''
+        if self.engine is None:
+            return 0
+        return self.engine.stop_recording(wait)
 
     def closeEvent(self, event):
-        self.close_file()
-
-    @QtCore.pyqtSlot(float)
-    def update_data(self, data_point):
-        '''Method for updating data, takes in one value:
-        - data points taken to buffers for analysis are always filtered
-        - data points written to file are always raw
+        # all the queued data is written before closing
+        if self.engine is not None:
+            self.engine.stop()
+        if self.metrics_dumper is not None:
+            self.metrics_dumper.close()
+
+    @QtCore.pyqtSlot(object)
+    def update_data(self, processed_block):
+        '''Method for updating the displayed data, takes in
+        a ProcessedBlock from the acquisition engine:
+        - the analysis is always made on the filtered data
+        - data written to file is always raw
         - data displayed in the plot depends on the
         Configuration.filtering parameter'''
-        filtered_data_point = self.sp.use_all_filters(data_point)
-        self.update_HR(filtered_data_point)
-        self.update_ECG_analysis(filtered_data_point)
+        self.startup_profiler.mark('first block')
+        self.engine_bridge.block_handled()
+        if self.oldest_unplotted_time is None:
+            self.oldest_unplotted_time = processed_block.received_time
+        self.previous_samples_number = self.samples_number
+        self.samples_number = processed_block.start + len(processed_block.raw)
+        self.hr = processed_block.hr
+        self.measures = processed_block.measures
+        self.update_HR()
+        self.update_ECG_analysis()
         if Configuration.filtering:
-            self.update_plot(filtered_data_point)
+            self.update_plot(processed_block.filtered)
         else:
-            self.update_plot(data_point)
-        if self.file is not None:
-            write_data_point_to_file(data_point, self.file)
-
-    def update_HR(self, x):
-        if len(self.buffer) == Configuration.data_points_number_in_the_buffer:
-            self.buffer = self.buffer[1:]
-        self.buffer.append(x)
-        if self.x[-1] % (1 * Configuration.Fs) == 0:
+            self.update_plot(processed_block.raw)
+
+    def passed_multiple_of(self, samples_interval):
+        '''Checks if the last block reached the next multiple
+        of samples_interval counted from the beginning'''
+        return self.samples_number // samples_interval > self.previous_samples_number // samples_interval
+
+    def update_HR(self):
+        if self.passed_multiple_of(1 * Configuration.Fs):
             self.showHR()
 
-    def update_ECG_analysis(self, x):
-        self.neverending_buffer.append(x)
-        if self.x[-1] % (10 * Configuration.Fs) == 0:
+    def update_ECG_analysis(self):
+        if self.passed_multiple_of(10 * Configuration.Fs):
             self.showECGAnalysis()
 
-    def update_plot(self, y):
-        if len(self.x) == Configuration.data_points_number_in_the_plot:
-            self.x = self.x[1:]  # Remove the first x element
-            self.y = self.y[1:]  # Remove the first y element
-        self.x.append(self.x[-1] + 1)  # Add a new value 1 higher than the last - x-axis in numbers
-        # of samples
-        self.y.append(y) # Add a new value depended on the configuration
-        x_in_seconds = np.array(self.x)/Configuration.Fs
-        y_in_V = convert_units_to_volts(np.array(self.y), Configuration.adc_resolution, Configuration.max_voltage)
-        self.data_line.setData(x_in_seconds, y_in_V)  # Update the plot
+    def update_plot(self, data_block):
+        # the oldest points are overwritten when the plot is full
+        samples_indices = np.arange(self.previous_samples_number + 1, self.samples_number + 1)
+        self.x.extend(samples_indices / Configuration.Fs)
+        self.y.extend(convert_units_to_volts(data_block, Configuration.adc_resolution, Configuration.max_voltage))
+
+    def refreshPlot(self):
+        '''Redraws the plot with the newest samples, called by the timer
+        at Configuration.plot_refresh_rate independently of the data acquisition'''
+        if self.plotted_samples_number == self.samples_number:
+            return
+        start_time = time.perf_counter()
+        self.plotted_samples_number = self.samples_number
+        # there is no need for more than min and max point per pixel
+        for channel, data_line in enumerate(self.data_lines):
+            x, y = decimate_min_max(self.x.view(), self.y.view()[:, channel], 2 * self.graphWidget.width())
+            with metrics.timer('plot.set_data'):
+                data_line.setData(x, y)  # Update the plot
+        if self.oldest_unplotted_time is not None:
+            metrics.observe('latency.sample_to_screen', time.perf_counter() - self.oldest_unplotted_time)
+            self.oldest_unplotted_time = None
+        if Configuration.profile_startup and 'first plotted sample' not in self.startup_profiler.stages:
+            self.startup_profiler.mark('first plotted sample')
+            self.close()
+            QtWidgets.QApplication.quit()
+        if self.frame_rate_meter.add_frame(time.perf_counter() - start_time):
+            self.label_frame_rate.setText(f'{self.frame_rate_meter.fps:.1f} fps, '
+                                          f'{self.frame_rate_meter.frame_time * 1000:.1f} ms per frame')
 
     def showHR(self):
-        if len(self.buffer) >= Configuration.data_points_number_in_the_buffer:
-            hr = self.sp.find_hr(self.buffer)
-            if np.isnan(hr):
+        if self.samples_number >= Configuration.data_points_number_in_the_buffer:
+            if np.isnan(self.hr):
                 self.ui.lcdNumber_HR.display('---')
             else:
-                self.ui.lcdNumber_HR.display(hr)
+                self.ui.lcdNumber_HR.display(self.hr)
 
     def showECGAnalysis(self):
-        if len(self.neverending_buffer) >= Configuration.data_points_number_in_the_buffer:
-            measures = self.sp.make_ecg_analysis(np.array(self.neverending_buffer))
-            if measures is None:
+        if self.samples_number >= Configuration.data_points_number_in_the_buffer:
+            if self.measures is None:
                 return
-            displayed_text = self.create_heart_measures_display_text(measures)
+            displayed_text = self.create_heart_measures_display_text(self.measures)
             self.ui.label_ecg_measures.setText(displayed_text)
 
     @staticmethod
     def create_heart_measures_display_text(measures):
-        keys = ['bpm', 'ibi', 'sdnn', 'sdsd', 'rmssd', 'pnn20', 'pnn50']
+        keys = ['bpm', 'ibi', 'sdnn', 'sdsd', 'rmssd', 'pnn20', 'pnn50', 'lf', 'hf', 'lf_hf']
         displayed_measures = {}
         for key in keys:
             if not np.isnan(measures[key]):
                 displayed_measures[key] = '{:.2f}'.format(measures[key])
             else:
                 displayed_measures[key] = '--'
-        displayed_text = f"<html><head/><body><p><span style=\" font-size:9pt;\">Average ECG <br/>measures:<br/>hr: {displayed_measures['bpm']}<br/>ibi: {displayed_measures['ibi']}<br/>sdnn: {displayed_measures['sdnn']}<br/>sdsd: {displayed_measures['sdsd']}<br/>rmssd: {displayed_measures['rmssd']}<br/>pnn20: {displayed_measures['pnn20']}<br/>pnn50: {displayed_measures['pnn50']}<br/></span></p></body></html>"
+        displayed_text = f"<html><head/><body><p><span style=\" font-size:9pt;\">Average ECG <br/>measures:<br/>hr: {displayed_measures['bpm']}<br/>ibi: {displayed_measures['ibi']}<br/>sdnn: {displayed_measures['sdnn']}<br/>sdsd: {displayed_measures['sdsd']}<br/>rmssd: {displayed_measures['rmssd']}<br/>pnn20: {displayed_measures['pnn20']}<br/>pnn50: {displayed_measures['pnn50']}<br/>lf: {displayed_measures['lf']}<br/>hf: {displayed_measures['hf']}<br/>lf/hf: {displayed_measures['lf_hf']}<br/></span></p></body></html>"
         return displayed_text
 
 
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='ECG Recorder')
+    parser.add_argument('--source', default=None, help='"synthetic", "stream:ADDRESS" or a recording '
+                                                       'file to replay instead of the serial port')
+    parser.add_argument('--metrics', nargs='?', const='', default=None, metavar='FILE',
+                        help='show the performance metrics panel, with FILE (.json or .csv) '
+                             'dump them to the file too')
+    parser.add_argument('--profile-startup', action='store_true',
+                        help='print the times of the startup stages and quit after the first plotted sample, '
+                             'run with python -X importtime for the times of the imports')
+    # the other arguments are left for Qt
+    return parser.parse_known_args()
+
+
 def run():
-    app = QtWidgets.QApplication(sys.argv)
+    args, qt_arguments = parse_arguments()
+    if args.source is not None:
+        Configuration.input_source = args.source
+    Configuration.profile_startup = args.profile_startup
+    if args.metrics is not None:
+        Configuration.show_metrics = True
+        Configuration.metrics_file = args.metrics or None
+    startup_profiler = StartupProfiler(Configuration.profile_startup)
+    startup_profiler.mark('imports')
+    app = QtWidgets.QApplication(sys.argv[:1] + qt_arguments)
     w = MainWindow()
+    startup_profiler.mark('window created')
     w.show()
     sys.exit(app.exec_())
 
@@ -0,0 +1,296 @@
+import argparse
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime
+from functools import partial
+import numpy as np
+
+from signal_processor import SignalProcessor
+from hrv_analyzer import IncrementalHRVAnalyzer
+from r_peaks_detector import StreamingRPeakDetector
+from recording_format import open_recording_writer
+from recording_index import open_indexed_recording_writer
+from async_recording_writer import AsyncRecordingWriter
+from sample_stream import StreamServer, parse_address
+from input_sources import DEFAULT_FS, create_input_source
+from instrumentation import metrics, MetricsDumper
+
+RECONNECT_INTERVAL = 1.0  # in seconds
+
+# start is the index of the first sample of the block counted from the
+# beginning of the acquisition, raw and filtered have one column per channel,
+# peaks are the absolute indices of the R peaks found in the detection channel,
+# received_time is time.perf_counter() when the oldest sample of the block was received
+ProcessedBlock = namedtuple('ProcessedBlock', ['start', 'raw', 'filtered', 'peaks', 'hr', 'measures',
+                                               'received_time'])
+
+
+class AcquisitionEngine:
+    '''Reads the input source, e.g. the serial port, filters the signal,
+    finds the R peaks, keeps the HRV measures and records the raw data
+    in its own thread, without any GUI. Every block of samples is published
+    to the subscribers as ProcessedBlock.
+
+    The subscribers are called in the engine thread, so they have to
+    return quickly, e.g. only pass the block to another thread.
+    Several engines can run at once, one per device'''
+
+    def __init__(self, source, Fs=200, channels=1, detection_channel=0, adc_resolution=12,
+                 max_voltage=3.3, block_interval=0.02, adaptive_threshold=False, hr_rr_intervals_number=10,
+                 recording_queue_size=1000, fsync_interval=5.0, accelerated=False, recording_index=True):
+        self.source = source
+        self.Fs = Fs
+        self.channels = channels
+        self.detection_channel = detection_channel
+        self.adc_resolution = adc_resolution
+        self.max_voltage = max_voltage
+        self.block_interval = block_interval
+        self.recording_queue_size = recording_queue_size
+        self.fsync_interval = fsync_interval
+        # sidecar index of the R peaks, blocks offsets and HR of every minute written with the recording
+        self.recording_index = recording_index
+
+        self.sp = SignalProcessor(Fs, adaptive_threshold=adaptive_threshold, accelerated=accelerated)
+        self.r_peaks_detector = StreamingRPeakDetector(self.sp, hr_rr_intervals_number=hr_rr_intervals_number)
+        # the R peaks come from the engine detector, so the analyzer has none of its own
+        self.hrv_analyzer = IncrementalHRVAnalyzer(self.sp, detect_peaks=False)
+        self.samples_number = 0
+
+        self.subscribers = []
+        self.writer = None
+        self.recording_filename = None
+        self.recording_start = None  # index of the first recorded sample
+        self.recording_lock = threading.Lock()
+        self.stop_event = threading.Event()
+        # set when the source is over or the acquisition is stopped
+        self.finished_event = threading.Event()
+        self.thread = None
+
+    def subscribe(self, subscriber):
+        '''subscriber is called with every ProcessedBlock'''
+        self.subscribers.append(subscriber)
+
+    def unsubscribe(self, subscriber):
+        self.subscribers.remove(subscriber)
+
+    def set_source(self, source):
+        '''The samples are taken from the new source after the current block'''
+        self.source = source
+
+    def start(self):
+        self.stop_event.clear()
+        self.finished_event.clear()
+        self.thread = threading.Thread(target=self._run, name='AcquisitionEngine', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        '''Stops the acquisition and finishes the recording'''
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        return self.stop_recording(wait=True)
+
+    def is_recording(self):
+        return self.writer is not None
+
+    def start_recording(self, filename):
+        with self.recording_lock:
+            if self.writer is not None:
+                return
+            # the file is opened and written in the writer thread
+            open_writer = open_indexed_recording_writer if self.recording_index else open_recording_writer
+            open_writer = partial(open_writer, filename, self.Fs, self.adc_resolution, self.max_voltage, self.channels)
+            self.writer = AsyncRecordingWriter(open_writer, self.recording_queue_size, self.fsync_interval)
+            self.recording_filename = filename
+            self.recording_start = None
+
+    def stop_recording(self, wait=True):
+        '''Returns the number of samples dropped while recording'''
+        with self.recording_lock:
+            writer, self.writer = self.writer, None
+        if writer is None:
+            return 0
+        writer.close(wait)
+        return writer.dropped_samples_number
+
+    def _run(self):
+        try:
+            while not self.stop_event.is_set():
+                if self.source is None:
+                    # waiting for the source, e.g. until the serial ports are found
+                    self.stop_event.wait(self.block_interval)
+                    continue
+                try:
+                    if self._read_source():
+                        return
+                except OSError as e:
+                    # serial port and connection errors, the source is opened again
+                    print(e)
+                    self.stop_event.wait(RECONNECT_INTERVAL)
+        finally:
+            self.finished_event.set()
+
+    def _read_source(self):
+        '''Returns True when the source is over'''
+        source = self.source
+        blocks = []
+        first_block_time = None
+        last_block_time = time.monotonic()
+        for block in source.read_blocks(timeout=self.block_interval):
+            if len(block) > 0:
+                blocks.append(block)
+                if first_block_time is None:
+                    first_block_time = time.perf_counter()
+            if time.monotonic() - last_block_time >= self.block_interval:
+                self._process_blocks(blocks, first_block_time)
+                blocks = []
+                first_block_time = None
+                last_block_time = time.monotonic()
+            if self.stop_event.is_set() or source is not self.source:
+                return False
+        self._process_blocks(blocks, first_block_time)
+        return source is self.source
+
+    def _process_blocks(self, blocks, received_time):
+        if len(blocks) > 0:
+            self.process_block(np.concatenate(blocks), received_time)
+
+    def process_block(self, data_block, received_time=None):
+        '''Processes the raw block and publishes it, data_block
+        has one column per channel or one value per sample'''
+        if received_time is None:
+            received_time = time.perf_counter()
+        stages = metrics.stages('engine')
+        data_block = np.asarray(data_block, dtype=float).reshape(-1, self.channels)
+        filtered_data_block = self.sp.use_all_filters_on_block(data_block)
+        if stages:
+            stages.lap('filtering')
+        peaks_indices = self.r_peaks_detector.update(filtered_data_block[:, self.detection_channel])
+        if stages:
+            stages.lap('detection')
+        self.hrv_analyzer.add_peaks(peaks_indices)
+        measures = self.hrv_analyzer.measures()
+        if stages:
+            stages.lap('hrv_analysis')
+        with self.recording_lock:
+            if self.writer is not None:
+                if self.recording_start is None:
+                    self.recording_start = self.samples_number
+                if self.recording_index:
+                    # the writer maps the R peaks to the written samples,
+                    # as it knows which of the samples it has dropped
+                    peaks = peaks_indices[peaks_indices >= self.recording_start]
+                    self.writer.write_block(data_block, peaks - self.recording_start)
+                else:
+                    self.writer.write_block(data_block)
+                if stages:
+                    metrics.set_gauge('recording.queue_depth', self.writer.queued_blocks_number())
+                    metrics.set_gauge('recording.dropped_samples', self.writer.dropped_samples_number)
+        if stages:
+            stages.lap('recording')
+        processed_block = ProcessedBlock(self.samples_number, data_block, filtered_data_block, peaks_indices,
+                                         self.r_peaks_detector.hr(), measures, received_time)
+        self.samples_number += len(data_block)
+        for subscriber in list(self.subscribers):
+            subscriber(processed_block)
+        if stages:
+            stages.lap('publishing')
+            metrics.count('samples.received', len(data_block))
+            metrics.observe('latency.processing', time.perf_counter() - received_time)
+
+
+class ConsoleReporter:
+    '''Subscriber printing HR every report_interval seconds
+    and the HRV measures every measures_interval seconds'''
+
+    def __init__(self, Fs, report_interval=1.0, measures_interval=10.0):
+        self.report_samples_interval = int(report_interval * Fs)
+        self.measures_samples_interval = int(measures_interval * Fs)
+        self.Fs = Fs
+
+    def __call__(self, block):
+        previous_samples_number = block.start
+        samples_number = block.start + len(block.raw)
+        if samples_number // self.report_samples_interval > previous_samples_number // self.report_samples_interval:
+            hr = '---' if np.isnan(block.hr) else block.hr
+            print(f'{samples_number / self.Fs:8.1f} s  HR: {hr}')
+        if samples_number // self.measures_samples_interval > previous_samples_number // self.measures_samples_interval:
+            print('    ' + ', '.join(f'{key}: {value:.2f}' for key, value in block.measures.items()))
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Records ECG and reports HR without the GUI. '
+                                                 'Stop with Ctrl+C.')
+    parser.add_argument('source', help='serial port, e.g. COM7 or /dev/ttyACM0, recording file to replay, '
+                                       '"synthetic" for the generated ECG or "stream:ADDRESS" '
+                                       'for the samples of another stream server')
+    parser.add_argument('--baudrate', type=int, default=38400)
+    parser.add_argument('--Fs', type=int, default=None, help='sampling frequency, 200 by default, '
+                                                             'taken from the binary recordings and the stream server')
+    parser.add_argument('--speed', type=float, default=1.0, help='speed of the replay or the synthetic ECG '
+                                                                 'relative to the real time, inf for no limit')
+    parser.add_argument('--hr', type=float, default=60.0, help='heart rate of the synthetic ECG')
+    parser.add_argument('--channels', type=int, default=None, help='1 by default, '
+                                                                   'taken from the binary recordings and the stream server')
+    parser.add_argument('--detection-channel', type=int, default=0, help='channel used for R peaks detection')
+    parser.add_argument('--output', default=None, help='recording file, .txt or .ecg, '
+                                                       'by default nothing is recorded')
+    parser.add_argument('--duration', type=float, default=None, help='in seconds, by default until Ctrl+C')
+    parser.add_argument('--report-interval', type=float, default=1.0, help='in seconds')
+    parser.add_argument('--adaptive-threshold', action='store_true')
+    parser.add_argument('--accelerated', action='store_true', help='compiled filters and detection loops, '
+                                                                   'needs numba')
+    parser.add_argument('--metrics', default=None, metavar='FILE',
+                        help='dump the performance metrics to a .json or .csv file')
+    parser.add_argument('--metrics-interval', type=float, default=1.0, help='in seconds')
+    parser.add_argument('--serve', default=None, metavar='ADDRESS',
+                        help='publish the samples and measures to local clients at host:port '
+                             'or at the path of the Unix socket')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    try:
+        source = create_input_source(args.source, args.baudrate, args.Fs, args.channels, args.speed, args.hr)
+    except (OSError, ValueError) as e:
+        print(e)
+        return
+    Fs = getattr(source, 'Fs', DEFAULT_FS if args.Fs is None else args.Fs)
+    print(f'Reading {source}')
+    engine = AcquisitionEngine(source, Fs, source.channels, args.detection_channel,
+                               adaptive_threshold=args.adaptive_threshold, accelerated=args.accelerated)
+    engine.subscribe(ConsoleReporter(Fs, args.report_interval))
+    server = None
+    if args.serve is not None:
+        server = StreamServer(Fs, source.channels, engine.adc_resolution, engine.max_voltage,
+                              parse_address(args.serve))
+        engine.subscribe(server)
+        print(f'Serving at {server.address}')
+    dumper = None
+    if args.metrics is not None:
+        metrics.enable()
+        dumper = MetricsDumper(metrics, args.metrics, args.metrics_interval)
+    if args.output is not None:
+        engine.start_recording(args.output)
+        print(f'Saving data to file {args.output}')
+    start_time = datetime.now()
+    engine.start()
+    try:
+        engine.finished_event.wait(args.duration)
+    except KeyboardInterrupt:
+        pass
+    dropped_samples_number = engine.stop()
+    if server is not None:
+        server.close()
+    if dumper is not None:
+        dumper.close()
+    print(f'Acquisition finished after {datetime.now() - start_time}, {engine.samples_number} samples')
+    if args.output is not None:
+        print(f'Data saved in {args.output}, {dropped_samples_number} samples dropped')
+
+
+if __name__ == '__main__':
+    main()
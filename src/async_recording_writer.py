@@ -0,0 +1,174 @@
+import queue
+import threading
+import time
+import numpy as np
+
+
+class AsyncRecordingWriter:
+    '''Writes the recording in a dedicated thread, so a slow disk
+    never stops the caller. The blocks wait in a bounded queue, when it
+    is full write_block waits at most put_timeout seconds and then drops
+    the block. The file is synced to the disk every fsync_interval seconds,
+    None turns the syncing off.
+
+    open_writer is called in the writer thread and has to return an object
+    with write_block, sync and close methods, e.g. BinaryRecordingWriter,
+    and add_peaks when the R peaks are passed to write_block,
+    e.g. IndexedRecordingWriter'''
+
+    def __init__(self, open_writer, queue_size=1000, fsync_interval=5.0, put_timeout=0.05):
+        self.open_writer = open_writer
+        self.fsync_interval = fsync_interval
+        self.put_timeout = put_timeout
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.written_samples_number = 0
+        self.dropped_samples_number = 0
+        self.dropped_blocks_number = 0
+        # runs of the dropped samples as the indices of the samples passed
+        # to write_block, with the number of all the samples dropped until
+        # the end of every run, to map the R peaks to the written samples
+        self.received_samples_number = 0
+        self.gaps_starts = np.zeros(0, dtype=int)
+        self.gaps_ends = np.zeros(0, dtype=int)
+        self.dropped_before_gaps_ends = np.zeros(0, dtype=int)
+        self.pending_peaks = np.zeros(0, dtype=int)
+        self.error = None
+        self.closed = False
+        # set by close, the thread finishes when the queue is empty,
+        # so closing never waits for a place in the full queue
+        self.closed_event = threading.Event()
+        # not a daemon thread, so the queued data is written
+        # even if the application exits without waiting for it
+        self.thread = threading.Thread(target=self._run, name='AsyncRecordingWriter')
+        self.thread.start()
+
+    def write_block(self, data_block, peaks_indices=None):
+        '''peaks_indices are the R peaks found since the previous block as
+        the indices of the samples passed to write_block, the dropped ones
+        included. They are moved back by the samples dropped before them,
+        so they point at the written samples, and the R peaks in the dropped
+        samples are left out'''
+        start = self.received_samples_number
+        self.received_samples_number += len(data_block)
+        if peaks_indices is not None:
+            # the peaks before this block are mapped for good, as the fate
+            # of their samples is already known
+            peaks_indices = np.concatenate([self.pending_peaks, self._map_peaks(peaks_indices)])
+        try:
+            self.queue.put((np.array(data_block), peaks_indices), timeout=self.put_timeout)
+            self.pending_peaks = np.zeros(0, dtype=int)
+        except queue.Full:
+            self.dropped_blocks_number += 1
+            self.dropped_samples_number += len(data_block)
+            self._add_gap(start, self.received_samples_number)
+            if peaks_indices is not None:
+                # the peaks in the written samples go with the next block
+                written_samples_number = start - self.dropped_samples_number + len(data_block)
+                self.pending_peaks = peaks_indices[peaks_indices < written_samples_number]
+
+    def _add_gap(self, start, end):
+        if len(self.gaps_ends) > 0 and self.gaps_ends[-1] == start:
+            self.gaps_ends[-1] = end
+            self.dropped_before_gaps_ends[-1] += end - start
+        else:
+            dropped_before_gap = self.dropped_before_gaps_ends[-1] if len(self.gaps_ends) > 0 else 0
+            self.gaps_starts = np.append(self.gaps_starts, start)
+            self.gaps_ends = np.append(self.gaps_ends, end)
+            self.dropped_before_gaps_ends = np.append(self.dropped_before_gaps_ends,
+                                                      dropped_before_gap + end - start)
+
+    def _map_peaks(self, peaks_indices):
+        peaks_indices = np.asarray(peaks_indices, dtype=int)
+        if len(self.gaps_starts) == 0:
+            return peaks_indices
+        # the last gap starting before every peak
+        gaps = np.searchsorted(self.gaps_starts, peaks_indices, side='right') - 1
+        after_gap = gaps >= 0
+        in_gap = after_gap & (peaks_indices < self.gaps_ends[gaps])
+        shifts = np.where(after_gap, self.dropped_before_gaps_ends[gaps], 0)
+        return (peaks_indices - shifts)[~in_gap]
+
+    def queued_blocks_number(self):
+        return self.queue.qsize()
+
+    def close(self, wait=True):
+        '''Finishes writing all the queued blocks and closes the file,
+        waits for it only when wait is set'''
+        if not self.closed:
+            self.closed = True
+            self.closed_event.set()
+            try:
+                # wakes the thread waiting for the blocks
+                self.queue.put_nowait(None)
+            except queue.Full:
+                pass
+        if wait:
+            self.thread.join()
+
+    def _get_blocks(self):
+        # take all the waiting blocks at once to write them in one call,
+        # wait no longer than until the next sync
+        try:
+            blocks = [self.queue.get(timeout=self.fsync_interval)]
+        except queue.Empty:
+            return [None] if self.closed_event.is_set() else []
+        while blocks[-1] is not None:
+            try:
+                blocks.append(self.queue.get_nowait())
+            except queue.Empty:
+                if self.closed_event.is_set():
+                    blocks.append(None)
+                break
+        return blocks
+
+    def _run(self):
+        try:
+            writer = self.open_writer()
+        except OSError as e:
+            print(e)
+            self.error = e
+            self._drop_all()
+            return
+        last_sync_time = time.monotonic()
+        finished = False
+        try:
+            while not finished:
+                blocks = self._get_blocks()
+                finished = len(blocks) > 0 and blocks[-1] is None
+                if finished:
+                    blocks = blocks[:-1]
+                if len(blocks) > 0:
+                    data_block = np.concatenate([block for block, _ in blocks])
+                    writer.write_block(data_block)
+                    self.written_samples_number += len(data_block)
+                    # the peaks are added after the samples they are found in
+                    peaks_indices = [peaks for _, peaks in blocks if peaks is not None and len(peaks) > 0]
+                    if len(peaks_indices) > 0:
+                        writer.add_peaks(np.concatenate(peaks_indices))
+                if finished and len(self.pending_peaks) > 0:
+                    # the R peaks reported with the blocks dropped at the end
+                    writer.add_peaks(self.pending_peaks)
+                if self.fsync_interval is not None and time.monotonic() - last_sync_time >= self.fsync_interval:
+                    writer.sync()
+                    last_sync_time = time.monotonic()
+        except OSError as e:
+            print(e)
+            self.error = e
+            if not finished:
+                self._drop_all()
+        finally:
+            writer.close()
+
+    def _drop_all(self):
+        # keep emptying the queue after an error, so the callers never wait
+        while True:
+            try:
+                item = self.queue.get(timeout=self.put_timeout)
+            except queue.Empty:
+                if self.closed_event.is_set():
+                    return
+                continue
+            if item is None:
+                return
+            self.dropped_blocks_number += 1
+            self.dropped_samples_number += len(item[0])
@@ -0,0 +1,140 @@
+import argparse
+import csv
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+import numpy as np
+import scipy.signal as ss
+
+from signal_processor import SignalProcessor, read_from_file
+from recording_format import BINARY_RECORDING_EXTENSION, read_binary_recording
+
+RECORDINGS_EXTENSIONS = ('.txt', BINARY_RECORDING_EXTENSION)
+
+
+def load_recording(filename, Fs, channels=1):
+    '''Returns the samples, with one column per channel when there
+    are many channels, and the sampling frequency. Fs and channels
+    are taken from the header of the binary recordings'''
+    if Path(filename).suffix == BINARY_RECORDING_EXTENSION:
+        header, samples = read_binary_recording(filename)
+        return np.asarray(samples, dtype=float), header.Fs
+    return read_from_file(filename, channels=channels), Fs
+
+
+def find_recordings(paths):
+    recordings = []
+    for path in map(Path, paths):
+        if path.is_dir():
+            recordings += sorted(p for p in path.iterdir() if p.suffix in RECORDINGS_EXTENSIONS)
+        else:
+            recordings.append(path)
+    return recordings
+
+
+def write_summary(summary, filename, output_format):
+    if output_format == 'json':
+        # NaN is not valid JSON
+        summary = {key: None if isinstance(value, float) and np.isnan(value) else value
+                   for key, value in summary.items()}
+        with open(filename, 'w') as f:
+            json.dump(summary, f, indent=4)
+    else:
+        with open(filename, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(summary))
+            writer.writeheader()
+            writer.writerow(summary)
+
+
+def summary_filenames(recordings, output_folder=None, output_format='csv'):
+    '''Names of the summaries of the recordings, with their extensions kept,
+    e.g. rec.txt_analysis.csv and rec.ecg_analysis.csv. The recordings
+    of the same name from different folders get numbered summaries
+    in the output folder'''
+    filenames = []
+    used_filenames = set()
+    for filename in map(Path, recordings):
+        folder = filename.parent if output_folder is None else Path(output_folder)
+        summary_filename = folder/f'{filename.name}_analysis.{output_format}'
+        number = 2
+        while summary_filename.resolve() in used_filenames:
+            summary_filename = folder/f'{filename.name}_analysis_{number}.{output_format}'
+            number += 1
+        used_filenames.add(summary_filename.resolve())
+        filenames.append(summary_filename)
+    return filenames
+
+
+def analyze_recording(filename, Fs=200, zero_phase=False, output_folder=None, output_format='csv',
+                      summary_filename=None, channels=1, detection_channel=0):
+    s, Fs = load_recording(filename, Fs, channels)
+    channels = 1 if s.ndim == 1 else s.shape[1]
+    if not 0 <= detection_channel < channels:
+        raise ValueError(f'No detection channel {detection_channel} in the recording of {channels} channels')
+    if s.ndim > 1:
+        s = s[:, detection_channel]
+    sp = SignalProcessor(Fs, use_sos=True)
+    if zero_phase:
+        s_filtered = ss.sosfiltfilt(sp.sos, s)
+    else:
+        s_filtered = sp.use_all_filters_on_block(s)
+    peaks_indices = sp.find_R_peaks(s_filtered)
+    measures = sp.make_ecg_analysis_on_peaks_indices(peaks_indices)
+    measures.update(sp.make_frequency_analysis_on_peaks_indices(peaks_indices))
+
+    summary = {
+        'file': str(filename),
+        'Fs': Fs,
+        'channels': channels,
+        'detection_channel': detection_channel,
+        'samples': len(s),
+        'duration': len(s) / Fs,
+        'peaks': len(peaks_indices),
+    }
+    summary.update({measure: float(value) for measure, value in measures.items()})
+
+    if summary_filename is None:
+        [summary_filename] = summary_filenames([filename], output_folder, output_format)
+    write_summary(summary, summary_filename, output_format)
+    return summary_filename
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Offline analysis of ECG recordings. '
+                                                 'Writes a summary of HRV measures for every recording.')
+    parser.add_argument('paths', nargs='+', help='recording files or folders with recordings')
+    parser.add_argument('--Fs', type=int, default=200, help='sampling frequency of the text recordings')
+    parser.add_argument('--channels', type=int, default=1, help='number of channels of the text recordings, '
+                                                                'taken from the binary recordings')
+    parser.add_argument('--detection-channel', type=int, default=0, help='channel used for R peaks detection')
+    parser.add_argument('--zero-phase', action='store_true', help='filter forwards and backwards')
+    parser.add_argument('--format', choices=['csv', 'json'], default='csv', help='format of the summaries')
+    parser.add_argument('--output-folder', default=None, help='folder for the summaries, '
+                                                              'by default next to the recordings')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes, '
+                                                                  'by default the number of CPUs')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    recordings = find_recordings(args.paths)
+    if args.output_folder is not None:
+        os.makedirs(args.output_folder, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        # the names are chosen before, so the processes never write the same summary
+        futures = {executor.submit(analyze_recording, filename, args.Fs, args.zero_phase,
+                                   args.output_folder, args.format, summary_filename,
+                                   args.channels, args.detection_channel): filename
+                   for filename, summary_filename in zip(recordings,
+                                                         summary_filenames(recordings, args.output_folder, args.format))}
+        for future in as_completed(futures):
+            try:
+                print(f'{futures[future]} analyzed, summary saved in {future.result()}')
+            except Exception as e:
+                print(f'{futures[future]} could not be analyzed: {e}')
+
+
+if __name__ == '__main__':
+    main()
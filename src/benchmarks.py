@@ -0,0 +1,1066 @@
+import argparse
+import json
+import os
+import platform
+import queue
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import warnings
+from datetime import datetime
+from pathlib import Path
+import numpy as np
+import scipy.signal as ss
+
+from signal_processor import SignalProcessor, read_from_file, iter_blocks_from_file
+from ring_buffer import RingBuffer
+from hrv_analyzer import IncrementalHRVAnalyzer, SpectralHRVAnalyzer
+from r_peaks_detector import StreamingRPeakDetector
+from port_handler import SerialStreamParser, read_blocks_from_serial_port
+from plot_decimation import decimate_min_max
+from recording_format import (convert_text_to_binary, read_binary_recording, BinaryRecordingWriter,
+                              TextRecordingWriter)
+from recording_index import RecordingIndex, IndexedRecordingWriter, build_recording_index, index_filename
+from async_recording_writer import AsyncRecordingWriter
+from acquisition_engine import AcquisitionEngine
+from sample_stream import StreamServer, StreamClient, SAMPLES_MESSAGE
+from input_sources import SyntheticECGSource
+from instrumentation import metrics
+
+
+def data_folder():
+    this_file_path = os.path.realpath(__file__)
+    folder_name = os.path.dirname(this_file_path)
+    return Path(os.path.join(folder_name, '../data/'))
+
+
+# results of the benchmarks run, saved as JSON and compared with the baseline
+results = {}
+# recording used by the benchmarks, the bundled one when not set
+recording = None
+
+
+def default_recording():
+    if recording is None:
+        return data_folder()/'example_ecg_data2.txt'
+    return recording
+
+
+def record(name, value, unit, higher_is_better=False):
+    results[name] = {'value': float(value), 'unit': unit, 'higher_is_better': higher_is_better}
+
+
+def write_synthetic_recording(filename, Fs=200, duration=600, hr=72):
+    source = SyntheticECGSource(Fs, hr, speed=np.inf, seed=0)
+    with TextRecordingWriter(filename) as writer:
+        writer.write_block(source.generate(duration * Fs))
+    return filename
+
+
+def measure_time(function, *args, repeat=3):
+    best_time = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        best_time = min(best_time, time.perf_counter() - start)
+    return best_time, result
+
+
+def filter_sample_by_sample(s, Fs):
+    sp = SignalProcessor(Fs)
+    return np.array([sp.use_all_filters(x) for x in s])
+
+
+def filter_in_blocks(s, Fs, block_size, use_sos=False):
+    sp = SignalProcessor(Fs, use_sos=use_sos)
+    blocks = [sp.use_all_filters_on_block(s[i:i + block_size]) for i in range(0, len(s), block_size)]
+    return np.concatenate(blocks)
+
+
+def benchmark_filtering(filename=None, Fs=200, block_sizes=(1, 10, 200, 2000)):
+    if filename is None:
+        filename = default_recording()
+    s = read_from_file(filename)
+    print(f'Filtering {len(s)} samples from {filename}')
+
+    t, reference = measure_time(filter_sample_by_sample, s, Fs, repeat=1)
+    print(f'use_all_filters (sample by sample): {len(s)/t:12.0f} samples/s')
+    record('filtering.sample_by_sample', len(s)/t, 'samples/s', True)
+
+    for block_size in block_sizes:
+        t, filtered = measure_time(filter_in_blocks, s, Fs, block_size)
+        max_error = np.max(np.abs(filtered - reference))
+        print(f'use_all_filters_on_block (block size {block_size:5d}): {len(s)/t:12.0f} samples/s, '
+              f'max difference: {max_error:.3g}')
+        record(f'filtering.block_{block_size}', len(s)/t, 'samples/s', True)
+
+
+def benchmark_sos_filtering(filename=None, Fs=200, block_sizes=(1, 200, 2000)):
+    '''Compares the fused second-order sections cascade
+    with the chain of the three (b, a) filters'''
+    if filename is None:
+        filename = default_recording()
+    s = read_from_file(filename)
+    print(f'Filtering {len(s)} samples from {filename} with the SOS cascade')
+
+    reference = filter_in_blocks(s, Fs, len(s))
+    for block_size in block_sizes:
+        t, filtered = measure_time(filter_in_blocks, s, Fs, block_size, True)
+        max_error = np.max(np.abs(filtered - reference))
+        relative_error = max_error / np.max(np.abs(reference))
+        print(f'SOS cascade (block size {block_size:5d}): {len(s)/t:12.0f} samples/s, '
+              f'max difference: {max_error:.3g} ({relative_error:.3g} of the signal range)')
+        record(f'filtering.sos_block_{block_size}', len(s)/t, 'samples/s', True)
+        assert relative_error < 1e-9, f'SOS cascade output differs from the chain of filters ' \
+                                      f'for the block size {block_size}'
+
+    def create_processor_with_filters():
+        sp = SignalProcessor(Fs)
+        # the filters are designed lazily, so they are taken to be measured too
+        return sp.ba, sp.sos
+
+    t, _ = measure_time(lambda: [create_processor_with_filters() for _ in range(1000)])
+    print(f'Creating SignalProcessor and its filters with cached coefficients: {t*1000:.3f} us')
+
+
+def update_list_buffer(samples, capacity):
+    # the way MainWindow used to keep its buffers
+    buffer = [0]
+    for x in samples:
+        if len(buffer) == capacity:
+            buffer = buffer[1:]
+        buffer.append(x)
+        view = np.array(buffer)
+    return buffer
+
+
+def update_ring_buffer(samples, capacity):
+    buffer = RingBuffer(capacity)
+    for x in samples:
+        buffer.append(x)
+        view = buffer.view()
+    return buffer
+
+
+def benchmark_buffers(Fs=200, windows_in_seconds=(3, 10, 60, 600), samples_number=20000):
+    '''Per-sample cost of appending a sample and taking a view
+    of the buffer for the window sizes like the ones in Configuration'''
+    samples = np.random.default_rng(0).normal(size=samples_number)
+    for window in windows_in_seconds:
+        capacity = window * Fs
+        # the buffers fill up first, so most of the samples are added to a full buffer
+        warm_up = np.concatenate([samples[:capacity], samples])
+        t_list, _ = measure_time(update_list_buffer, warm_up, capacity, repeat=1)
+        t_ring, _ = measure_time(update_ring_buffer, warm_up, capacity, repeat=1)
+        print(f'Buffer of {capacity:6d} samples: list {t_list/len(warm_up)*1e6:8.2f} us/sample, '
+              f'RingBuffer {t_ring/len(warm_up)*1e6:6.2f} us/sample')
+        record(f'ring_buffer.update_{capacity}', t_ring/len(warm_up)*1e6, 'us/sample')
+
+
+def analyze_whole_signal_repeatedly(sp, s, interval):
+    # the way MainWindow used to analyze the whole recording every interval
+    for end in range(interval, len(s) + 1, interval):
+        measures = sp.make_ecg_analysis(s[:end])
+    return measures
+
+
+def analyze_incrementally(sp, s, block_size):
+    analyzer = IncrementalHRVAnalyzer(sp)
+    for i in range(0, len(s), block_size):
+        analyzer.update(s[i:i + block_size])
+    analyzer.flush()
+    return analyzer.measures()
+
+
+def benchmark_hrv_analysis(filename=None, Fs=200):
+    if filename is None:
+        filename = default_recording()
+    sp = SignalProcessor(Fs)
+    s = sp.use_all_filters_on_block(read_from_file(filename))
+    print(f'HRV analysis of {len(s)} samples from {filename}')
+
+    interval = 10*Fs
+    t, _ = measure_time(analyze_whole_signal_repeatedly, sp, s, interval, repeat=1)
+    print(f'make_ecg_analysis on the whole signal every 10 s: {t:.3f} s')
+    t, measures = measure_time(analyze_incrementally, sp, s, Fs)
+    print(f'IncrementalHRVAnalyzer: {t:.3f} s')
+    record('hrv.incremental', t/len(s)*1e6, 'us/sample')
+    reference = sp.make_ecg_analysis(s)
+    for key, value in reference.items():
+        assert np.isclose(measures[key], value, rtol=1e-9, equal_nan=True), f'{key} differs'
+
+
+def analyze_spectrum_every_10_s(sp, peaks_indices, window=300):
+    # Welch's method on the R peaks of the last window every 10 s
+    measures = []
+    for end in range(10 * sp.Fs, peaks_indices[-1] + 1, 10 * sp.Fs):
+        in_window = (peaks_indices > end - window * sp.Fs) & (peaks_indices <= end)
+        measures.append(sp.make_frequency_analysis_on_peaks_indices(peaks_indices[in_window]))
+    return measures
+
+
+def analyze_spectrum_incrementally(sp, peaks_indices, window=300):
+    analyzer = SpectralHRVAnalyzer(window)
+    for i in range(1, len(peaks_indices)):
+        analyzer.add_rr_interval(peaks_indices[i] / sp.Fs, (1000/sp.Fs)*(peaks_indices[i] - peaks_indices[i - 1]))
+    return analyzer.measures()
+
+
+def benchmark_spectral_hrv(Fs=200, durations_in_minutes=(10, 60, 240), hr=72):
+    '''Cost of LF and HF power of the last 5 min recomputed every 10 s
+    and kept by SpectralHRVAnalyzer, on the synthetic ECG'''
+    sp = SignalProcessor(Fs)
+    for duration in durations_in_minutes:
+        s = SyntheticECGSource(Fs, hr, speed=np.inf, seed=0).generate(duration * 60 * Fs)
+        peaks_indices = sp.find_R_peaks(sp.use_all_filters_on_block(s))
+        t_batch, _ = measure_time(analyze_spectrum_every_10_s, sp, peaks_indices, repeat=1)
+        t_incremental, _ = measure_time(analyze_spectrum_incrementally, sp, peaks_indices)
+        # with the window covering all the R peaks the measures are the ones of the whole signal
+        measures = analyze_spectrum_incrementally(sp, peaks_indices, duration * 60)
+        reference = sp.make_frequency_analysis_on_peaks_indices(peaks_indices)
+        for key, value in reference.items():
+            assert np.isclose(measures[key], value, rtol=1e-9, equal_nan=True), f'{key} differs'
+        print(f'{duration:4d} min, {len(peaks_indices)} R peaks: Welch on the last 5 min every 10 s '
+              f'{t_batch/len(peaks_indices)*1e6:7.2f} us/beat, SpectralHRVAnalyzer '
+              f'{t_incremental/len(peaks_indices)*1e6:6.2f} us/beat, LF/HF {measures["lf_hf"]:.3g}')
+        record(f'spectral_hrv.incremental_{duration}min', t_incremental/len(peaks_indices)*1e6, 'us/beat')
+
+
+def parse_byte_by_byte(data):
+    # the way read_from_serial_port used to decode the data
+    values = []
+    value = ''
+    for i in range(len(data)):
+        x = data[i:i + 1].decode("utf-8")
+        if x.isdigit():
+            value += x
+        elif value != '':
+            values.append(float(value))
+            value = ''
+    return np.array(values)
+
+
+def parse_in_chunks(data, chunk_size, channels=1):
+    parser = SerialStreamParser(channels)
+    blocks = [parser.feed(data[i:i + chunk_size]) for i in range(0, len(data), chunk_size)]
+    return np.concatenate(blocks)
+
+
+def encode_as_serial_stream(s):
+    return ''.join(f'{int(x)}\n' for x in s).encode('utf-8')
+
+
+def benchmark_serial_parsing(filename=None, chunk_sizes=(64, 1024, 16384)):
+    if filename is None:
+        filename = default_recording()
+    s = read_from_file(filename)
+    data = encode_as_serial_stream(s)
+    print(f'Parsing {len(s)} values ({len(data)} bytes) from {filename}')
+
+    t, reference = measure_time(parse_byte_by_byte, data, repeat=1)
+    print(f'Byte by byte: {len(s)/t:12.0f} values/s')
+    for chunk_size in chunk_sizes:
+        t, values = measure_time(parse_in_chunks, data, chunk_size)
+        assert np.array_equal(values, reference), 'SerialStreamParser output differs'
+        print(f'SerialStreamParser (reads of {chunk_size:5d} bytes): {len(s)/t:12.0f} values/s')
+        record(f'serial_parsing.chunk_{chunk_size}', len(s)/t, 'values/s', True)
+
+    # a short line of many channels is dropped without shifting the next rows
+    rows = parse_in_chunks(b'junk\n1,2,3\n4,5\n6,7,8\n9,10,11\n', 4, channels=3)
+    assert np.array_equal(rows, [[1, 2, 3], [6, 7, 8], [9, 10, 11]]), 'SerialStreamParser rows are shifted'
+
+
+def benchmark_serial_port(filename=None, baudrates=(115200, 230400, 921600), duration=1.0):
+    '''Reads from a pseudo-terminal standing in for the device, which
+    sends the recording as fast as the given baudrate allows'''
+    import pty
+    import tty
+    if filename is None:
+        filename = default_recording()
+    s = read_from_file(filename)
+    data = encode_as_serial_stream(s)
+    bits_per_byte = 11  # start bit, 7 data bits, parity bit, 2 stop bits
+
+    for baudrate in baudrates:
+        device, port = pty.openpty()
+        tty.setraw(device)
+        bytes_number = min(len(data), int(baudrate / bits_per_byte * duration))
+        # the number cut at the end is never completed, so it is not counted
+        expected = SerialStreamParser().feed(data[:bytes_number])
+
+        def send():
+            chunk_size = max(1, baudrate // bits_per_byte // 100)
+            for i in range(0, bytes_number, chunk_size):
+                os.write(device, data[i:min(i + chunk_size, bytes_number)])
+                time.sleep(0.01)
+
+        reader = read_blocks_from_serial_port(os.ttyname(port), baudrate)
+        sender = threading.Thread(target=send)
+        start = time.perf_counter()
+        sender.start()
+        blocks = []
+        received = 0
+        while received < len(expected):
+            block = next(reader)
+            blocks.append(block)
+            received += len(block)
+        t = time.perf_counter() - start
+        sender.join()
+        reader.close()
+        os.close(device)
+        os.close(port)
+        values = np.concatenate(blocks)
+        assert np.array_equal(values, expected), 'values read from the port differ'
+        print(f'Baudrate {baudrate:7d}: {len(values)/t:9.0f} values/s in {len(blocks)} blocks')
+        record(f'serial_port.baudrate_{baudrate}', len(values)/t, 'values/s', True)
+
+
+def benchmark_plot_decimation(Fs=200, windows_in_seconds=(3, 60, 300, 600), widget_width=1920):
+    '''Time of preparing one frame of the plot from the ring buffer view'''
+    for window in windows_in_seconds:
+        capacity = window * Fs
+        x = RingBuffer(capacity)
+        y = RingBuffer(capacity)
+        x.extend(np.arange(capacity) / Fs)
+        y.extend(np.random.default_rng(0).normal(size=capacity))
+        t, (x_plotted, _) = measure_time(decimate_min_max, x.view(), y.view(), 2 * widget_width, repeat=20)
+        print(f'Plot window of {window:4d} s ({capacity:6d} samples): {t*1000:6.3f} ms per frame, '
+              f'{len(x_plotted)} points plotted')
+        record(f'plot_decimation.window_{window}s', t*1000, 'ms')
+
+
+def load_binary_recording(filename):
+    header, samples = read_binary_recording(filename)
+    return np.asarray(samples, dtype=float)
+
+
+def write_in_blocks(writer, s, block_size):
+    with writer:
+        for i in range(0, len(s), block_size):
+            writer.write_block(s[i:i + block_size])
+
+
+def benchmark_recording_format(filename=None, Fs=200, block_size=4):
+    if filename is None:
+        filename = default_recording()
+    with tempfile.TemporaryDirectory() as folder:
+        binary_filename = convert_text_to_binary(filename, Path(folder)/'recording.ecg')
+        t_text, s = measure_time(read_from_file, filename)
+        t_mmap, _ = measure_time(read_binary_recording, binary_filename)
+        t_binary, s_binary = measure_time(load_binary_recording, binary_filename)
+        assert np.array_equal(s, s_binary), 'binary recording differs from the text one'
+        text_size = os.path.getsize(filename)
+        binary_size = os.path.getsize(binary_filename)
+        # written in blocks as they come from the port
+        t_write_text, _ = measure_time(lambda: write_in_blocks(TextRecordingWriter(Path(folder)/'written.txt'),
+                                                               s, block_size))
+        t_write_binary, _ = measure_time(lambda: write_in_blocks(BinaryRecordingWriter(Path(folder)/'written.ecg',
+                                                                                       Fs), s, block_size))
+        # the small blocks are buffered by the writer, but the samples must be the same
+        assert np.array_equal(read_binary_recording(Path(folder)/'written.ecg')[1], s_binary), \
+            'binary recording written in blocks differs'
+    print(f'Recording {filename}, {len(s)} samples')
+    print(f'Text:   {text_size/1024:8.1f} KiB, loaded in {t_text*1000:8.3f} ms, '
+          f'written in blocks of {block_size} in {t_write_text*1000:8.3f} ms')
+    print(f'Binary: {binary_size/1024:8.1f} KiB, memory-mapped in {t_mmap*1000:8.3f} ms, '
+          f'loaded as floats in {t_binary*1000:8.3f} ms, '
+          f'written in blocks of {block_size} in {t_write_binary*1000:8.3f} ms')
+    record('recording.load_text', t_text*1000, 'ms')
+    record('recording.load_binary', t_binary*1000, 'ms')
+    record('recording.write_text', t_write_text*1000, 'ms')
+    record('recording.write_binary', t_write_binary*1000, 'ms')
+
+
+def read_line_by_line(filename):
+    # the way read_from_file used to parse the text recordings
+    with open(filename) as f:
+        lines = [float(line.rstrip()) for line in f.readlines()]
+    return np.array(lines)
+
+
+def read_in_blocks(filename, block_size):
+    return sum(len(block) for block in iter_blocks_from_file(filename, block_size))
+
+
+def benchmark_text_loading(filename=None, Fs=200):
+    if filename is None:
+        filename = default_recording()
+    t_lines, reference = measure_time(read_line_by_line, filename)
+    t_numpy, s = measure_time(read_from_file, filename)
+    assert np.array_equal(s, reference), 'read_from_file output differs'
+    t_blocks, _ = measure_time(read_in_blocks, filename, 10*Fs)
+    t_slice, s_slice = measure_time(read_from_file, filename, 149*Fs, 161*Fs)
+    assert np.array_equal(s_slice, reference[149*Fs:161*Fs]), 'read_from_file slice differs'
+    print(f'Loading {len(s)} samples from {filename}')
+    print(f'Line by line:                 {t_lines*1000:8.3f} ms')
+    print(f'read_from_file:               {t_numpy*1000:8.3f} ms')
+    print(f'iter_blocks_from_file:        {t_blocks*1000:8.3f} ms')
+    print(f'read_from_file 149 s - 161 s: {t_slice*1000:8.3f} ms')
+    record('text_loading.read_from_file', t_numpy*1000, 'ms')
+    record('text_loading.slice_12s', t_slice*1000, 'ms')
+
+    # a malformed line must not silently truncate the chunk
+    with tempfile.TemporaryDirectory() as folder:
+        malformed_filename = Path(folder)/'malformed.txt'
+        malformed_filename.write_bytes(b'1\n2\nx\n4\n')
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', DeprecationWarning)
+                read_from_file(malformed_filename)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('read_from_file accepted a malformed line')
+
+
+def find_beat_by_analyzing_whole_recording(filename, Fs, beat, margin):
+    # the way a beat was found before the recordings were indexed
+    sp = SignalProcessor(Fs)
+    s = read_from_file(filename)
+    peaks_indices = sp.find_R_peaks(sp.use_all_filters_on_block(s))
+    start = peaks_indices[beat] - int(round(margin * Fs))
+    return start, s[start:peaks_indices[beat] + int(round(margin * Fs)) + 1]
+
+
+class SlowWriter:
+    '''IndexedRecordingWriter on a disk so slow that the blocks are dropped'''
+
+    def __init__(self, writer, delay):
+        self.writer = writer
+        self.delay = delay
+
+    def write_block(self, data_block):
+        time.sleep(self.delay)
+        self.writer.write_block(data_block)
+
+    def __getattr__(self, name):
+        return getattr(self.writer, name)
+
+
+def record_with_drops(filename, Fs, samples_number=20000, block_size=4, peaks_interval=37, peaks_delay=500):
+    '''Records the samples of unique values with R peaks reported late, like
+    by the streaming detector, through a writer too slow to keep up'''
+    s = np.arange(samples_number, dtype=float)
+    peaks_indices = np.arange(0, samples_number, peaks_interval)
+    open_writer = lambda: SlowWriter(IndexedRecordingWriter(TextRecordingWriter(filename), index_filename(filename),
+                                                            Fs), 0.001)
+    writer = AsyncRecordingWriter(open_writer, queue_size=4, fsync_interval=None, put_timeout=0)
+    for start in range(0, samples_number, block_size):
+        end = start + block_size
+        reported = (peaks_indices >= start - peaks_delay) & (peaks_indices < end - peaks_delay)
+        if end >= samples_number:
+            reported = peaks_indices >= start - peaks_delay
+        writer.write_block(s[start:end], peaks_indices[reported])
+        if start % (20 * block_size) == 0:
+            time.sleep(0.005)  # the writer catches up from time to time
+    writer.close()
+    return writer, peaks_indices
+
+
+def benchmark_recording_index(Fs=200, duration_in_hours=2, hr=72, query_duration=180):
+    '''Building the index of a long synthetic text recording and reading
+    a time range and a beat through it'''
+    with tempfile.TemporaryDirectory() as folder:
+        filename = Path(folder)/'long.txt'
+        write_synthetic_recording(filename, Fs, int(duration_in_hours * 3600), hr)
+        t_build, _ = measure_time(build_recording_index, filename, Fs, repeat=1)
+        index = RecordingIndex(filename)
+        size = os.path.getsize(filename)
+        print(f'{duration_in_hours} h recording, {size/2**20:.1f} MiB: index built in {t_build:.2f} s, '
+              f'{os.path.getsize(index_filename(filename))/2**10:.0f} KiB, {len(index.peaks)} R peaks')
+        record('recording_index.build', t_build*1000, 'ms')
+
+        start = int(duration_in_hours * 3600 * Fs * 0.75)
+        stop = start + query_duration * Fs
+        t_scan, reference = measure_time(read_from_file, filename, start, stop)
+        t_index, s = measure_time(index.read_samples, start, stop)
+        assert np.array_equal(s, reference), 'indexed samples differ'
+        print(f'{query_duration} s from {start/Fs/3600:.1f} h: read_from_file {t_scan*1000:8.3f} ms, '
+              f'RecordingIndex {t_index*1000:6.3f} ms')
+        record(f'recording_index.time_range_{query_duration}s', t_index*1000, 'ms')
+
+        beat = len(index.peaks) // 2
+        t_whole, (reference_start, reference) = measure_time(find_beat_by_analyzing_whole_recording,
+                                                             filename, Fs, beat, 0.5, repeat=1)
+        t_index, (beat_start, s, _) = measure_time(index.read_beats, beat)
+        assert beat_start == reference_start and np.array_equal(s, reference), 'indexed beat differs'
+        print(f'Beat {beat}: analysis of the whole recording {t_whole*1000:8.1f} ms, '
+              f'RecordingIndex {t_index*1000:6.3f} ms')
+        record('recording_index.beat', t_index*1000, 'ms')
+
+        # the R peaks in the index must point at the same samples when the writer drops some of them
+        filename = Path(folder)/'dropped.txt'
+        writer, peaks_indices = record_with_drops(filename, Fs)
+        recorded = read_from_file(filename)
+        index = RecordingIndex(filename)
+        assert writer.dropped_samples_number > 0 and len(recorded) + writer.dropped_samples_number == 20000
+        assert np.array_equal(recorded[index.peaks], np.intersect1d(peaks_indices, recorded)), \
+            'indexed R peaks differ from the recorded ones after dropping samples'
+        print(f'{writer.dropped_samples_number} samples dropped by the writer, '
+              f'{len(index.peaks)} of {len(peaks_indices)} R peaks indexed at the right samples')
+
+
+def analyze_windows_naively(sp, s, window, step):
+    # re-running the whole analysis for every window
+    window_length = window * sp.Fs
+    step_length = step * sp.Fs
+    return [sp.make_ecg_analysis(s[start:start + window_length])
+            for start in range(0, len(s) - window_length + 1, step_length)]
+
+
+def benchmark_windowed_analysis(filename=None, Fs=200, windows=((300, 30), (60, 5), (10, 1))):
+    if filename is None:
+        filename = default_recording()
+    sp = SignalProcessor(Fs)
+    s = sp.use_all_filters_on_block(read_from_file(filename))
+    peaks_indices = sp.find_R_peaks(s)
+    print(f'Windowed HRV analysis of {len(s)} samples from {filename}')
+    for window, step in windows:
+        t_naive, _ = measure_time(analyze_windows_naively, sp, s, window, step, repeat=1)
+        t_vectorized, analysis = measure_time(sp.make_windowed_ecg_analysis, s, window, step)
+        # the same windows analyzed one by one on the same R peaks
+        for row in analysis:
+            in_window = (peaks_indices >= row['start'] * Fs) & (peaks_indices < row['end'] * Fs)
+            measures = sp.make_ecg_analysis_on_peaks_indices(peaks_indices[in_window])
+            for key in ['bpm', 'sdnn', 'rmssd', 'pnn50']:
+                assert np.isclose(row[key], measures[key], atol=1e-5, equal_nan=True), f'{key} differs'
+        print(f'Window {window:3d} s, step {step:2d} s, {len(analysis):4d} windows: '
+              f'per-window loop {t_naive*1000:9.3f} ms, vectorized {t_vectorized*1000:7.3f} ms')
+        record(f'windowed_analysis.window_{window}s_step_{step}s', t_vectorized*1000, 'ms')
+
+
+def refine_R_peaks_in_loop(s, peaks_indices, window_size=21):
+    # the way find_R_peaks used to refine the peaks one by one
+    maximized_peaks_indices = []
+    mid = window_size // 2
+    for i in peaks_indices:
+        window_start_index = max(0, i - mid)
+        window_end_index = min(len(s), i + mid + 1)
+        windowed_s = s[window_start_index:window_end_index]
+        argmax_index = np.argmax(np.array(windowed_s))
+        maximized_peaks_indices.append(window_start_index + argmax_index)
+    return np.array(maximized_peaks_indices)
+
+
+def benchmark_R_peaks_refinement(filename=None, Fs=200, repetitions=(1, 6)):
+    '''Refinement of the R peaks on the recording and on its repetitions
+    making about an hour long signal'''
+    if filename is None:
+        filename = default_recording()
+    sp = SignalProcessor(Fs)
+    s = sp.use_all_filters_on_block(read_from_file(filename))
+    for repetition in repetitions:
+        s_repeated = np.tile(s, repetition)
+        candidates = sp.find_R_peaks_candidates(s_repeated)
+        t_loop, reference = measure_time(refine_R_peaks_in_loop, s_repeated, candidates)
+        t_vectorized, peaks_indices = measure_time(sp.refine_R_peaks, s_repeated, candidates)
+        assert np.array_equal(peaks_indices, reference), 'refined R peaks differ'
+        t_find, _ = measure_time(sp.find_R_peaks, s_repeated)
+        print(f'{len(s_repeated)/Fs/60:5.1f} min, {len(candidates)} peaks: refinement in loop '
+              f'{t_loop*1000:8.3f} ms, vectorized {t_vectorized*1000:7.3f} ms, '
+              f'whole find_R_peaks {t_find*1000:8.3f} ms')
+        record(f'R_peaks_refinement.repetitions_{repetition}', t_vectorized*1000, 'ms')
+
+
+def find_hr_every_second(sp, s, block_size):
+    # the way MainWindow used to find HR in the last 10 s every second
+    buffer_length = 10 * sp.Fs
+    hrs = []
+    for end in range(block_size, len(s) + 1, block_size):
+        if end % sp.Fs < block_size and end >= buffer_length:
+            hrs.append(sp.find_hr(s[end - buffer_length:end]))
+    return hrs
+
+
+def split_into_blocks(s, block_size):
+    return [s[i:i + block_size] for i in range(0, len(s), block_size)]
+
+
+def detect_in_stream(sp, blocks):
+    detector = StreamingRPeakDetector(sp)
+    peaks = []
+    hrs = []
+    samples_number = 0
+    for block in blocks:
+        peaks.append(detector.update(block))
+        samples_number += len(block)
+        if samples_number % sp.Fs < len(block) and samples_number >= 10 * sp.Fs:
+            hrs.append(detector.hr())
+    peaks.append(detector.flush())
+    return np.concatenate(peaks), hrs, detector.latency()
+
+
+def benchmark_streaming_detection(filename=None, Fs=200, block_size=4):
+    if filename is None:
+        filename = default_recording()
+    s = SignalProcessor(Fs).use_all_filters_on_block(read_from_file(filename))
+    s = s[:len(s) - len(s) % block_size]
+    # the blocks come from the device, only the detection is timed
+    blocks = split_into_blocks(s, block_size)
+    print(f'R peaks detection in blocks of {block_size} samples from {filename}')
+    for adaptive_threshold in [False, True]:
+        sp = SignalProcessor(Fs, adaptive_threshold=adaptive_threshold)
+        t_batch, _ = measure_time(find_hr_every_second, sp, s, block_size)
+        t_stream, (peaks_indices, _, latency) = measure_time(detect_in_stream, sp, blocks)
+        assert np.array_equal(peaks_indices, sp.find_R_peaks(s)), 'streaming R peaks differ'
+        threshold = 'adaptive' if adaptive_threshold else 'fixed'
+        print(f'{threshold} threshold: find_hr on the 10 s buffer every second '
+              f'{t_batch/len(s)*1e6:6.2f} us/sample, StreamingRPeakDetector {t_stream/len(s)*1e6:6.2f} us/sample, '
+              f'latency at most {latency/Fs:.2f} s')
+        name = 'streaming_detection' if not adaptive_threshold else 'streaming_detection.adaptive_threshold'
+        record(name, t_stream/len(s)*1e6, 'us/sample')
+
+
+def find_R_peaks_with_200_Hz_parameters(sp, s):
+    # the detector before its parameters were set in seconds
+    s_ma = sp.moving_average(s, 5)
+    diff_abs2 = np.abs(np.diff(s_ma))**2
+    peaks_indices, _ = ss.find_peaks(diff_abs2, height=5000, distance=66)
+    return sp.refine_R_peaks(s, peaks_indices, 21)
+
+
+def compare_R_peaks(peaks_times, reference_times, tolerance=0.05):
+    '''Returns sensitivity and positive predictivity of the R peaks
+    matched with the reference ones within tolerance in seconds'''
+    if len(peaks_times) == 0 or len(reference_times) == 0:
+        return 0.0, 0.0
+    nearest = np.clip(np.searchsorted(peaks_times, reference_times), 1, len(peaks_times) - 1)
+    distances = np.minimum(np.abs(peaks_times[nearest] - reference_times),
+                           np.abs(peaks_times[nearest - 1] - reference_times))
+    true_positives = np.sum(distances <= tolerance)
+    return true_positives / len(reference_times), min(1.0, true_positives / len(peaks_times))
+
+
+def benchmark_detection_at_sampling_rates(filenames=None, Fs=200, sampling_rates=(200, 500, 1000)):
+    '''The recordings are resampled to the other sampling rates and the
+    R peaks found there are compared with the ones found at 200 Hz.
+    The StreamingRPeakDetector has to find the same R peaks as
+    find_R_peaks on the whole signal'''
+    if filenames is None and recording is not None:
+        filenames = [recording]
+    elif filenames is None:
+        filenames = [data_folder()/'example_ecg_data1.txt', data_folder()/'example_ecg_data2.txt']
+    for filename in filenames:
+        s = read_from_file(filename)
+        sp = SignalProcessor(Fs)
+        reference_times = sp.find_R_peaks(sp.use_all_filters_on_block(s)) / Fs
+        print(f'R peaks detection at different sampling rates, {len(reference_times)} R peaks in {filename}')
+        for new_Fs in sampling_rates:
+            s_resampled = ss.resample_poly(s, new_Fs, Fs)
+            # name, adaptive threshold, detector
+            detectors = [
+                ('200 Hz parameters', False, find_R_peaks_with_200_Hz_parameters),
+                ('fixed threshold', False, SignalProcessor.find_R_peaks),
+                ('adaptive threshold', True, SignalProcessor.find_R_peaks),
+            ]
+            for name, adaptive_threshold, detector in detectors:
+                sp = SignalProcessor(new_Fs, adaptive_threshold=adaptive_threshold)
+                s_filtered = sp.use_all_filters_on_block(s_resampled)
+                t, peaks_indices = measure_time(detector, sp, s_filtered)
+                sensitivity, positive_predictivity = compare_R_peaks(peaks_indices / new_Fs, reference_times)
+                if detector is SignalProcessor.find_R_peaks:
+                    # the live engine must find the same R peaks
+                    block_size = 4
+                    s_blocks = s_filtered[:len(s_filtered) - len(s_filtered) % block_size]
+                    streaming_peaks_indices, _, _ = detect_in_stream(sp, split_into_blocks(s_blocks, block_size))
+                    assert np.array_equal(streaming_peaks_indices, detector(sp, s_blocks)), \
+                        f'streaming R peaks differ at {new_Fs} Hz with the {name}'
+                print(f'{new_Fs:5d} Hz, {name:18s}: sensitivity {sensitivity:6.1%}, '
+                      f'positive predictivity {positive_predictivity:6.1%}, '
+                      f'{len(s_filtered)/t/1e6:6.2f} M samples/s')
+                record(f'detection.{Path(filename).stem}.{new_Fs}Hz.{name.replace(" ", "_")}.sensitivity',
+                       sensitivity, 'ratio', True)
+
+
+def benchmark_multichannel_filtering(filename=None, Fs=200, channels_numbers=(1, 2, 4, 8, 12), block_size=4):
+    '''Cost of filtering one sample of every channel when all the channels
+    are filtered together, the recording is copied to every channel'''
+    if filename is None:
+        filename = default_recording()
+    s = read_from_file(filename)
+    reference = filter_in_blocks(s, Fs, block_size)
+    for channels in channels_numbers:
+        s_channels = np.repeat(s[:, np.newaxis], channels, axis=1)
+        t, filtered = measure_time(filter_in_blocks, s_channels, Fs, block_size)
+        max_error = np.max(np.abs(filtered - reference[:, np.newaxis]))
+        print(f'{channels:3d} channels (block size {block_size}): {len(s)/t:10.0f} samples/s, '
+              f'{t/len(s)/channels*1e6:6.3f} us per sample of one channel, max difference: {max_error:.3g}')
+        record(f'multichannel_filtering.channels_{channels}', t/len(s)/channels*1e6, 'us/sample')
+
+
+def receive_samples(client, samples_number, received):
+    blocks = []
+    received_samples_number = 0
+    while received_samples_number < samples_number:
+        message = client.read_message()
+        if message is not None and message[0] == SAMPLES_MESSAGE:
+            blocks.append(message[1][1][:, 0])
+            received_samples_number += len(blocks[-1])
+    received.append((np.concatenate(blocks), client.lost_messages_number))
+
+
+def benchmark_stream_server(filename=None, Fs=200, clients_number=3, block_size=4, repetitions=2,
+                            queue_size=1000):
+    '''Publishes the recording to the clients on localhost as fast as it is processed.
+    One more client connects but never reads, the frames that do not fit
+    in its queue are dropped while the other clients receive all the samples'''
+    if filename is None:
+        filename = default_recording()
+    s = np.tile(read_from_file(filename), repetitions)
+    engine = AcquisitionEngine(None, Fs)
+    server = StreamServer(Fs, address=('127.0.0.1', 0), queue_size=queue_size)
+    engine.subscribe(server)
+    received = []
+    threads = [threading.Thread(target=receive_samples, args=(StreamClient(server.address), len(s), received))
+               for _ in range(clients_number)]
+    # small receive buffer, so the frames wait in the server queue
+    stalled_client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    stalled_client.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    stalled_client.connect(server.address)
+    while server.clients_number() < clients_number + 1:
+        time.sleep(0.01)
+    for thread in threads:
+        thread.start()
+
+    start = time.perf_counter()
+    for i in range(0, len(s), block_size):
+        engine.process_block(s[i:i + block_size])
+    t_processing = time.perf_counter() - start
+    for thread in threads:
+        thread.join()
+    t_total = time.perf_counter() - start
+    dropped_frames_number = server.dropped_frames_number()
+    stalled_client.close()
+    server.close()
+    print(f'Stream server, {clients_number} clients, block size {block_size}: '
+          f'{len(s)/t_processing:10.0f} samples/s processed and published, '
+          f'{len(s)/t_total:10.0f} samples/s received, '
+          f'{dropped_frames_number} frames dropped for the stalled client')
+    record('stream_server.published', len(s)/t_processing, 'samples/s', True)
+    for samples, lost_messages_number in received:
+        assert np.array_equal(samples, s), 'received samples differ from the sent ones'
+        assert lost_messages_number == 0, 'messages lost by a reading client'
+
+
+def benchmark_synthetic_acquisition(sampling_rates=(200, 1000, 5000, 20000), duration=60, hr=72):
+    '''Throughput of the whole acquisition pipeline fed with the synthetic ECG
+    as fast as possible, the heart rate found has to be the generated one'''
+    for Fs in sampling_rates:
+        source = SyntheticECGSource(Fs, hr, speed=np.inf, seed=0)
+        engine = AcquisitionEngine(source, Fs, block_interval=0.02)
+        hr_found = []
+        engine.subscribe(lambda block: hr_found.append(block.hr))
+        start = time.perf_counter()
+        for block in source.read_blocks():
+            for i in range(0, len(block), int(0.02 * Fs)):
+                engine.process_block(block[i:i + int(0.02 * Fs)])
+            if engine.samples_number >= duration * Fs:
+                break
+        t = time.perf_counter() - start
+        print(f'Synthetic ECG at {Fs:5d} Hz, blocks of 20 ms: {engine.samples_number/t:10.0f} samples/s, '
+              f'{engine.samples_number/t/Fs:7.1f}x real time, HR: {hr_found[-1]}')
+        record(f'synthetic_acquisition.{Fs}Hz', engine.samples_number/t/Fs, 'x real time', True)
+        assert abs(hr_found[-1] - hr) <= 2, 'wrong HR of the synthetic ECG'
+
+
+def benchmark_analysis_latency(filename=None, Fs=200, durations_in_minutes=(1, 5, 10, 30, 60)):
+    '''Latency of find_R_peaks and make_ecg_analysis against the signal length,
+    the recording is repeated for the longer signals'''
+    if filename is None:
+        filename = default_recording()
+    sp = SignalProcessor(Fs)
+    s = sp.use_all_filters_on_block(read_from_file(filename))
+    print(f'Analysis latency against the signal length, signal from {filename}')
+    for duration in durations_in_minutes:
+        length = duration * 60 * Fs
+        s_repeated = np.tile(s, -(-length // len(s)))[:length]
+        t_peaks, _ = measure_time(sp.find_R_peaks, s_repeated)
+        t_analysis, _ = measure_time(sp.make_ecg_analysis, s_repeated)
+        print(f'{duration:3d} min: find_R_peaks {t_peaks*1000:9.3f} ms, make_ecg_analysis {t_analysis*1000:9.3f} ms')
+        record(f'analysis_latency.find_R_peaks_{duration}min', t_peaks*1000, 'ms')
+        record(f'analysis_latency.make_ecg_analysis_{duration}min', t_analysis*1000, 'ms')
+
+
+class TimedSyntheticECGSource(SyntheticECGSource):
+    '''Remembers when the generation started, the sample i exists
+    at start_time + (i + 1)/Fs as if it was sent by the device'''
+
+    def read_blocks(self, timeout=0.1):
+        self.start_time = time.monotonic()
+        yield from super().read_blocks(timeout)
+
+
+def benchmark_sample_to_screen_latency(Fs=200, duration=10.0, hr=72, frame_rate=30, widget_width=1920):
+    '''Time from the moment the sample exists until it is in the plotted
+    points. The engine runs in its thread like in the GUI, the blocks are
+    passed through a queue like the Qt signal and the plot is prepared
+    frame_rate times per second like by MainWindow.refreshPlot'''
+    source = TimedSyntheticECGSource(Fs, hr, seed=0)
+    engine = AcquisitionEngine(source, Fs)
+    blocks = queue.Queue()
+    engine.subscribe(blocks.put)
+    capacity = 3 * Fs
+    x = RingBuffer(capacity)
+    y = RingBuffer(capacity)
+    latencies = []
+    engine.start()
+    end_time = time.monotonic() + duration
+    while time.monotonic() < end_time:
+        time.sleep(1 / frame_rate)
+        newest_sample = None
+        while not blocks.empty():
+            block = blocks.get()
+            x.extend(np.arange(block.start, block.start + len(block.raw)) / Fs)
+            y.extend(block.filtered[:, 0])
+            newest_sample = block.start + len(block.raw) - 1
+        if newest_sample is None:
+            continue
+        decimate_min_max(x.view(), y.view(), 2 * widget_width)
+        latencies.append(time.monotonic() - (source.start_time + (newest_sample + 1) / Fs))
+    engine.stop()
+    latencies = np.array(latencies) * 1000
+    print(f'Sample to screen latency at {Fs} Hz, {frame_rate} fps, {len(latencies)} frames: '
+          f'median {np.median(latencies):6.1f} ms, 95th percentile {np.percentile(latencies, 95):6.1f} ms, '
+          f'max {np.max(latencies):6.1f} ms')
+    record('sample_to_screen_latency.median', np.median(latencies), 'ms')
+    record('sample_to_screen_latency.p95', np.percentile(latencies, 95), 'ms')
+
+
+def import_times(module):
+    '''Returns the cumulative import times in ms of all the modules
+    imported with the module in a new interpreter, from python -X importtime'''
+    src_folder = os.path.dirname(os.path.realpath(__file__))
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            cwd=src_folder, capture_output=True, text=True, check=True).stderr
+    times = {}
+    for line in output.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            _, cumulative, name = line[len('import time:'):].split('|')
+            if cumulative.strip().isdigit():
+                times[name.strip()] = int(cumulative) / 1000
+    return times
+
+
+def benchmark_startup(modules=('acquisition_engine', 'signal_processor', 'batch_analysis'), top=5):
+    '''Cold import time of the entry points, the live processing
+    must not import matplotlib'''
+    for module in modules:
+        times = import_times(module)
+        assert not any(name.startswith('matplotlib') for name in times), f'{module} imports matplotlib'
+        slowest = sorted(((t, name) for name, t in times.items() if name != module), reverse=True)[:top]
+        print(f'import {module}: {times[module]:7.1f} ms, slowest: ' +
+              ', '.join(f'{name} {t:.0f} ms' for t, name in slowest))
+        record(f'startup.import_{module}', times[module], 'ms')
+
+
+def process_in_blocks(s, Fs, block_size):
+    engine = AcquisitionEngine(None, Fs)
+    for i in range(0, len(s), block_size):
+        engine.process_block(s[i:i + block_size])
+
+
+def time_stages_with_metrics(calls_number):
+    for _ in range(calls_number):
+        stages = metrics.stages('benchmark')
+        if stages:
+            stages.lap('stage')
+
+
+def benchmark_instrumentation(filename=None, Fs=200, block_size=4, calls_number=100000):
+    '''Cost of the instrumented acquisition with the metrics disabled and enabled'''
+    if filename is None:
+        filename = default_recording()
+    s = read_from_file(filename)
+    enabled = metrics.enabled
+    metrics.enable(False)
+    t_call_disabled, _ = measure_time(time_stages_with_metrics, calls_number)
+    t_disabled, _ = measure_time(process_in_blocks, s, Fs, block_size, repeat=5)
+    metrics.enable(True)
+    t_call_enabled, _ = measure_time(time_stages_with_metrics, calls_number)
+    t_enabled, _ = measure_time(process_in_blocks, s, Fs, block_size, repeat=5)
+    metrics.enable(enabled)
+    metrics.reset()
+    print(f'Stages timer with one stage: disabled {t_call_disabled/calls_number*1e6:.3f} us, '
+          f'enabled {t_call_enabled/calls_number*1e6:.3f} us per call')
+    print(f'AcquisitionEngine.process_block, blocks of {block_size}: metrics disabled '
+          f'{len(s)/t_disabled:9.0f} samples/s, enabled {len(s)/t_enabled:9.0f} samples/s '
+          f'({t_enabled/t_disabled - 1:+.1%})')
+    record('instrumentation.disabled_call', t_call_disabled/calls_number*1e6, 'us')
+
+
+def filter_sample_by_sample_with(sp, s):
+    return np.array([sp.use_all_filters(x) for x in s])
+
+
+def filter_in_blocks_with(sp, s, block_size):
+    return np.concatenate([sp.use_all_filters_on_block(s[i:i + block_size]) for i in range(0, len(s), block_size)])
+
+
+def benchmark_compiled_kernels(filename=None, Fs=200, block_size=4, tolerance=1e-9):
+    '''Per-sample latency of the compiled filters and detection loops
+    compared with the SciPy ones, the results must be the same within
+    tolerance relative to the signal range'''
+    import compiled_kernels
+    if not compiled_kernels.AVAILABLE:
+        print('numba is not installed, compiled kernels skipped')
+        return
+    if filename is None:
+        filename = default_recording()
+    s = read_from_file(filename)
+    print(f'Compiled kernels on {len(s)} samples from {filename}')
+    start = time.perf_counter()
+    for use_sos in [False, True]:
+        sp = SignalProcessor(Fs, use_sos=use_sos, accelerated=True)
+        sp.use_all_filters(s[0])
+        sp.use_all_filters_on_block(s[:block_size])
+        sp.find_R_peaks(sp.use_all_filters_on_block(s[:10 * Fs]))
+    print(f'First calls with the compilation or loading from the cache: {(time.perf_counter() - start)*1000:.0f} ms')
+
+    for use_sos in [False, True]:
+        name = 'sos' if use_sos else 'ba'
+        reference_sp = SignalProcessor(Fs, use_sos=use_sos)
+        t_scipy, reference = measure_time(filter_sample_by_sample_with, reference_sp, s, repeat=1)
+        sp = SignalProcessor(Fs, use_sos=use_sos, accelerated=True)
+        t_compiled, filtered = measure_time(filter_sample_by_sample_with, sp, s, repeat=1)
+        relative_error = np.max(np.abs(filtered - reference)) / np.max(np.abs(reference))
+        assert relative_error < tolerance, f'compiled {name} filters differ'
+        print(f'{name:3s} use_all_filters: SciPy {t_scipy/len(s)*1e6:6.2f} us/sample, '
+              f'compiled {t_compiled/len(s)*1e6:6.2f} us/sample, difference {relative_error:.3g}')
+        record(f'compiled_kernels.{name}_sample', t_compiled/len(s)*1e6, 'us/sample')
+
+        reference_sp = SignalProcessor(Fs, use_sos=use_sos)
+        t_scipy, reference = measure_time(filter_in_blocks_with, reference_sp, s, block_size, repeat=1)
+        sp = SignalProcessor(Fs, use_sos=use_sos, accelerated=True)
+        t_compiled, filtered = measure_time(filter_in_blocks_with, sp, s, block_size, repeat=1)
+        relative_error = np.max(np.abs(filtered - reference)) / np.max(np.abs(reference))
+        assert relative_error < tolerance, f'compiled {name} block filters differ'
+        print(f'{name:3s} use_all_filters_on_block (block size {block_size}): SciPy {t_scipy/len(s)*1e6:6.2f} '
+              f'us/sample, compiled {t_compiled/len(s)*1e6:6.2f} us/sample, difference {relative_error:.3g}')
+        record(f'compiled_kernels.{name}_block_{block_size}', t_compiled/len(s)*1e6, 'us/sample')
+
+    reference_sp = SignalProcessor(Fs)
+    sp = SignalProcessor(Fs, accelerated=True)
+    s_filtered = reference_sp.use_all_filters_on_block(s)
+    w = reference_sp.moving_average_width
+    t_numpy, reference = measure_time(reference_sp.moving_average, s_filtered, w)
+    t_compiled, s_ma = measure_time(sp.moving_average, s_filtered, w)
+    assert np.allclose(s_ma, reference, rtol=0, atol=tolerance * np.max(np.abs(s_filtered))), 'moving average differs'
+    print(f'moving_average: NumPy {t_numpy*1000:7.3f} ms, compiled {t_compiled*1000:7.3f} ms')
+
+    candidates = reference_sp.find_R_peaks_candidates(s_filtered)
+    t_numpy, reference = measure_time(reference_sp.refine_R_peaks, s_filtered, candidates)
+    t_compiled, peaks_indices = measure_time(sp.refine_R_peaks, s_filtered, candidates)
+    assert np.array_equal(peaks_indices, reference), 'compiled refinement differs'
+    assert np.array_equal(sp.find_R_peaks(s_filtered), reference_sp.find_R_peaks(s_filtered)), 'R peaks differ'
+    print(f'refine_R_peaks: NumPy {t_numpy*1000:7.3f} ms, compiled {t_compiled*1000:7.3f} ms')
+
+    s_filtered = s_filtered[:len(s_filtered) - len(s_filtered) % block_size]
+    blocks = split_into_blocks(s_filtered, block_size)
+    t_scipy, (reference, _, _) = measure_time(detect_in_stream, reference_sp, blocks, repeat=1)
+    t_compiled, (peaks_indices, _, _) = measure_time(detect_in_stream, sp, blocks, repeat=1)
+    assert np.array_equal(peaks_indices, reference), 'compiled streaming R peaks differ'
+    print(f'StreamingRPeakDetector: SciPy {t_scipy/len(s_filtered)*1e6:6.2f} us/sample, '
+          f'compiled {t_compiled/len(s_filtered)*1e6:6.2f} us/sample')
+    record('compiled_kernels.streaming_detection', t_compiled/len(s_filtered)*1e6, 'us/sample')
+
+
+BENCHMARKS = [
+    benchmark_filtering,
+    benchmark_sos_filtering,
+    benchmark_buffers,
+    benchmark_hrv_analysis,
+    benchmark_spectral_hrv,
+    benchmark_serial_parsing,
+    benchmark_serial_port,
+    benchmark_plot_decimation,
+    benchmark_recording_format,
+    benchmark_text_loading,
+    benchmark_recording_index,
+    benchmark_windowed_analysis,
+    benchmark_R_peaks_refinement,
+    benchmark_streaming_detection,
+    benchmark_detection_at_sampling_rates,
+    benchmark_multichannel_filtering,
+    benchmark_stream_server,
+    benchmark_synthetic_acquisition,
+    benchmark_analysis_latency,
+    benchmark_sample_to_screen_latency,
+    benchmark_startup,
+    benchmark_instrumentation,
+    benchmark_compiled_kernels,
+]
+
+
+def save_results(filename):
+    import scipy
+    output = {
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'recording': str(default_recording()),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'scipy': scipy.__version__,
+        'results': results,
+    }
+    with open(filename, 'w') as f:
+        json.dump(output, f, indent=4)
+
+
+def compare_with_baseline(baseline_filename, tolerance=0.2):
+    '''Prints the results worse than the baseline by more than tolerance,
+    as a fraction of the baseline value, returns their number'''
+    with open(baseline_filename) as f:
+        baseline = json.load(f)['results']
+    regressions_number = 0
+    print(f'Comparison with {baseline_filename}, tolerance {tolerance:.0%}')
+    for name, result in results.items():
+        if name not in baseline or baseline[name]['value'] == 0:
+            continue
+        change = result['value'] / baseline[name]['value'] - 1
+        if not result['higher_is_better']:
+            change = -change
+        if change < -tolerance:
+            regressions_number += 1
+            print(f'REGRESSION {name}: {result["value"]:.4g} {result["unit"]}, '
+                  f'baseline {baseline[name]["value"]:.4g} {result["unit"]} ({change:+.0%})')
+    print(f'{regressions_number} regressions in {len(results)} results')
+    return regressions_number
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Benchmarks of the acquisition and analysis pipeline.')
+    parser.add_argument('--recording', default=None, help='text recording used by the benchmarks, '
+                                                          '"synthetic" for the generated ECG, '
+                                                          'by default the bundled recording')
+    parser.add_argument('--only', nargs='+', default=None, help='run only the benchmarks with names '
+                                                                'containing any of the given words')
+    parser.add_argument('--output', default=None, help='JSON file for the results')
+    parser.add_argument('--baseline', default=None, help='JSON file with the results to compare with, '
+                                                         'the exit code is 1 when there are regressions')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative regression')
+    return parser.parse_args()
+
+
+def main():
+    global recording
+    args = parse_arguments()
+    with tempfile.TemporaryDirectory() as folder:
+        if args.recording == 'synthetic':
+            recording = write_synthetic_recording(Path(folder)/'synthetic_ecg.txt')
+        elif args.recording is not None:
+            recording = Path(args.recording)
+        for benchmark in BENCHMARKS:
+            if args.only is None or any(word in benchmark.__name__ for word in args.only):
+                benchmark()
+    if args.output is not None:
+        save_results(args.output)
+        print(f'Results saved in {args.output}')
+    if args.baseline is not None and compare_with_baseline(args.baseline, args.tolerance) > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+'''Compiled loops of the real-time path, used by SignalProcessor
+with accelerated=True. The filters keep their state in the
+preallocated arrays of the processor and update it in place, so a
+single sample costs one call without any temporary arrays.
+numba is optional, AVAILABLE is False when it is not installed'''
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+AVAILABLE = numba is not None
+
+
+def jit(function):
+    if numba is None:
+        return function
+    # compiled on the first call and cached on the disk for the next runs
+    return numba.njit(cache=True, nogil=True)(function)
+
+
+@jit
+def lfilter_block(b, a, x, zi):
+    '''Direct form II transposed filter of the columns of x,
+    a[0] must be 1 and b and a of the same length'''
+    y = np.empty_like(x)
+    order = zi.shape[0]
+    for n in range(x.shape[0]):
+        for c in range(x.shape[1]):
+            xn = x[n, c]
+            yn = zi[0, c] + b[0] * xn
+            for k in range(order - 1):
+                zi[k, c] = zi[k + 1, c] + b[k + 1] * xn - a[k + 1] * yn
+            zi[order - 1, c] = b[order] * xn - a[order] * yn
+            y[n, c] = yn
+    return y
+
+
+@jit
+def lfilter_sample(b, a, x, zi):
+    order = zi.shape[0]
+    y = zi[0] + b[0] * x
+    for k in range(order - 1):
+        zi[k] = zi[k + 1] + b[k + 1] * x - a[k + 1] * y
+    zi[order - 1] = b[order] * x - a[order] * y
+    return y
+
+
+@jit
+def sosfilt_block(sos, x, zi):
+    '''Cascade of second-order sections, zi has the shape
+    (sections, 2, channels) like in scipy.signal.sosfilt'''
+    y = np.empty_like(x)
+    for n in range(x.shape[0]):
+        for c in range(x.shape[1]):
+            xn = x[n, c]
+            for s in range(sos.shape[0]):
+                yn = sos[s, 0] * xn + zi[s, 0, c]
+                zi[s, 0, c] = sos[s, 1] * xn - sos[s, 4] * yn + zi[s, 1, c]
+                zi[s, 1, c] = sos[s, 2] * xn - sos[s, 5] * yn
+                xn = yn
+            y[n, c] = xn
+    return y
+
+
+@jit
+def sosfilt_sample(sos, x, zi):
+    for s in range(sos.shape[0]):
+        y = sos[s, 0] * x + zi[s, 0]
+        zi[s, 0] = sos[s, 1] * x - sos[s, 4] * y + zi[s, 1]
+        zi[s, 1] = sos[s, 2] * x - sos[s, 5] * y
+        x = y
+    return x
+
+
+@jit
+def moving_average_kernel(x, w):
+    z_length = w // 2 - 1
+    ma_length = abs(len(x) - w) + 1
+    con = np.zeros(ma_length + 2 * z_length)
+    if len(x) < w:
+        # np.convolve swaps the arguments, every window holds the whole x
+        con[z_length:z_length + ma_length] = np.sum(x) / w
+        return con
+    window_sum = 0.0
+    for i in range(w - 1):
+        window_sum += x[i]
+    for i in range(ma_length):
+        window_sum += x[i + w - 1]
+        con[z_length + i] = window_sum / w
+        window_sum -= x[i]
+    return con
+
+
+@jit
+def refine_R_peaks_kernel(s, peaks_indices, window_size):
+    mid = window_size // 2
+    maximized_peaks_indices = np.empty(len(peaks_indices), dtype=np.int64)
+    for n in range(len(peaks_indices)):
+        i = peaks_indices[n]
+        window_start_index = max(0, i - mid)
+        window_end_index = min(len(s), i + mid + 1)
+        argmax_index = window_start_index
+        for j in range(window_start_index + 1, window_end_index):
+            if s[j] > s[argmax_index]:
+                argmax_index = j
+        maximized_peaks_indices[n] = argmax_index
+    return maximized_peaks_indices
+
+
+def moving_average(x, w):
+    '''The same as SignalProcessor.moving_average'''
+    return moving_average_kernel(np.ascontiguousarray(x, dtype=float), w)
+
+
+def refine_R_peaks(s, peaks_indices, window_size=21):
+    '''The same as SignalProcessor.refine_R_peaks'''
+    if len(peaks_indices) == 0:
+        return np.array([])
+    return refine_R_peaks_kernel(np.ascontiguousarray(s, dtype=float),
+                                 np.ascontiguousarray(peaks_indices, dtype=np.int64), window_size)
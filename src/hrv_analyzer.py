@@ -0,0 +1,167 @@
+from collections import deque
+import numpy as np
+import scipy.signal as ss
+
+from r_peaks_detector import StreamingRPeakDetector
+from signal_processor import (RR_RESAMPLING_FREQUENCY, SPECTRAL_SEGMENT_LENGTH, SPECTRAL_SEGMENT_STEP,
+                              band_powers, frequency_measures)
+
+
+class RunningStatistics:
+    '''Mean and standard deviation updated one value at a time
+    with Welford's algorithm'''
+
+    def __init__(self):
+        self.n = 0
+        self._mean = 0.0
+        self._m2 = 0.0
+
+    def update(self, x):
+        self.n += 1
+        delta = x - self._mean
+        self._mean += delta / self.n
+        self._m2 += delta * (x - self._mean)
+
+    def mean(self):
+        if self.n == 0:
+            return np.nan
+        return self._mean
+
+    def std(self):
+        # population standard deviation, the same as np.std
+        if self.n == 0:
+            return np.nan
+        return np.sqrt(self._m2 / self.n)
+
+
+class SpectralHRVAnalyzer:
+    '''LF and HF power of the RR intervals of the last window seconds,
+    updated as the R peaks come. The RR intervals are resampled once,
+    as in resample_rr_intervals, and only the resampled values not yet
+    in a complete segment of Welch's method are kept. The band powers of
+    every segment are computed once, when it is complete, with the window
+    and the frequency grid computed in advance, and the measures are
+    the mean of the band powers of the segments in the window. So memory
+    and time per update are bounded. When the window covers all the
+    R peaks, the measures are the same as of
+    make_frequency_analysis_on_peaks_indices. The measures change every
+    SPECTRAL_SEGMENT_STEP resampled values, 32 s'''
+
+    def __init__(self, window=300):
+        self.segments_number = max(1, (int(window * RR_RESAMPLING_FREQUENCY) - SPECTRAL_SEGMENT_LENGTH)
+                                   // SPECTRAL_SEGMENT_STEP + 1)
+        self.window = ss.get_window('hann', SPECTRAL_SEGMENT_LENGTH)
+        # one-sided power spectral density in ms^2/Hz, as scipy.signal.welch
+        self.scale = np.full(SPECTRAL_SEGMENT_LENGTH // 2 + 1, 2 / (RR_RESAMPLING_FREQUENCY * np.sum(self.window**2)))
+        self.scale[0] /= 2
+        if SPECTRAL_SEGMENT_LENGTH % 2 == 0:
+            self.scale[-1] /= 2
+        self.frequencies = np.fft.rfftfreq(SPECTRAL_SEGMENT_LENGTH, 1 / RR_RESAMPLING_FREQUENCY)
+
+        self.first_beat_time = None
+        self.last_beat = None  # (time, RR interval)
+        self.resampled_number = 0
+        self.rr_tachogram = np.zeros(0)  # resampled values of the next segments
+        self.segments_band_powers = deque(maxlen=self.segments_number)
+        self._measures = frequency_measures(np.nan, np.nan)
+
+    def add_rr_interval(self, beat_time, rr):
+        '''beat_time is the time of the R peak ending the RR interval in seconds'''
+        if self.first_beat_time is None:
+            self.first_beat_time = beat_time
+            resampled = np.array([rr])
+        else:
+            last_time, last_rr = self.last_beat
+            end = int(np.floor((beat_time - self.first_beat_time) * RR_RESAMPLING_FREQUENCY)) + 1
+            times = self.first_beat_time + np.arange(self.resampled_number, end) / RR_RESAMPLING_FREQUENCY
+            resampled = np.interp(times, [last_time, beat_time], [last_rr, rr])
+        self.last_beat = (beat_time, rr)
+        self.resampled_number += len(resampled)
+        self.rr_tachogram = np.concatenate([self.rr_tachogram, resampled])
+        if len(self.rr_tachogram) >= SPECTRAL_SEGMENT_LENGTH:
+            self._add_segments()
+
+    def _add_segments(self):
+        while len(self.rr_tachogram) >= SPECTRAL_SEGMENT_LENGTH:
+            segment = self.rr_tachogram[:SPECTRAL_SEGMENT_LENGTH]
+            spectrum = np.fft.rfft((segment - np.mean(segment)) * self.window)
+            psd = self.scale * (spectrum.real**2 + spectrum.imag**2)
+            self.segments_band_powers.append(band_powers(self.frequencies, psd))
+            self.rr_tachogram = self.rr_tachogram[SPECTRAL_SEGMENT_STEP:]
+        self._measures = frequency_measures(*np.mean(self.segments_band_powers, axis=0))
+
+    def measures(self):
+        return dict(self._measures)
+
+
+class IncrementalHRVAnalyzer:
+    '''Heart rate variability analysis of a signal coming in blocks.
+    The R peaks are found by StreamingRPeakDetector, so memory and
+    time per sample are bounded, and the measures are updated with
+    running statistics. After flush() the measures are the same as
+    the ones computed by SignalProcessor.make_ecg_analysis on the whole
+    signal. The frequency-domain measures come from SpectralHRVAnalyzer
+    and cover the last spectral_window seconds.
+
+    The R peaks may also come from a detector shared with other users,
+    then the analyzer is created with detect_peaks=False, without its own
+    detector, and they are passed to add_peaks instead of calling update'''
+
+    def __init__(self, sp, spectral_window=300, detect_peaks=True, **detector_parameters):
+        self.sp = sp
+        self.detector = StreamingRPeakDetector(sp, **detector_parameters) if detect_peaks else None
+        self.spectral_analyzer = SpectralHRVAnalyzer(spectral_window)
+
+        self.last_peak = None
+        self.last_rr = None
+        self.rr_statistics = RunningStatistics()
+        self.rr_diff_statistics = RunningStatistics()
+        self.rr_sqdiff_sum = 0.0
+        self.nn20 = 0
+        self.nn50 = 0
+
+    def update(self, block):
+        self.add_peaks(self.detector.update(block))
+
+    def flush(self):
+        '''Accepts also the R peaks at the end of the signal,
+        to be used when the signal is over'''
+        self.add_peaks(self.detector.flush())
+
+    def add_peaks(self, peaks_indices):
+        for peak in peaks_indices:
+            self._add_peak(peak)
+
+    def _add_peak(self, peak):
+        if self.last_peak is not None:
+            rr = (1000/self.sp.Fs)*(peak - self.last_peak)  # distance in miliseconds
+            self.rr_statistics.update(rr)
+            self.spectral_analyzer.add_rr_interval(peak / self.sp.Fs, rr)
+            if self.last_rr is not None:
+                rr_diff = rr - self.last_rr
+                self.rr_diff_statistics.update(rr_diff)
+                self.rr_sqdiff_sum += rr_diff**2
+                self.nn20 += rr_diff > 20.0
+                self.nn50 += rr_diff > 50.0
+            self.last_rr = rr
+        self.last_peak = peak
+
+    def measures(self):
+        keys = ['bpm', 'ibi', 'sdnn', 'sdsd', 'rmssd', 'pnn20', 'pnn50']
+        measures = {}
+        for key in keys:
+            measures[key] = np.nan
+
+        measures['ibi'] = self.rr_statistics.mean()
+        measures['bpm'] = 60000 / measures['ibi']
+        measures['sdnn'] = self.rr_statistics.std()
+        measures['sdsd'] = self.rr_diff_statistics.std()
+
+        rr_diff_number = self.rr_diff_statistics.n
+        if rr_diff_number > 0:
+            measures['rmssd'] = np.sqrt(self.rr_sqdiff_sum / rr_diff_number)
+            measures['pnn20'] = self.nn20 / rr_diff_number
+            measures['pnn50'] = self.nn50 / rr_diff_number
+
+        measures.update(self.spectral_analyzer.measures())
+        return measures
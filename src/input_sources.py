@@ -0,0 +1,219 @@
+import time
+from pathlib import Path
+import numpy as np
+
+from port_handler import read_blocks_from_serial_port
+from signal_processor import read_from_file
+from recording_format import BINARY_RECORDING_EXTENSION, read_binary_recording
+from sample_stream import StreamClient, parse_address
+
+DEFAULT_FS = 200
+DEFAULT_CHANNELS = 1
+MAX_BLOCK_SIZE = 1 << 14  # samples generated at once when the speed is not limited
+SYNTHETIC_SOURCE_NAME = 'synthetic'
+STREAM_SOURCE_PREFIX = 'stream:'
+
+# P, Q, R, S and T waves: time from the R peak in seconds,
+# amplitude relative to the R wave and width in seconds
+ECG_WAVES = np.array([
+    (-0.20, 0.15, 0.025),
+    (-0.025, -0.12, 0.010),
+    (0.0, 1.0, 0.010),
+    (0.025, -0.25, 0.010),
+    (0.30, 0.30, 0.050),
+])
+
+
+class InputSource:
+    '''Source of the raw samples for the AcquisitionEngine.
+    read_blocks yields arrays with the samples received since the previous
+    block, one value per sample or one column per channel, and waits
+    for them at most timeout seconds, like read_blocks_from_serial_port.
+    When the generator is over the acquisition is finished'''
+
+    channels = 1
+
+    def read_blocks(self, timeout=0.1):
+        raise NotImplementedError
+
+
+class SerialSource(InputSource):
+
+    def __init__(self, port, baudrate, channels=1):
+        self.port = port
+        self.baudrate = baudrate
+        self.channels = channels
+
+    def read_blocks(self, timeout=0.1):
+        return read_blocks_from_serial_port(self.port, self.baudrate, timeout, self.channels)
+
+    def __str__(self):
+        return f'serial port {self.port} at {self.baudrate} baud'
+
+
+class NetworkSource(InputSource):
+    '''Raw samples published by the StreamServer of another process.
+    Fs and channels are read from the server when the source is created,
+    the given ones must be the same. The first read_blocks uses
+    that connection, the next ones connect again'''
+
+    def __init__(self, address, Fs=None, channels=None):
+        self.address = address
+        self.client = StreamClient(address)
+        self.Fs = self.client.Fs
+        self.channels = self.client.channels
+        try:
+            self._check_settings(self.client, Fs, channels)
+        except ValueError:
+            self.client.close()
+            raise
+
+    def _check_settings(self, client, Fs, channels):
+        if Fs is not None and Fs != client.Fs:
+            raise ValueError(f'The stream server at {self.address} sends {client.Fs} Hz, not {Fs} Hz')
+        if channels is not None and channels != client.channels:
+            raise ValueError(f'The stream server at {self.address} sends {client.channels} channels, not {channels}')
+
+    def read_blocks(self, timeout=0.1):
+        client, self.client = self.client, None
+        if client is None:
+            client = StreamClient(self.address, timeout)
+        else:
+            client.socket.settimeout(timeout)
+        with client:
+            # the server may have been started again with other settings
+            self._check_settings(client, self.Fs, self.channels)
+            yield from client.read_blocks()
+
+    def __str__(self):
+        return f'stream server at {self.address}, {self.Fs} Hz, {self.channels} channels'
+
+
+class PacedSource(InputSource):
+    '''Source producing the samples itself at speed times the real time,
+    with the speed set to np.inf the samples are produced as fast
+    as they are taken'''
+
+    def __init__(self, Fs, speed=1.0):
+        self.Fs = Fs
+        self.speed = speed
+
+    def generate(self, samples_number):
+        '''Returns the next samples_number samples, fewer at the end of the source'''
+        raise NotImplementedError
+
+    def read_blocks(self, timeout=0.1):
+        if np.isinf(self.speed):
+            while True:
+                block = self.generate(MAX_BLOCK_SIZE)
+                if len(block) == 0:
+                    return
+                yield block
+        start_time = time.monotonic()
+        produced_samples_number = 0
+        while True:
+            time.sleep(timeout)
+            due_samples_number = int((time.monotonic() - start_time) * self.Fs * self.speed)
+            block = self.generate(due_samples_number - produced_samples_number)
+            if len(block) == 0 and due_samples_number > produced_samples_number:
+                return
+            produced_samples_number += len(block)
+            yield block
+
+
+class FileReplaySource(PacedSource):
+    '''Replays a text or binary recording, the sampling frequency
+    of the binary recordings is taken from the header'''
+
+    def __init__(self, filename, Fs=200, speed=1.0, channels=1, loop=False):
+        if Path(filename).suffix == BINARY_RECORDING_EXTENSION:
+            header, samples = read_binary_recording(filename)
+            Fs, channels = header.Fs, header.channels
+        else:
+            samples = read_from_file(filename, channels=channels)
+        super().__init__(Fs, speed)
+        self.filename = filename
+        self.samples = samples
+        self.channels = channels
+        self.loop = loop
+        self.position = 0
+
+    def generate(self, samples_number):
+        if self.loop and self.position == len(self.samples):
+            self.position = 0
+        block = np.asarray(self.samples[self.position:self.position + samples_number], dtype=float)
+        self.position += len(block)
+        return block
+
+    def __str__(self):
+        return f'replay of {self.filename} at {self.speed}x speed'
+
+
+class SyntheticECGSource(PacedSource):
+    '''ECG made of Gaussian P, Q, R, S and T waves in ADC units.
+    The heart rate is modulated with breathing, hr_variability is the
+    relative depth of the modulation. The noise is white Gaussian and the
+    mains interference is a sine of mains_frequency, both in ADC units.
+    The channels differ only in the amplitude, as leads placed differently'''
+
+    def __init__(self, Fs=200, hr=60.0, hr_variability=0.05, amplitude=500.0, noise=5.0,
+                 mains_amplitude=20.0, mains_frequency=50.0, baseline=2048.0, channels=1,
+                 speed=1.0, adc_resolution=12, breathing_frequency=0.25, seed=None):
+        super().__init__(Fs, speed)
+        self.hr = hr
+        self.hr_variability = hr_variability
+        self.amplitude = amplitude
+        self.noise = noise
+        self.mains_amplitude = mains_amplitude
+        self.mains_frequency = mains_frequency
+        self.baseline = baseline
+        self.channels = channels
+        self.max_value = 2**adc_resolution - 1
+        self.breathing_frequency = breathing_frequency
+        self.rng = np.random.default_rng(seed)
+        self.channels_gains = np.linspace(1.0, 0.5, channels)
+        self.samples_number = 0
+        self.beats = 0.0  # number of beats since the beginning, R peaks at the whole numbers
+
+    def heart_rates(self, t):
+        return self.hr * (1 + self.hr_variability * np.sin(2 * np.pi * self.breathing_frequency * t))
+
+    def generate(self, samples_number):
+        t = (self.samples_number + np.arange(samples_number)) / self.Fs
+        # the phase of the heart cycle is the integral of the heart rate
+        beats = self.beats + np.cumsum(self.heart_rates(t)) / (60 * self.Fs)
+        if samples_number > 0:
+            self.beats = beats[-1]
+        self.samples_number += samples_number
+
+        rr = 60 / self.heart_rates(t)
+        beats_phase = beats - np.rint(beats)
+        time_from_R = beats_phase * rr
+        ecg = np.zeros(samples_number)
+        for center, relative_amplitude, width in ECG_WAVES:
+            ecg += relative_amplitude * np.exp(-0.5 * ((time_from_R - center) / width)**2)
+
+        mains = self.mains_amplitude * np.sin(2 * np.pi * self.mains_frequency * t)
+        signal = self.baseline + mains[:, np.newaxis] + self.amplitude * np.outer(ecg, self.channels_gains)
+        signal += self.rng.normal(0, self.noise, signal.shape)
+        signal = np.clip(np.rint(signal), 0, self.max_value)
+        return signal[:, 0] if self.channels == 1 else signal
+
+    def __str__(self):
+        return f'synthetic ECG at {self.Fs} Hz, HR {self.hr}'
+
+
+def create_input_source(name, baudrate=38400, Fs=None, channels=None, speed=1.0, hr=60.0):
+    '''Source from its name: 'synthetic', 'stream:host:port' or 'stream:path'
+    of the Unix socket, a recording file or a serial port. Fs and channels
+    of the stream server are taken from it, None means the default ones
+    for the other sources'''
+    if name.startswith(STREAM_SOURCE_PREFIX):
+        return NetworkSource(parse_address(name[len(STREAM_SOURCE_PREFIX):]), Fs, channels)
+    Fs = DEFAULT_FS if Fs is None else Fs
+    channels = DEFAULT_CHANNELS if channels is None else channels
+    if name == SYNTHETIC_SOURCE_NAME:
+        return SyntheticECGSource(Fs, hr, channels=channels, speed=speed)
+    if Path(name).is_file():
+        return FileReplaySource(name, Fs, speed, channels)
+    return SerialSource(name, baudrate, channels)
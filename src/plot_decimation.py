@@ -0,0 +1,20 @@
+import numpy as np
+
+
+def decimate_min_max(x, y, max_points):
+    '''Reduces the number of points to at most max_points keeping
+    the minimum and maximum of every bin of the neighbouring points,
+    so the peaks stay visible in the plot. The oldest points that
+    do not fill the whole bin are dropped'''
+    n = len(y)
+    if n <= max_points:
+        return x, y
+    bins_number = max(1, max_points // 2)
+    bin_size = -(-n // bins_number)  # ceil
+    bins_number = n // bin_size
+    start = n - bins_number * bin_size
+    bins = y[start:].reshape(bins_number, bin_size)
+    # min and max of every bin in the order of their appearance
+    extremes = np.sort(np.stack([np.argmin(bins, axis=1), np.argmax(bins, axis=1)], axis=1), axis=1)
+    indices = (extremes + start + bin_size * np.arange(bins_number)[:, None]).ravel()
+    return x[indices], y[indices]
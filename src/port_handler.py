@@ -1,7 +1,10 @@
 from datetime import datetime
+import numpy as np
 import serial
 from serial.tools.list_ports import comports
 
+from instrumentation import metrics
+
 
 def convert_units_to_volts(value, adc_resolution=12, max_voltage=3.3):
     quantization_level = 2**adc_resolution
@@ -13,29 +16,118 @@ def find_available_ports():
     return [port.name for port in comports()]
 
 
-def read_from_serial_port(port, baudrate):
+class SerialStreamParser:
+    '''Parses a stream of ASCII integers separated by any non-digit
+    characters into arrays of floats. Digits at the end of the data
+    are kept until the next feed, as the number may continue there.
+
+    With many channels every line holds one value of each channel,
+    e.g. "1648,1702,1533", and the values are returned as rows
+    of an array with one column per channel. A line is kept until
+    its newline is received, the lines without exactly one value
+    per channel are dropped and counted in malformed_lines_number'''
+
+    def __init__(self, channels=1):
+        self.channels = channels
+        self.remainder = b''
+        self.malformed_lines_number = 0
+        # the first line may be received from its middle,
+        # so it is skipped to start with the first channel
+        self.synchronized = channels == 1
+
+    def feed(self, data):
+        if self.channels == 1:
+            return self.parse_numbers(data)
+        if not self.synchronized:
+            line_end = data.find(b'\n')
+            if line_end < 0:
+                return np.zeros((0, self.channels))
+            data = data[line_end + 1:]
+            self.synchronized = True
+        return self.parse_rows(data)
+
+    def parse_numbers(self, data):
+        data = self.remainder + data
+        codes = np.frombuffer(data, dtype=np.uint8)
+        is_digit = (codes >= ord('0')) & (codes <= ord('9'))
+        non_digits = np.flatnonzero(~is_digit)
+        if len(non_digits) == 0:
+            self.remainder = data
+            return np.zeros(0)
+        end = non_digits[-1] + 1
+        self.remainder = data[end:]
+        return parse_numbers_with_positions(codes[:end], is_digit[:end])[0]
+
+    def parse_rows(self, data):
+        data = self.remainder + data
+        end = data.rfind(b'\n') + 1
+        self.remainder = data[end:]
+        if end == 0:
+            return np.zeros((0, self.channels))
+        codes = np.frombuffer(data, dtype=np.uint8, count=end)
+        is_digit = (codes >= ord('0')) & (codes <= ord('9'))
+        values, starts = parse_numbers_with_positions(codes, is_digit)
+
+        # a short or corrupted line must not shift the values of the next ones
+        line_ends = np.flatnonzero(codes == ord('\n'))
+        lines = np.searchsorted(line_ends, starts)
+        values_numbers = np.bincount(lines, minlength=len(line_ends))
+        is_valid_line = values_numbers == self.channels
+        malformed_lines_number = len(line_ends) - np.count_nonzero(is_valid_line)
+        if malformed_lines_number:
+            self.malformed_lines_number += malformed_lines_number
+            metrics.count('serial.malformed_lines', malformed_lines_number)
+        return values[is_valid_line[lines]].reshape(-1, self.channels)
+
+
+def parse_numbers_with_positions(codes, is_digit):
+    '''Values of the runs of digits and their start positions,
+    the codes must end with a non-digit'''
+    # numbers are runs of digits, each one ends before a non-digit
+    edges = np.diff(is_digit.astype(np.int8), prepend=0)
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    if len(starts) == 0:
+        return np.zeros(0), starts
+    lengths = ends - starts
+    digits_positions = np.flatnonzero(is_digit)
+    digits = (codes[digits_positions] - ord('0')).astype(float)
+    powers = np.repeat(ends, lengths) - digits_positions - 1
+    first_digits = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    return np.add.reduceat(digits * 10.0**powers, first_digits), starts
+
+
+def open_serial_port(port, baudrate, timeout=0.1):
     # device-dependent configuration of serial connection
-    ser = serial.Serial(
+    return serial.Serial(
         port=port,
         baudrate=baudrate,
         parity=serial.PARITY_ODD,
         stopbits=serial.STOPBITS_TWO,
-        bytesize=serial.SEVENBITS
+        bytesize=serial.SEVENBITS,
+        timeout=timeout
     )
-    ser.isOpen()
-
-    value = ''
-    while True:
-        while ser.inWaiting() > 0:
-            x = ser.read(1).decode("utf-8")
-            if x.isdigit():
-                value += x
-            else:
-                if value != '':
-                    yield float(value)
-                    value = ''
-                else:
-                    continue
+
+
+def read_blocks_from_serial_port(port, baudrate, timeout=0.1, channels=1):
+    '''Yields arrays with all the values received since the previous block,
+    with one column per channel when there are many channels.
+    Waits for the data at most timeout seconds, so the block is empty
+    when nothing was received in that time'''
+    parser = SerialStreamParser(channels)
+    with open_serial_port(port, baudrate, timeout) as ser:
+        while True:
+            data = ser.read(max(1, ser.in_waiting))
+            metrics.count('serial.bytes', len(data))
+            with metrics.timer('serial.parsing'):
+                block = parser.feed(data)
+            yield block
+
+
+def read_from_serial_port(port, baudrate):
+    for block in read_blocks_from_serial_port(port, baudrate):
+        for x in block:
+            yield float(x)
 
 
 def write_all_data_to_file(filename, port, baudrate):
@@ -54,6 +146,15 @@ def write_data_point_to_file(x, file):
     if out != '':
         file.write(out)
 
+
+def write_data_block_to_file(data_block, file):
+    '''Returns the number of the written characters'''
+    if data_block.ndim == 1:
+        return file.write(''.join(str(x)+'\n' for x in data_block.tolist()))
+    else:
+        # one line with the values of all channels per sample
+        return file.write(''.join(','.join(map(str, row))+'\n' for row in data_block.tolist()))
+
 def main():
     from enum import auto, Enum
 
@@ -0,0 +1,311 @@
+from collections import deque
+import numpy as np
+import scipy.signal as ss
+
+from signal_processor import NUMBER_OF_SEC_IN_ONE_MIN
+
+NO_PEAKS = np.zeros(0, dtype=int)
+NO_ENERGY = np.zeros(0)
+
+
+class StreamingRPeakDetector:
+    '''Online R peaks detector fed with blocks of the filtered signal.
+
+    Every sample goes through the detection once. The moving average
+    carries its last width - 1 samples to the next block, so the slope
+    energy is computed only for the new samples, and its local maxima
+    wait as the candidates for the refractory rule of find_peaks, no two
+    R peaks closer than R_peaks_min_distance. Each candidate is compared
+    once with the candidates before it in a window of that distance, so
+    it is known which ones are higher than all the others within the
+    distance on both sides. Such a candidate is an R peak whatever comes
+    later, and the candidates before it no longer depend on the future
+    ones, so they are decided at once. The R peaks are refined in the
+    samples kept only around them, the adaptive threshold is learned once
+    on the beginning of the signal and its state is kept between the
+    blocks. The peaks are the same as found by SignalProcessor.find_R_peaks
+    on the whole signal, except that of the equal slope energies within
+    the distance find_peaks may keep another one.
+
+    The new samples are processed once there are hop of them, so an R peak
+    higher than its neighbours is reported about R_peaks_min_distance + hop
+    samples after it occurs, the adaptive threshold reports the first peaks
+    only after its learning time.
+
+    The heart rate is kept from the last hr_rr_intervals_number
+    RR intervals with a running sum'''
+
+    def __init__(self, sp, hop=None, hr_rr_intervals_number=10):
+        self.sp = sp
+        self.hop = sp.Fs // 2 if hop is None else hop
+        self.width = sp.moving_average_width
+        self.distance = sp.R_peaks_min_distance
+        self.refinement_margin = sp.refinement_window_size // 2
+        self.new_blocks = []
+        self.new_samples_number = 0
+        self.received_samples_number = 0
+        # samples kept for the refinement and index of the first one
+        # counted from the beginning of the signal
+        self.samples = np.zeros(0)
+        self.offset = 0
+        # the last samples of the moving average window
+        self.moving_average_window = np.ones(self.width)
+        self.moving_average_tail = np.zeros(0)
+        # slope energy from its last sample that may start a local maximum
+        self.slope_energy = np.zeros(0)
+        self.slope_energy_offset = 0
+        # local maxima of the slope energy not decided yet
+        # as [position, slope energy, dominated by a higher one within the distance],
+        # and the ones that may still be dominated by the next candidates
+        self.candidates = []
+        self.candidates_window = deque()
+        self.adaptive_threshold = sp.create_adaptive_threshold() if sp.adaptive_threshold else None
+        # slope energy of the beginning, until the adaptive threshold is learned,
+        # and the candidates waiting for it
+        self.learning_slope_energy = []
+        self.unclassified = NO_PEAKS
+        self.unclassified_energies = np.zeros(0)
+
+        self.last_peak = None
+        self.rr_intervals = deque(maxlen=hr_rr_intervals_number)  # in samples
+        self.rr_intervals_sum = 0
+
+    def samples_number(self):
+        return self.received_samples_number + self.new_samples_number
+
+    def latency(self):
+        '''Delay of reporting the R peak higher than its neighbours in samples'''
+        return self.distance + self.hop
+
+    def update(self, block):
+        '''Returns the indices of the new R peaks,
+        counted from the beginning of the signal'''
+        self.new_blocks.append(block)
+        self.new_samples_number += len(block)
+        if self.new_samples_number >= self.hop:
+            return self._detect()
+        return NO_PEAKS
+
+    def flush(self):
+        '''Accepts also the R peaks at the end of the signal,
+        to be used when the signal is over'''
+        if self.samples_number() < self.width:
+            # too short for the moving average to have any valid sample
+            s = np.concatenate([self.samples] + self.new_blocks)
+            self.new_blocks = []
+            peaks = self.sp.find_R_peaks(s).astype(int)
+            for peak in peaks.tolist():
+                self._add_peak(peak)
+            return peaks
+        return self._detect(flush=True)
+
+    def _detect(self, flush=False):
+        block = np.concatenate([np.zeros(0)] + self.new_blocks)
+        self.new_blocks = []
+        self.new_samples_number = 0
+        self.received_samples_number += len(block)
+        self.samples = np.concatenate([self.samples, block])
+
+        self._find_candidates(self._update_slope_energy(block, flush))
+        peaks, energies = self._decide_candidates(flush)
+        if self.adaptive_threshold is not None:
+            peaks = self._classify(peaks, energies, flush)
+        if len(peaks) > 0:
+            peaks = self._refine(peaks)
+        self._trim_samples()
+        return peaks
+
+    def _refine(self, peaks):
+        '''The same as SignalProcessor.refine_R_peaks, for the few peaks
+        a direct maximum of each window is faster than the windows view'''
+        refined = []
+        for peak in peaks.tolist():
+            start = max(0, peak - self.refinement_margin)
+            window = self.samples[start - self.offset:peak + self.refinement_margin + 1 - self.offset]
+            refined.append(start + int(window.argmax()))
+            self._add_peak(refined[-1])
+        return np.array(refined, dtype=int)
+
+    def _update_slope_energy(self, block, flush):
+        # the same values as SignalProcessor.slope_energy: every window sum is computed
+        # once from the same samples, the moving average has width // 2 - 1 zeros
+        # at both ends of the signal
+        x = np.concatenate([self.moving_average_tail, block])
+        if len(x) < self.width:
+            self.moving_average_tail = x
+            return NO_ENERGY
+        moving_average = np.convolve(x, self.moving_average_window, 'valid')
+        moving_average /= self.width
+        zeros_length = self.width // 2 - 1
+        if len(self.moving_average_tail) < self.width:
+            moving_average = np.concatenate([np.zeros(zeros_length), moving_average])
+        # otherwise the tail of width samples gives the last value of the previous block first
+        if flush:
+            moving_average = np.concatenate([moving_average, np.zeros(zeros_length)])
+        self.moving_average_tail = x[len(x) - self.width:]
+        slope_energy = moving_average[1:] - moving_average[:-1]
+        slope_energy *= slope_energy
+        if self.adaptive_threshold is not None and not self.adaptive_threshold.learned():
+            self.learning_slope_energy.append(slope_energy)
+        return slope_energy
+
+    def _find_candidates(self, slope_energy):
+        s = np.concatenate([self.slope_energy, slope_energy])
+        if len(s) < 3:
+            self.slope_energy = s
+            return
+        fixed_threshold = self.adaptive_threshold is None
+        if not fixed_threshold or s.max() >= self.sp.slope_energy_threshold:
+            if (s[1:] == s[:-1]).any():
+                # the plateaus are handled by find_peaks
+                maxima, _ = ss.find_peaks(s)
+            else:
+                middle = s[1:-1]
+                maxima = np.flatnonzero((middle > s[:-2]) & (middle > s[2:])) + 1
+            energies = s[maxima]
+            if fixed_threshold:
+                above_threshold = energies >= self.sp.slope_energy_threshold
+                maxima, energies = maxima[above_threshold], energies[above_threshold]
+            self._add_candidates((maxima + self.slope_energy_offset).tolist(), energies.tolist())
+        # the last samples may still become a local maximum or a plateau,
+        # its rising edge is kept too
+        start = len(s) - 2
+        while start > 0 and s[start] == s[start + 1]:
+            start -= 1
+        self.slope_energy = s[start:]
+        self.slope_energy_offset += start
+
+    def _add_candidates(self, maxima, energies):
+        # the window keeps the candidates within the distance from the last one
+        # with decreasing slope energies, a new candidate dominates the lower ones
+        # and is dominated by the higher one left
+        window = self.candidates_window
+        for position, energy in zip(maxima, energies):
+            candidate = [position, energy, False]
+            while window and position - window[0][0] >= self.distance:
+                window.popleft()
+            while window and window[-1][1] <= energy:
+                if window[-1][1] == energy:
+                    candidate[2] = True
+                window.pop()[2] = True
+            if window:
+                candidate[2] = True
+            window.append(candidate)
+            self.candidates.append(candidate)
+
+    def _decide_candidates(self, flush):
+        '''Returns the candidates left by the refractory rule,
+        the same as find_peaks with distance, once they cannot change'''
+        candidates = self.candidates
+        if len(candidates) == 0:
+            return NO_PEAKS, NO_ENERGY
+        if flush:
+            last = len(candidates) - 1
+            self.candidates = []
+        else:
+            last = self._find_last_dominant()
+            if last is None:
+                return NO_PEAKS, NO_ENERGY
+            # the candidates after the dominant one, closer than the distance, are left out
+            end = last + 1
+            while end < len(candidates) and candidates[end][0] - candidates[last][0] < self.distance:
+                end += 1
+            self.candidates = candidates[end:]
+        decided = candidates[:last + 1]
+
+        # the dominant candidates are kept and the ones closer to them than
+        # the distance are left out, the others need find_peaks
+        peaks, energies, uncovered = [], [], []
+        last_dominant = None
+        for position, energy, dominated in decided:
+            if not dominated:
+                while uncovered and position - uncovered[-1] < self.distance:
+                    uncovered.pop()
+                peaks.append(position)
+                energies.append(energy)
+                last_dominant = position
+            elif last_dominant is None or position - last_dominant >= self.distance:
+                uncovered.append(position)
+        if len(uncovered) == 0:
+            return np.array(peaks, dtype=int), np.array(energies)
+        # find_peaks on the heights of the candidates alone gives the same
+        # selection, as the other local maxima do not take part in it
+        positions = np.array([candidate[0] for candidate in decided])
+        heights = np.zeros(positions[-1] - positions[0] + 3)
+        heights[positions - positions[0] + 1] = [candidate[1] for candidate in decided]
+        kept, _ = ss.find_peaks(heights, distance=self.distance)
+        return kept + positions[0] - 1, heights[kept]
+
+    def _find_last_dominant(self):
+        '''Index of the last candidate higher than all the others within
+        the distance, with all of them already known, None if there is none'''
+        # the local maxima are known before the last kept slope energy sample
+        known_until = self.slope_energy_offset + 1 - self.distance
+        # and the refinement window of the peak is already received
+        known_until = min(known_until, self.received_samples_number - self.refinement_margin - 1)
+        last = len(self.candidates) - 1
+        while last >= 0 and (self.candidates[last][0] > known_until or self.candidates[last][2]):
+            last -= 1
+        return last if last >= 0 else None
+
+    def _classify(self, peaks, energies, flush):
+        '''Peaks selected by the adaptive threshold, including the missed ones
+        found by the searchback, after it is learned on the beginning'''
+        if len(peaks) > 0:
+            self.unclassified = np.concatenate([self.unclassified, peaks])
+            self.unclassified_energies = np.concatenate([self.unclassified_energies, energies])
+        if not self.adaptive_threshold.learned():
+            learning_slope_energy = np.concatenate([np.zeros(0)] + self.learning_slope_energy)
+            self.learning_slope_energy = [learning_slope_energy]
+            if len(learning_slope_energy) < self.adaptive_threshold.learning_length and not flush:
+                return NO_PEAKS
+            if len(self.unclassified) == 0:
+                # nothing to select, the same as in select_R_peaks_adaptively
+                return NO_PEAKS if flush else self._learn(learning_slope_energy)
+            self._learn(learning_slope_energy)
+        if len(self.unclassified) == 0:
+            return NO_PEAKS
+        peaks = self.adaptive_threshold.classify(self.unclassified, self.unclassified_energies)
+        self.unclassified = NO_PEAKS
+        self.unclassified_energies = np.zeros(0)
+        return peaks
+
+    def _learn(self, learning_slope_energy):
+        self.adaptive_threshold.learn(learning_slope_energy)
+        self.learning_slope_energy = []
+        return NO_PEAKS
+
+    def _trim_samples(self):
+        # the samples are kept for the refinement of the peaks not reported yet:
+        # the candidates, the local maxima still to be found and the noise peaks
+        # of the adaptive threshold that may be taken as missed beats
+        keep_from = self.slope_energy_offset + 1
+        if len(self.candidates) > 0:
+            keep_from = min(keep_from, self.candidates[0][0])
+        if len(self.unclassified) > 0:
+            keep_from = min(keep_from, self.unclassified[0])
+        if self.adaptive_threshold is not None and self.adaptive_threshold.oldest_peak() is not None:
+            keep_from = min(keep_from, self.adaptive_threshold.oldest_peak())
+        keep_from = max(self.offset, keep_from - self.refinement_margin)
+        self.samples = self.samples[keep_from - self.offset:]
+        self.offset = keep_from
+
+    def _add_peak(self, peak):
+        if self.last_peak is not None:
+            if len(self.rr_intervals) == self.rr_intervals.maxlen:
+                self.rr_intervals_sum -= self.rr_intervals[0]
+            rr = peak - self.last_peak
+            self.rr_intervals.append(rr)
+            self.rr_intervals_sum += rr
+        self.last_peak = peak
+
+    def hr(self):
+        '''Heart rate from the last RR intervals, NaN when it is unknown
+        or out of the physiological range, the same as SignalProcessor.find_hr'''
+        if len(self.rr_intervals) == 0:
+            return np.nan
+        average_distance = self.rr_intervals_sum / len(self.rr_intervals)
+        hr = self.sp.Fs * NUMBER_OF_SEC_IN_ONE_MIN / average_distance
+        if hr < 30 or hr > 200:
+            return np.nan
+        return int(hr)
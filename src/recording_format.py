@@ -0,0 +1,195 @@
+import os
+import re
+import struct
+import sys
+import time
+from collections import namedtuple
+from datetime import datetime
+from pathlib import Path
+import numpy as np
+
+from port_handler import write_data_block_to_file
+from signal_processor import read_from_file
+
+BINARY_RECORDING_EXTENSION = '.ecg'
+MAGIC = b'ECGR'
+VERSION = 2
+# magic, version, Fs, adc resolution, max voltage, start timestamp, channels number
+HEADER_FORMAT = '<4sHIHddH'
+HEADER_SIZE = 64  # header is padded with zeros, so the samples are aligned
+SAMPLE_DTYPE = np.dtype('<u2')
+# the version 1 recordings have signed samples
+SAMPLE_DTYPES = {1: np.dtype('<i2'), VERSION: SAMPLE_DTYPE}
+MAX_ADC_RESOLUTION = 16
+WRITE_BUFFER_SIZE = 1 << 16
+
+RecordingHeader = namedtuple('RecordingHeader',
+                             ['Fs', 'adc_resolution', 'max_voltage', 'start_timestamp', 'channels'])
+
+
+def to_samples(data_block, max_value):
+    '''ADC values as SAMPLE_DTYPE, clipped to the range from 0 to max_value'''
+    samples = np.rint(data_block)
+    # a few times faster than np.clip for the small blocks
+    np.maximum(samples, 0, out=samples)
+    np.minimum(samples, max_value, out=samples)
+    return samples.astype(SAMPLE_DTYPE)
+
+
+class BinaryRecordingWriter:
+    '''Writes unsigned 16-bit ADC samples after the header with the recording
+    parameters, the samples out of the ADC range are clipped to it.
+    The small blocks are gathered in a preallocated buffer and converted
+    and written together, as a few samples at a time cost more in the
+    conversion calls than in the writing. size is the number of bytes
+    written so far, including the ones still in the buffer'''
+
+    def __init__(self, filename, Fs, adc_resolution=12, max_voltage=3.3, start_timestamp=None, channels=1):
+        if adc_resolution > MAX_ADC_RESOLUTION:
+            raise ValueError(f'ADC resolution {adc_resolution} is above {MAX_ADC_RESOLUTION} bits')
+        self.max_value = 2**adc_resolution - 1
+        if start_timestamp is None:
+            start_timestamp = time.time()
+        self.header = RecordingHeader(Fs, adc_resolution, max_voltage, start_timestamp, channels)
+        self.file = open(filename, 'wb', buffering=WRITE_BUFFER_SIZE)
+        header = struct.pack(HEADER_FORMAT, MAGIC, VERSION, *self.header)
+        self.file.write(header.ljust(HEADER_SIZE, b'\0'))
+        self.size = HEADER_SIZE
+        self.buffer = np.empty(WRITE_BUFFER_SIZE // SAMPLE_DTYPE.itemsize)
+        self.samples = np.empty(len(self.buffer), dtype=SAMPLE_DTYPE)
+        self.buffered_values_number = 0
+
+    def write_block(self, data_block):
+        values = np.ravel(data_block)
+        start = self.buffered_values_number
+        end = start + len(values)
+        if end > len(self.buffer):
+            self.flush_buffer()
+            if len(values) > len(self.buffer):
+                self.size += self.file.write(to_samples(values, self.max_value).tobytes())
+                return
+            start, end = 0, len(values)
+        self.buffer[start:end] = values
+        self.buffered_values_number = end
+        self.size += len(values) * SAMPLE_DTYPE.itemsize
+
+    def flush_buffer(self):
+        '''Converts and writes the buffered samples'''
+        if self.buffered_values_number == 0:
+            return
+        values = self.buffer[:self.buffered_values_number]
+        samples = self.samples[:self.buffered_values_number]
+        np.rint(values, out=values)
+        np.maximum(values, 0, out=values)
+        np.minimum(values, self.max_value, out=values)
+        samples[:] = values
+        self.file.write(samples)
+        self.buffered_values_number = 0
+
+    def sync(self):
+        self.flush_buffer()
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        if not self.file.closed:
+            self.flush_buffer()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class TextRecordingWriter:
+    '''Writes raw samples as text, one sample per line,
+    the values of many channels are separated with commas,
+    size is the number of bytes written so far'''
+
+    def __init__(self, filename):
+        # without the newlines translation the number of the written
+        # characters is the size of the file
+        self.file = open(filename, 'w', buffering=WRITE_BUFFER_SIZE, newline='\n')
+        self.size = 0
+
+    def write_block(self, data_block):
+        self.size += write_data_block_to_file(np.asarray(data_block), self.file)
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_recording_writer(filename, Fs, adc_resolution=12, max_voltage=3.3, channels=1):
+    '''Chooses the recording format by the file extension'''
+    if Path(filename).suffix == BINARY_RECORDING_EXTENSION:
+        return BinaryRecordingWriter(filename, Fs, adc_resolution, max_voltage, channels=channels)
+    return TextRecordingWriter(filename)
+
+
+def read_binary_recording_version_and_header(filename):
+    with open(filename, 'rb') as f:
+        header = f.read(HEADER_SIZE)
+    magic, version, *values = struct.unpack_from(HEADER_FORMAT, header)
+    if magic != MAGIC:
+        raise ValueError(f'{filename} is not an ECG recording')
+    if version not in SAMPLE_DTYPES:
+        raise ValueError(f'Unsupported version {version} of ECG recording {filename}')
+    return version, RecordingHeader(*values)
+
+
+def read_binary_recording_header(filename):
+    return read_binary_recording_version_and_header(filename)[1]
+
+
+def read_binary_recording(filename):
+    '''Returns the header and the samples memory-mapped from the file
+    without reading them into memory'''
+    version, header = read_binary_recording_version_and_header(filename)
+    sample_dtype = SAMPLE_DTYPES[version]
+    if os.path.getsize(filename) == HEADER_SIZE:
+        return header, np.zeros(0, dtype=sample_dtype)
+    samples = np.memmap(filename, dtype=sample_dtype, mode='r', offset=HEADER_SIZE)
+    if header.channels > 1:
+        samples = samples.reshape(-1, header.channels)
+    return header, samples
+
+
+def guess_start_timestamp(filename):
+    # recordings are named after their start time by default
+    match = re.search(r'\d{4}-\d{2}-\d{2}_\d{6}', Path(filename).stem)
+    if match is not None:
+        return datetime.strptime(match.group(), '%Y-%m-%d_%H%M%S').timestamp()
+    return os.path.getmtime(filename)
+
+
+def convert_text_to_binary(filename, binary_filename=None, Fs=200, adc_resolution=12, max_voltage=3.3, channels=1):
+    if binary_filename is None:
+        binary_filename = Path(filename).with_suffix(BINARY_RECORDING_EXTENSION)
+    s = read_from_file(filename, channels=channels)
+    with BinaryRecordingWriter(binary_filename, Fs, adc_resolution, max_voltage,
+                               guess_start_timestamp(filename), channels) as writer:
+        writer.write_block(s)
+    return binary_filename
+
+
+def main():
+    '''Converts the text recordings given as arguments to the binary format'''
+    for filename in sys.argv[1:]:
+        binary_filename = convert_text_to_binary(filename)
+        print(f'{filename} converted to {binary_filename}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,328 @@
+import argparse
+import os
+import struct
+import time
+from collections import namedtuple
+from datetime import datetime
+from pathlib import Path
+import numpy as np
+
+from signal_processor import SignalProcessor, iter_lines_chunks_from_file, parse_text_samples, read_from_file
+from r_peaks_detector import StreamingRPeakDetector
+from recording_format import (BINARY_RECORDING_EXTENSION, HEADER_SIZE, SAMPLE_DTYPE, WRITE_BUFFER_SIZE,
+                              BinaryRecordingWriter, guess_start_timestamp, open_recording_writer,
+                              read_binary_recording, read_binary_recording_header)
+
+INDEX_EXTENSION = '.idx'  # added to the name of the recording, e.g. recording.txt.idx
+INDEX_MAGIC = b'ECGI'
+INDEX_VERSION = 1
+# magic, version, Fs, channels number, start timestamp, samples number of the indexed blocks
+INDEX_HEADER_FORMAT = '<4sHIHdI'
+INDEX_HEADER_SIZE = 32
+INDEX_BLOCK_DURATION = 1.0  # in seconds
+BUILD_BLOCK_SIZE = 1 << 16  # samples read at once when the index is built from the recording
+# all the records have the same size, sample is the index of the sample
+# in the recording, offset and value depend on the kind
+INDEX_RECORD_DTYPE = np.dtype([('kind', '<i8'), ('sample', '<i8'), ('offset', '<i8'), ('value', '<f8')])
+BLOCK_RECORD = 0  # offset: position of the sample in the recording file in bytes
+PEAK_RECORD = 1  # R peak at the sample
+MINUTE_RECORD = 2  # minute starting at the sample, offset: number of the R peaks, value: mean HR
+END_RECORD = 3  # sample: samples number, offset: size of the recording file, written when it is closed
+# summary of every minute, start in seconds from the beginning of the recording
+MINUTE_SUMMARY_DTYPE = np.dtype([('start', float), ('peaks', int), ('hr', float)])
+
+IndexHeader = namedtuple('IndexHeader', ['Fs', 'channels', 'start_timestamp', 'block_size'])
+
+
+def index_filename(filename):
+    return Path(str(filename) + INDEX_EXTENSION)
+
+
+class RecordingIndexWriter:
+    '''Appends the records to the sidecar index of the recording. Every
+    block_size-th sample has its offset in the recording file, the R peaks
+    are kept as the indices of the samples and every minute gets the number
+    of the R peaks in it and the mean HR of the RR intervals ending in it.
+    The records are only appended, so the index written before a crash
+    can still be read'''
+
+    def __init__(self, filename, Fs, channels=1, start_timestamp=None, block_size=None):
+        if start_timestamp is None:
+            start_timestamp = time.time()
+        if block_size is None:
+            block_size = max(1, int(round(INDEX_BLOCK_DURATION * Fs)))
+        self.header = IndexHeader(Fs, channels, start_timestamp, block_size)
+        self.file = open(filename, 'wb', buffering=WRITE_BUFFER_SIZE)
+        header = struct.pack(INDEX_HEADER_FORMAT, INDEX_MAGIC, INDEX_VERSION, *self.header)
+        self.file.write(header.ljust(INDEX_HEADER_SIZE, b'\0'))
+        self.minute_length = 60 * Fs
+        self.last_peak = None
+        self.minute = None
+        self.minute_peaks_number = 0
+        self.minute_rr_intervals = []
+
+    def _write_records(self, kind, samples, offsets=0, values=0.0):
+        records = np.zeros(len(samples), dtype=INDEX_RECORD_DTYPE)
+        records['kind'] = kind
+        records['sample'] = samples
+        records['offset'] = offsets
+        records['value'] = values
+        self.file.write(records.tobytes())
+
+    def add_blocks(self, samples, offsets):
+        self._write_records(BLOCK_RECORD, samples, offsets)
+
+    def add_peaks(self, peaks_indices):
+        self._write_records(PEAK_RECORD, peaks_indices)
+        for peak in peaks_indices:
+            minute = peak // self.minute_length
+            if minute != self.minute:
+                if self.minute is not None:
+                    self._write_minute()
+                self.minute = minute
+                self.minute_peaks_number = 0
+                self.minute_rr_intervals = []
+            self.minute_peaks_number += 1
+            if self.last_peak is not None:
+                self.minute_rr_intervals.append(peak - self.last_peak)
+            self.last_peak = peak
+
+    def _write_minute(self):
+        hr = np.nan
+        if len(self.minute_rr_intervals) > 0:
+            hr = self.minute_length / np.mean(self.minute_rr_intervals)
+        self._write_records(MINUTE_RECORD, [self.minute * self.minute_length], self.minute_peaks_number, hr)
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self, samples_number, size):
+        if self.minute is not None:
+            self._write_minute()
+        self._write_records(END_RECORD, [samples_number], size)
+        self.file.close()
+
+
+class IndexedRecordingWriter:
+    '''Recording writer, e.g. BinaryRecordingWriter, building the index
+    while the samples are written. The blocks are split at the indexed
+    samples, so their offsets are the sizes of the file before them.
+    The R peaks are given to add_peaks as the indices of the samples
+    in the recording'''
+
+    def __init__(self, writer, filename, Fs, channels=1, start_timestamp=None):
+        self.writer = writer
+        self.index = RecordingIndexWriter(filename, Fs, channels, start_timestamp)
+        self.block_size = self.index.header.block_size
+        self.samples_number = 0
+
+    def write_block(self, data_block):
+        while len(data_block) > 0:
+            if self.samples_number % self.block_size == 0:
+                self.index.add_blocks([self.samples_number], self.writer.size)
+            part = data_block[:self.block_size - self.samples_number % self.block_size]
+            self.writer.write_block(part)
+            self.samples_number += len(part)
+            data_block = data_block[len(part):]
+
+    def add_peaks(self, peaks_indices):
+        self.index.add_peaks(peaks_indices)
+
+    def sync(self):
+        self.writer.sync()
+        self.index.sync()
+
+    def close(self):
+        self.writer.close()
+        self.index.close(self.samples_number, self.writer.size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_indexed_recording_writer(filename, Fs, adc_resolution=12, max_voltage=3.3, channels=1):
+    '''open_recording_writer with the index written next to the recording'''
+    writer = open_recording_writer(filename, Fs, adc_resolution, max_voltage, channels)
+    start_timestamp = writer.header.start_timestamp if isinstance(writer, BinaryRecordingWriter) else None
+    return IndexedRecordingWriter(writer, index_filename(filename), Fs, channels, start_timestamp)
+
+
+def iter_binary_samples_with_offsets(filename):
+    '''Yields the offsets in the file and the values of the samples
+    of the binary recording in blocks'''
+    header, samples = read_binary_recording(filename)
+    sample_size = header.channels * SAMPLE_DTYPE.itemsize
+    for start in range(0, len(samples), BUILD_BLOCK_SIZE):
+        values = np.asarray(samples[start:start + BUILD_BLOCK_SIZE], dtype=float)
+        yield HEADER_SIZE + (start + np.arange(len(values))) * sample_size, values
+
+
+def iter_text_samples_with_offsets(filename, channels=1):
+    '''Yields the offsets in the file and the values of the samples
+    of the text recording in chunks of complete lines'''
+    offset = 0
+    for data in iter_lines_chunks_from_file(filename):
+        newlines = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == ord('\n'))
+        line_starts = np.concatenate([[0], newlines + 1])
+        line_starts = line_starts[line_starts < len(data)]
+        values = parse_text_samples(data, channels)
+        yield offset + line_starts, values
+        offset += len(data)
+
+
+def build_recording_index(filename, Fs=200, channels=1, detection_channel=0):
+    '''Writes the index of the recording in one pass, with memory bounded by
+    the size of the blocks read. Fs and channels of the binary recordings
+    are taken from the header. Returns the name of the index'''
+    if Path(filename).suffix == BINARY_RECORDING_EXTENSION:
+        header = read_binary_recording_header(filename)
+        Fs, channels, start_timestamp = header.Fs, header.channels, header.start_timestamp
+        samples_with_offsets = iter_binary_samples_with_offsets(filename)
+    else:
+        start_timestamp = guess_start_timestamp(filename)
+        samples_with_offsets = iter_text_samples_with_offsets(filename, channels)
+    sp = SignalProcessor(Fs)
+    detector = StreamingRPeakDetector(sp)
+    index = RecordingIndexWriter(index_filename(filename), Fs, channels, start_timestamp)
+    block_size = index.header.block_size
+    samples_number = 0
+    for offsets, values in samples_with_offsets:
+        first_block_sample = -(-samples_number // block_size) * block_size
+        blocks_samples = np.arange(first_block_sample, samples_number + len(values), block_size)
+        index.add_blocks(blocks_samples, offsets[blocks_samples - samples_number])
+        filtered = sp.use_all_filters_on_block(values).reshape(len(values), -1)
+        index.add_peaks(detector.update(filtered[:, detection_channel]))
+        samples_number += len(values)
+    index.add_peaks(detector.flush())
+    index.close(samples_number, os.path.getsize(filename))
+    return index_filename(filename)
+
+
+def read_index(filename):
+    with open(filename, 'rb') as f:
+        magic, version, *values = struct.unpack_from(INDEX_HEADER_FORMAT, f.read(INDEX_HEADER_SIZE))
+        if magic != INDEX_MAGIC:
+            raise ValueError(f'{filename} is not an index of ECG recording')
+        if version != INDEX_VERSION:
+            raise ValueError(f'Unsupported version {version} of the index {filename}')
+        # the last record may be incomplete after a crash
+        records_number = (os.path.getsize(filename) - INDEX_HEADER_SIZE) // INDEX_RECORD_DTYPE.itemsize
+        records = np.fromfile(f, dtype=INDEX_RECORD_DTYPE, count=records_number)
+    return IndexHeader(*values), records
+
+
+class RecordingIndex:
+    '''Random access to the samples, the beats and the time ranges of the
+    recording through its index. Only the bytes of the recording holding
+    the asked samples are read: the binary recordings are memory-mapped
+    and the text ones are read from the indexed block before the first
+    sample to the indexed block after the last one. The samples are
+    counted from the beginning of the recording and the times
+    in seconds from its start too.
+
+    The index written while recording misses the R peaks of the last
+    moments before it was stopped, build_recording_index finds all of them'''
+
+    def __init__(self, filename):
+        self.filename = Path(filename)
+        self.header, records = read_index(index_filename(filename))
+        self.Fs = self.header.Fs
+        self.channels = self.header.channels
+        self.start_timestamp = self.header.start_timestamp
+        kinds = records['kind']
+        blocks = records[kinds == BLOCK_RECORD]
+        self.blocks_samples = blocks['sample']
+        self.blocks_offsets = blocks['offset']
+        self.peaks = records['sample'][kinds == PEAK_RECORD]
+        minutes = records[kinds == MINUTE_RECORD]
+        self.minutes = np.zeros(len(minutes), dtype=MINUTE_SUMMARY_DTYPE)
+        self.minutes['start'] = minutes['sample'] / self.Fs
+        self.minutes['peaks'] = minutes['offset']
+        self.minutes['hr'] = minutes['value']
+        end = records[kinds == END_RECORD]
+        # unknown when the recording was not closed
+        self.samples_number = int(end['sample'][-1]) if len(end) > 0 else None
+
+    def read_samples(self, start, stop):
+        start = max(0, start)
+        if self.filename.suffix == BINARY_RECORDING_EXTENSION:
+            _, samples = read_binary_recording(self.filename)
+            return np.asarray(samples[start:stop], dtype=float)
+        if stop <= start or len(self.blocks_samples) == 0:
+            return read_from_file(self.filename, start, stop, self.channels)
+        first = max(0, np.searchsorted(self.blocks_samples, start, side='right') - 1)
+        last = np.searchsorted(self.blocks_samples, stop)
+        with open(self.filename, 'rb') as f:
+            f.seek(self.blocks_offsets[first])
+            if last < len(self.blocks_offsets):
+                data = f.read(self.blocks_offsets[last] - self.blocks_offsets[first])
+            else:
+                data = f.read()
+        samples = parse_text_samples(data, self.channels)
+        skipped_samples_number = start - self.blocks_samples[first]
+        return samples[skipped_samples_number:skipped_samples_number + stop - start]
+
+    def read_time_range(self, start_time, end_time):
+        return self.read_samples(int(round(start_time * self.Fs)), int(round(end_time * self.Fs)))
+
+    def read_datetime_range(self, start, end):
+        '''Samples between the datetimes, e.g. from 14:32 to 14:35 of the day the recording started'''
+        return self.read_time_range(start.timestamp() - self.start_timestamp, end.timestamp() - self.start_timestamp)
+
+    def peaks_in_range(self, start, stop):
+        return self.peaks[np.searchsorted(self.peaks, start):np.searchsorted(self.peaks, stop)]
+
+    def read_beats(self, first_beat, last_beat=None, margin=0.5):
+        '''Samples from margin seconds before the R peak first_beat to margin
+        seconds after the R peak last_beat, the beats counted from 0. Returns
+        the index of the first sample, the samples and the R peaks in them'''
+        if last_beat is None:
+            last_beat = first_beat
+        margin_length = int(round(margin * self.Fs))
+        start = max(0, self.peaks[first_beat] - margin_length)
+        stop = self.peaks[last_beat] + margin_length + 1
+        samples = self.read_samples(start, stop)
+        return start, samples, self.peaks_in_range(start, start + len(samples))
+
+    def minute_summaries(self, start_time=0, end_time=np.inf):
+        '''Minutes starting between the times'''
+        starts = self.minutes['start']
+        return self.minutes[(starts >= start_time) & (starts < end_time)]
+
+    def time_of_day(self, time):
+        return datetime.fromtimestamp(self.start_timestamp + time)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Builds the indices of the recordings '
+                                                 'and prints their summaries.')
+    parser.add_argument('recordings', nargs='+')
+    parser.add_argument('--Fs', type=int, default=200, help='sampling frequency of the text recordings')
+    parser.add_argument('--channels', type=int, default=1, help='channels number of the text recordings')
+    parser.add_argument('--rebuild', action='store_true', help='build the index even if it exists')
+    parser.add_argument('--minutes', action='store_true', help='print HR of every minute')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    for filename in args.recordings:
+        if args.rebuild or not index_filename(filename).exists():
+            print(f'Indexing {filename}')
+            build_recording_index(filename, args.Fs, args.channels)
+        index = RecordingIndex(filename)
+        samples_number = '?' if index.samples_number is None else index.samples_number
+        print(f'{filename}: {samples_number} samples at {index.Fs} Hz, {len(index.peaks)} R peaks, '
+              f'started {index.time_of_day(0):%Y-%m-%d %H:%M:%S}')
+        if args.minutes:
+            for minute in index.minutes:
+                print(f'    {index.time_of_day(minute["start"]):%H:%M}  {minute["peaks"]:3d} beats, '
+                      f'HR {minute["hr"]:.1f}')
+
+
+if __name__ == '__main__':
+    main()
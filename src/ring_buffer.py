@@ -0,0 +1,61 @@
+import numpy as np
+
+
+class RingBuffer:
+    '''Preallocated buffer keeping the newest capacity samples.
+    Every sample is stored twice, capacity positions apart, so the samples
+    in the buffer are always available as one contiguous view
+    in chronological order without copying. With channels set every
+    sample is a row with one value per channel'''
+
+    def __init__(self, capacity, dtype=float, channels=None):
+        self.capacity = capacity
+        shape = (2 * capacity,) if channels is None else (2 * capacity, channels)
+        self._data = np.zeros(shape, dtype=dtype)
+        self._end = 0  # position where the next sample will be written
+        self._length = 0
+
+    def __len__(self):
+        return self._length
+
+    def is_full(self):
+        return self._length == self.capacity
+
+    def clear(self):
+        self._end = 0
+        self._length = 0
+
+    def append(self, x):
+        self._data[self._end] = x
+        self._data[self._end + self.capacity] = x
+        self._end = (self._end + 1) % self.capacity
+        self._length = min(self._length + 1, self.capacity)
+
+    def extend(self, block):
+        block = np.asarray(block)
+        n = len(block)
+        if n >= self.capacity:
+            # only the newest samples would stay in the buffer anyway
+            block = block[n - self.capacity:]
+            self._data[:self.capacity] = block
+            self._data[self.capacity:] = block
+            self._end = 0
+            self._length = self.capacity
+            return
+        first_part = min(n, self.capacity - self._end)
+        self._write(self._end, block[:first_part])
+        self._write(0, block[first_part:])
+        self._end = (self._end + n) % self.capacity
+        self._length = min(self._length + n, self.capacity)
+
+    def _write(self, position, block):
+        n = len(block)
+        self._data[position:position + n] = block
+        self._data[position + self.capacity:position + self.capacity + n] = block
+
+    def view(self):
+        '''Returns read-only view of the samples, the oldest first'''
+        end = self._end + self.capacity
+        view = self._data[end - self._length:end]
+        view.flags.writeable = False
+        return view
@@ -0,0 +1,318 @@
+import argparse
+import os
+import queue
+import socket
+import struct
+import threading
+import numpy as np
+
+from recording_format import SAMPLE_DTYPE, to_samples
+from instrumentation import metrics
+
+DEFAULT_ADDRESS = ('127.0.0.1', 5757)
+FRAME_MAGIC = b'ES'
+# magic, message type, sequence number, payload size
+FRAME_HEADER_FORMAT = '<2sBII'
+FRAME_HEADER_SIZE = struct.calcsize(FRAME_HEADER_FORMAT)
+# Fs, channels, adc_resolution, max_voltage
+INFO_FORMAT = '<IHHd'
+# index of the first sample, samples number, channels,
+# followed by the raw samples as uint16 clipped to the ADC range and the filtered ones as float32
+SAMPLES_HEADER_FORMAT = '<QII'
+SAMPLES_HEADER_SIZE = struct.calcsize(SAMPLES_HEADER_FORMAT)
+FILTERED_DTYPE = np.dtype('<f4')
+MEASURES_KEYS = ['hr', 'bpm', 'ibi', 'sdnn', 'sdsd', 'rmssd', 'pnn20', 'pnn50', 'lf', 'hf', 'lf_hf']
+# samples number, then the measures, NaN when unknown
+MEASURES_FORMAT = '<Q' + 'd' * len(MEASURES_KEYS)
+
+INFO_MESSAGE = 0
+SAMPLES_MESSAGE = 1
+MEASURES_MESSAGE = 2
+
+
+def parse_address(text):
+    '''host:port is a TCP address, anything else a Unix socket path'''
+    host, separator, port = text.rpartition(':')
+    if separator and port.isdigit():
+        return host or DEFAULT_ADDRESS[0], int(port)
+    return text
+
+
+def address_family(address):
+    return socket.AF_UNIX if isinstance(address, str) else socket.AF_INET
+
+
+def encode_frame(message_type, sequence, payload):
+    return struct.pack(FRAME_HEADER_FORMAT, FRAME_MAGIC, message_type, sequence, len(payload)) + payload
+
+
+def encode_samples(processed_block, max_value):
+    raw = to_samples(processed_block.raw, max_value)
+    filtered = processed_block.filtered.astype(FILTERED_DTYPE)
+    samples_number, channels = raw.shape
+    return struct.pack(SAMPLES_HEADER_FORMAT, processed_block.start, samples_number, channels) + \
+        raw.tobytes() + filtered.tobytes()
+
+
+def decode_samples(payload):
+    '''Returns the index of the first sample and the raw and filtered
+    samples with one column per channel'''
+    start, samples_number, channels = struct.unpack_from(SAMPLES_HEADER_FORMAT, payload)
+    values_number = samples_number * channels
+    raw = np.frombuffer(payload, SAMPLE_DTYPE, values_number, SAMPLES_HEADER_SIZE)
+    filtered = np.frombuffer(payload, FILTERED_DTYPE, values_number,
+                             SAMPLES_HEADER_SIZE + values_number * SAMPLE_DTYPE.itemsize)
+    return start, raw.reshape(samples_number, channels), filtered.reshape(samples_number, channels)
+
+
+def encode_measures(samples_number, hr, measures):
+    values = [hr] + [measures[key] for key in MEASURES_KEYS[1:]]
+    return struct.pack(MEASURES_FORMAT, samples_number, *map(float, values))
+
+
+def decode_measures(payload):
+    samples_number, *values = struct.unpack(MEASURES_FORMAT, payload)
+    return samples_number, dict(zip(MEASURES_KEYS, values))
+
+
+class ClientConnection:
+    '''Sends the frames to one client in its own thread. A slow client
+    only fills its own queue, the frames that do not fit are dropped
+    and the client sees the gap in the sequence numbers'''
+
+    def __init__(self, connection, queue_size, on_close):
+        self.connection = connection
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.on_close = on_close
+        self.dropped_frames_number = 0
+        self.thread = threading.Thread(target=self._run, name='ClientConnection', daemon=True)
+        self.thread.start()
+
+    def send(self, frame):
+        try:
+            self.queue.put_nowait(frame)
+        except queue.Full:
+            self.dropped_frames_number += 1
+            metrics.count('stream.dropped_frames')
+
+    def close(self):
+        # the queue may be full, so the sentinel has to make place
+        while True:
+            try:
+                self.queue.put_nowait(None)
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def _run(self):
+        try:
+            while True:
+                frame = self.queue.get()
+                if frame is None:
+                    break
+                self.connection.sendall(frame)
+        except OSError:
+            pass  # the client disconnected
+        finally:
+            self.connection.close()
+            self.on_close(self)
+
+
+class StreamServer:
+    '''Publishes the processed blocks to any number of local clients,
+    it is a subscriber of the AcquisitionEngine. Every client gets
+    the information about the signal after connecting, then the raw and
+    filtered samples of every block and the HR and HRV measures every
+    measures_interval seconds as separate messages.
+
+    address is (host, port) for TCP or a path of the Unix socket'''
+
+    def __init__(self, Fs, channels=1, adc_resolution=12, max_voltage=3.3, address=DEFAULT_ADDRESS,
+                 queue_size=100, measures_interval=1.0):
+        self.Fs = Fs
+        self.channels = channels
+        self.adc_resolution = adc_resolution
+        self.max_voltage = max_voltage
+        self.address = address
+        self.queue_size = queue_size
+        self.measures_samples_interval = max(1, int(measures_interval * Fs))
+        self.sequence = 0
+        self.clients = []
+        self.clients_lock = threading.Lock()
+
+        self.server_socket = socket.socket(address_family(address), socket.SOCK_STREAM)
+        if address_family(address) == socket.AF_INET:
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server_socket.bind(address)
+        self.server_socket.listen()
+        # the real port when port 0 was requested
+        self.address = self.server_socket.getsockname()
+        self.thread = threading.Thread(target=self._accept_clients, name='StreamServer', daemon=True)
+        self.thread.start()
+
+    def clients_number(self):
+        with self.clients_lock:
+            return len(self.clients)
+
+    def dropped_frames_number(self):
+        with self.clients_lock:
+            return sum(client.dropped_frames_number for client in self.clients)
+
+    def close(self):
+        self.server_socket.close()
+        if address_family(self.address) == socket.AF_UNIX and os.path.exists(self.address):
+            os.unlink(self.address)
+        with self.clients_lock:
+            clients = list(self.clients)
+        for client in clients:
+            client.close()
+
+    def __call__(self, processed_block):
+        self._publish(SAMPLES_MESSAGE, encode_samples(processed_block, 2**self.adc_resolution - 1))
+        samples_number = processed_block.start + len(processed_block.raw)
+        interval = self.measures_samples_interval
+        if samples_number // interval > processed_block.start // interval:
+            self._publish(MEASURES_MESSAGE, encode_measures(samples_number, processed_block.hr,
+                                                            processed_block.measures))
+
+    def _publish(self, message_type, payload):
+        # the frame is encoded once for all the clients
+        frame = encode_frame(message_type, self.sequence, payload)
+        self.sequence = (self.sequence + 1) % 2**32
+        with self.clients_lock:
+            for client in self.clients:
+                client.send(frame)
+
+    def _accept_clients(self):
+        while True:
+            try:
+                connection, _ = self.server_socket.accept()
+            except OSError:
+                return  # the server was closed
+            if address_family(self.address) == socket.AF_INET:
+                connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            info = struct.pack(INFO_FORMAT, self.Fs, self.channels, self.adc_resolution, self.max_voltage)
+            client = ClientConnection(connection, self.queue_size, self._remove_client)
+            with self.clients_lock:
+                # the information goes first, before any samples
+                client.send(encode_frame(INFO_MESSAGE, self.sequence, info))
+                self.clients.append(client)
+
+    def _remove_client(self, client):
+        with self.clients_lock:
+            if client in self.clients:
+                self.clients.remove(client)
+
+
+class StreamClient:
+    '''Receives the messages of the StreamServer. The signal information
+    is read when connecting and available as Fs, channels,
+    adc_resolution and max_voltage'''
+
+    def __init__(self, address=DEFAULT_ADDRESS, timeout=0.1):
+        self.socket = socket.socket(address_family(address), socket.SOCK_STREAM)
+        self.socket.connect(address)
+        self.buffer = bytearray()
+        self.last_sequence = None
+        self.lost_messages_number = 0
+        self.socket.settimeout(None)
+        message_type, info = self.read_message()
+        self.Fs, self.channels, self.adc_resolution, self.max_voltage = info
+        self.socket.settimeout(timeout)
+
+    def close(self):
+        self.socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def read_message(self):
+        '''Returns the message type and its decoded content, None when
+        nothing came before the timeout. Raises ConnectionError when
+        the server has closed the connection'''
+        while True:
+            frame = self._take_frame()
+            if frame is not None:
+                return frame
+            try:
+                data = self.socket.recv(1 << 16)
+            except socket.timeout:
+                return None
+            if not data:
+                raise ConnectionError('The stream server closed the connection')
+            self.buffer += data
+
+    def iter_messages(self):
+        while True:
+            message = self.read_message()
+            if message is not None:
+                yield message
+
+    def read_blocks(self, filtered=False):
+        '''Yields the raw (or filtered) samples like read_blocks_from_serial_port,
+        the block is empty when nothing came before the timeout'''
+        empty_block = np.zeros((0, self.channels))
+        while True:
+            message = self.read_message()
+            if message is None:
+                yield empty_block
+                continue
+            message_type, content = message
+            if message_type == SAMPLES_MESSAGE:
+                _, raw, filtered_samples = content
+                yield (filtered_samples if filtered else raw).astype(float)
+
+    def _take_frame(self):
+        if len(self.buffer) < FRAME_HEADER_SIZE:
+            return None
+        magic, message_type, sequence, payload_size = struct.unpack_from(FRAME_HEADER_FORMAT, self.buffer)
+        if magic != FRAME_MAGIC:
+            raise ConnectionError('Wrong frame received from the stream server')
+        frame_size = FRAME_HEADER_SIZE + payload_size
+        if len(self.buffer) < frame_size:
+            return None
+        payload = bytes(self.buffer[FRAME_HEADER_SIZE:frame_size])
+        del self.buffer[:frame_size]
+
+        if message_type == INFO_MESSAGE:
+            return message_type, struct.unpack(INFO_FORMAT, payload)
+        if self.last_sequence is not None:
+            self.lost_messages_number += (sequence - self.last_sequence - 1) % 2**32
+        self.last_sequence = sequence
+        if message_type == SAMPLES_MESSAGE:
+            return message_type, decode_samples(payload)
+        if message_type == MEASURES_MESSAGE:
+            return message_type, decode_measures(payload)
+        return message_type, payload
+
+
+def read_blocks_from_stream_server(address=DEFAULT_ADDRESS, timeout=0.1, filtered=False):
+    '''The same as read_blocks_from_serial_port, but the samples
+    come from the StreamServer'''
+    with StreamClient(address, timeout) as client:
+        yield from client.read_blocks(filtered)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Prints HR and HRV measures sent by the stream server.')
+    parser.add_argument('address', nargs='?', default=f'{DEFAULT_ADDRESS[0]}:{DEFAULT_ADDRESS[1]}',
+                        help='host:port or path of the Unix socket')
+    args = parser.parse_args()
+    with StreamClient(parse_address(args.address)) as client:
+        print(f'Connected, Fs: {client.Fs} Hz, channels: {client.channels}')
+        for message_type, content in client.iter_messages():
+            if message_type == MEASURES_MESSAGE:
+                samples_number, measures = content
+                print(f'{samples_number / client.Fs:8.1f} s  ' +
+                      ', '.join(f'{key}: {value:.2f}' for key, value in measures.items()) +
+                      f', lost messages: {client.lost_messages_number}')
+
+
+if __name__ == '__main__':
+    main()
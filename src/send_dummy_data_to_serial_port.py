@@ -1,13 +1,24 @@
-import time
+import argparse
 import serial
-import sys
 
-port = sys.argv[1] # '/dev/pts/2'
+from input_sources import SyntheticECGSource
 
-ser = serial.Serial(port, 115200, timeout=0.050)
-count = 0
+parser = argparse.ArgumentParser(description='Sends the synthetic ECG to the serial port '
+                                             'in the same format as the device.')
+parser.add_argument('port', help='e.g. /dev/pts/2')
+parser.add_argument('--baudrate', type=int, default=115200)
+parser.add_argument('--Fs', type=int, default=200)
+parser.add_argument('--hr', type=float, default=60.0)
+parser.add_argument('--channels', type=int, default=1)
+parser.add_argument('--speed', type=float, default=1.0, help='relative to the real time, inf for no limit')
+args = parser.parse_args()
 
-while 1:
-    ser.write((str(time.time())+'\n').encode('utf-8'))
-    time.sleep(1)
-    count += 1
+ser = serial.Serial(args.port, args.baudrate, timeout=0.050)
+source = SyntheticECGSource(args.Fs, args.hr, channels=args.channels, speed=args.speed)
+
+for block in source.read_blocks(timeout=0.01):
+    if block.ndim == 1:
+        lines = ''.join(f'{int(x)}\n' for x in block)
+    else:
+        lines = ''.join(','.join(str(int(x)) for x in row) + '\n' for row in block)
+    ser.write(lines.encode('utf-8'))
@@ -0,0 +1,71 @@
+import numpy as np
+import matplotlib.pyplot as plt
+import scipy.signal as ss
+
+from port_handler import convert_units_to_volts
+from signal_processor import FilterType
+
+matplotlib_plots_params = {'font.family': 'Calibri',
+                           'font.size': 12,
+                           'legend.fontsize': 12,
+                           'axes.labelsize': 14,
+                           'axes.titlesize': 20,
+                           'xtick.labelsize': 12,
+                           'ytick.labelsize': 12}
+plt.rcParams.update(matplotlib_plots_params)
+
+
+def plot_filter_characteristics(b, a, Fs):
+    W, h = ss.freqz(b, a)
+    f = W * Fs / (2 * np.pi)
+    angle = np.unwrap(np.angle(h))
+    plt.figure()
+    plt.subplot(121)
+    plt.plot(f, abs(h))
+    plt.grid('on')
+    plt.xlim([0, 64])
+    plt.xlabel('Częstotliwość [Hz]') # Frequency Częstotliwość
+    plt.ylabel('Moduł transmitancji') # Transfer function module Moduł transmitancji
+    plt.subplot(122)
+    plt.plot(f, angle, 'g')
+    plt.grid('on')
+    plt.xlim([0, 64])
+    plt.xlabel('Częstotliwość [Hz]') # Frequency Częstotliwość
+    plt.ylabel('Faza') # Phase Faza
+    plt.tight_layout()
+
+
+def plot_all_filters_characteristics(sp):
+    [b, a] = sp.ba[FilterType.highpass]
+    plot_filter_characteristics(b, a, sp.Fs)
+    [b, a] = sp.ba[FilterType.bandstop]
+    plot_filter_characteristics(b, a, sp.Fs)
+    [b, a] = sp.ba[FilterType.lowpass]
+    plot_filter_characteristics(b, a, sp.Fs)
+    plt.show()
+
+
+def plot_signal_with_R_peaks(s, s_filtered, peaks_indices, Fs):
+    x = np.arange(0, len(s))
+
+    plt.figure()
+    plt.subplot(2, 1, 1)
+    plt.plot(x/Fs, convert_units_to_volts(s)*1000)
+    plt.grid('on')
+    plt.ylabel('Amplituda [mV]')
+    plt.subplot(2, 1, 2)
+    plt.plot(x/Fs, convert_units_to_volts(s_filtered)*1000)
+    plt.grid('on')
+    plt.xlabel('Czas [s]')
+    plt.ylabel('Amplituda [mV]')
+    plt.tight_layout()
+
+    plt.figure()
+    plt.plot(x/Fs, convert_units_to_volts(s_filtered)*1000)
+    plt.plot(peaks_indices/Fs, convert_units_to_volts(s_filtered[peaks_indices])*1000, 'x')
+    plt.grid('on')
+    plt.xlabel('Czas [s]')
+    plt.ylabel('Amplituda [mV]')
+    plt.tight_layout()
+
+    plt.show()
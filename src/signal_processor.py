@@ -1,19 +1,40 @@
+import os
+from collections import deque
+from pathlib import Path
 import numpy as np
-import matplotlib.pyplot as plt
 import scipy.signal as ss
 from enum import auto, Enum
-from port_handler import convert_units_to_volts
-
-matplotlib_plots_params = {'font.family': 'Calibri',
-                           'font.size': 12,
-                           'legend.fontsize': 12,
-                           'axes.labelsize': 14,
-                           'axes.titlesize': 20,
-                           'xtick.labelsize': 12,
-                           'ytick.labelsize': 12}
-plt.rcParams.update(matplotlib_plots_params)
+from functools import cached_property, lru_cache
 
 NUMBER_OF_SEC_IN_ONE_MIN = 60
+TEXT_READ_CHUNK_SIZE = 1 << 20  # in bytes
+
+# R peaks detection parameters independent of the sampling frequency,
+# the comments give their values in samples at Fs = 200 Hz
+MOVING_AVERAGE_DURATION = 0.025  # in seconds, 5 samples
+R_PEAKS_MIN_DISTANCE = 0.33  # in seconds, 66 samples
+REFINEMENT_WINDOW_DURATION = 0.105  # in seconds, 21 samples
+# threshold of the squared slope of the signal in (ADC units / s)^2,
+# 5000 (ADC units / sample)^2
+SLOPE_ENERGY_THRESHOLD = 5000 * 200**2
+# frequency-domain HRV: the RR intervals are resampled at
+# RR_RESAMPLING_FREQUENCY and their spectrum estimated with Welch's
+# method on Hann windowed segments overlapping by half
+RR_RESAMPLING_FREQUENCY = 4.0  # in Hz
+SPECTRAL_SEGMENT_LENGTH = 256  # resampled RR intervals, 64 s
+SPECTRAL_SEGMENT_STEP = SPECTRAL_SEGMENT_LENGTH // 2
+LF_BAND = (0.04, 0.15)  # in Hz
+HF_BAND = (0.15, 0.4)  # in Hz
+# the adaptive threshold never goes below this part of SLOPE_ENERGY_THRESHOLD,
+# so the noise alone is not taken for the beats
+ADAPTIVE_THRESHOLD_FLOOR = 0.1
+ADAPTIVE_THRESHOLD_LEARNING_TIME = 2  # in seconds
+# the missed beat is searched for at most that long before the current peak,
+# 166% of the longest RR interval of 2 s at HR 30
+SEARCHBACK_DURATION = 3.32  # in seconds
+# above it the (b, a) coefficients of the lowpass filter are numerically
+# unstable, so the cascade of second-order sections is used
+BA_FILTERS_MAX_FS = 1000
 
 
 class FilterType(Enum):
@@ -22,59 +43,316 @@ class FilterType(Enum):
     lowpass = auto()
 
 
+# (order, critical frequencies in Hz, type) of the Butterworth filters
+# applied one after another in the order of this dictionary
+FILTERS_SPECIFICATION = {
+    FilterType.highpass: (2, 0.5, 'highpass'),
+    FilterType.bandstop: (5, (49, 51), 'bandstop'),
+    FilterType.lowpass: (10, 40, 'lowpass'),
+}
+
+
+@lru_cache(maxsize=None)
+def design_filter(Fs, N, Wn, btype, output='ba'):
+    # the designed coefficients are shared between all processors
+    # using the same Fs, so they must not be modified in place
+    return ss.butter(N=N, Wn=Wn, btype=btype, fs=Fs, output=output)
+
+
+def load_compiled_kernels():
+    '''compiled_kernels module, None with a message when numba is not installed'''
+    import compiled_kernels
+    if not compiled_kernels.AVAILABLE:
+        print('numba is not installed, the SciPy filters are used')
+        return None
+    return compiled_kernels
+
+
+@lru_cache(maxsize=None)
+def design_filters_cascade(Fs):
+    return np.vstack([design_filter(Fs, *specification, output='sos')
+                      for specification in FILTERS_SPECIFICATION.values()])
+
+
+def resample_rr_intervals(beats_times, rr_list):
+    '''RR intervals, given at the times of the R peaks ending them,
+    linearly interpolated every 1/RR_RESAMPLING_FREQUENCY seconds
+    from the first of them'''
+    if len(beats_times) == 0:
+        return np.zeros(0)
+    samples_number = int(np.floor((beats_times[-1] - beats_times[0]) * RR_RESAMPLING_FREQUENCY)) + 1
+    times = beats_times[0] + np.arange(samples_number) / RR_RESAMPLING_FREQUENCY
+    return np.interp(times, beats_times, rr_list)
+
+
+def band_powers(frequencies, psd):
+    '''LF and HF power in ms^2 of the power spectral density in ms^2/Hz'''
+    df = frequencies[1] - frequencies[0]
+    lf_band = (frequencies >= LF_BAND[0]) & (frequencies < LF_BAND[1])
+    hf_band = (frequencies >= HF_BAND[0]) & (frequencies < HF_BAND[1])
+    return np.sum(psd[..., lf_band], axis=-1) * df, np.sum(psd[..., hf_band], axis=-1) * df
+
+
+def frequency_measures(lf, hf):
+    return {'lf': lf, 'hf': hf, 'lf_hf': lf / hf if hf > 0 else np.nan}
+
+
+class AdaptiveThreshold:
+    '''Pan-Tompkins like classification of the slope energy peaks.
+    The running estimates of the signal and noise peaks levels, learned
+    first on the learning_time seconds from the beginning of the signal,
+    set the threshold between them, never lower than floor. When no beat
+    was found for 166% of the average RR interval, the highest noise peak
+    above half of the threshold since the last beat, at most
+    SEARCHBACK_DURATION before, is taken as the missed beat.
+
+    The state is kept between the calls of select, so the slope energy
+    may come in windows, as in StreamingRPeakDetector, and the peaks are
+    the same as when it is classified at once'''
+
+    def __init__(self, Fs, floor, learning_time=ADAPTIVE_THRESHOLD_LEARNING_TIME):
+        self.learning_length = int(learning_time * Fs)
+        self.searchback_length = int(SEARCHBACK_DURATION * Fs)
+        self.floor = floor
+        self.signal_level = None
+        self.noise_level = None
+        self.threshold = None
+        self.noise_peaks = []  # (index, slope energy) since the last selected peak
+        self.selected = deque(maxlen=9)  # the last selected peaks, for the average RR interval
+        self.rr_average = None
+
+    def learned(self):
+        return self.threshold is not None
+
+    def learn(self, slope_energy):
+        learning_part = slope_energy[:self.learning_length]
+        self.signal_level = 0.25 * np.max(learning_part)
+        self.noise_level = 0.5 * np.mean(learning_part)
+        self._update_threshold()
+
+    def _update_threshold(self):
+        self.threshold = max(self.floor, self.noise_level + 0.25 * (self.signal_level - self.noise_level))
+
+    def oldest_peak(self):
+        '''Index of the oldest peak that may still be selected, None when there is none'''
+        return self.noise_peaks[0][0] if len(self.noise_peaks) > 0 else None
+
+    def select(self, slope_energy, peaks_indices, offset=0):
+        '''Returns the selected peaks of peaks_indices, which are the indices
+        in slope_energy, and the missed ones found earlier. All of them
+        are counted from offset, the index of the beginning of slope_energy'''
+        peaks_indices = np.asarray(peaks_indices, dtype=int)
+        return self.classify(peaks_indices + offset, slope_energy[peaks_indices])
+
+    def classify(self, peaks_indices, energies):
+        '''The same as select for the peaks given with their slope energies'''
+        selected = []
+        for i, energy in zip(peaks_indices.tolist(), energies.tolist()):
+            if energy > self.threshold:
+                selected.append(i)
+                self.selected.append(i)
+                self.signal_level = 0.125 * energy + 0.875 * self.signal_level
+                self.noise_peaks = []
+            else:
+                self.noise_level = 0.125 * energy + 0.875 * self.noise_level
+                self.noise_peaks.append((i, energy))
+                while self.noise_peaks[0][0] < i - self.searchback_length:
+                    del self.noise_peaks[0]
+                if self.rr_average is not None and i - self.selected[-1] > 1.66 * self.rr_average:
+                    missed, missed_energy = max(self.noise_peaks, key=lambda peak: peak[1])
+                    if missed_energy > max(self.floor, self.threshold / 2):
+                        selected.append(missed)
+                        self.selected.append(missed)
+                        self.signal_level = 0.25 * missed_energy + 0.75 * self.signal_level
+                        self.noise_peaks = [peak for peak in self.noise_peaks if peak[0] > missed]
+            self._update_threshold()
+            if len(self.selected) >= 2:
+                self.rr_average = np.mean(np.diff(self.selected))
+        return np.array(selected, dtype=int)
+
+# measures computed in sliding windows, start and end in seconds
+WINDOWED_ANALYSIS_DTYPE = np.dtype([
+    ('start', float),
+    ('end', float),
+    ('peaks', int),
+    ('bpm', float),
+    ('sdnn', float),
+    ('rmssd', float),
+    ('pnn50', float),
+])
+
+
 class SignalProcessor:
-    def __init__(self, Fs):
+    def __init__(self, Fs, use_sos=None, adaptive_threshold=False, accelerated=False):
         self.Fs = Fs
+        self.use_sos = Fs > BA_FILTERS_MAX_FS if use_sos is None else use_sos
+        # compiled loops of compiled_kernels instead of SciPy, when numba is installed
+        self.kernels = load_compiled_kernels() if accelerated else None
+        if self.kernels is not None:
+            # the compiled versions take the place of the static methods
+            self.moving_average = self.kernels.moving_average
+            self.refine_R_peaks = self.kernels.refine_R_peaks
+        # R peaks detection parameters in samples
+        self.moving_average_width = max(2, int(round(MOVING_AVERAGE_DURATION * Fs)))
+        self.R_peaks_min_distance = max(1, int(round(R_PEAKS_MIN_DISTANCE * Fs)))
+        self.refinement_window_size = int(round(REFINEMENT_WINDOW_DURATION * Fs))
+        self.slope_energy_threshold = SLOPE_ENERGY_THRESHOLD / Fs**2
+        # Pan-Tompkins like threshold following the amplitude of the signal
+        # instead of the fixed slope_energy_threshold
+        self.adaptive_threshold = adaptive_threshold
         self.zi = {
             FilterType.highpass: None,
             FilterType.bandstop: None,
             FilterType.lowpass: None,
         }
-        self.ba = {
-            FilterType.highpass: ss.butter(N=2, Wn=0.5, btype='highpass', fs=self.Fs),
-            FilterType.bandstop: ss.butter(N=5, Wn=(49, 51), btype='bandstop', fs=self.Fs),
-            FilterType.lowpass: ss.butter(N=10, Wn=40, btype='lowpass', fs=self.Fs),
+        self.sos_zi = None
+
+    # the filters are designed when they are used for the first time,
+    # so creating the processor costs nothing at startup
+    @cached_property
+    def ba(self):
+        return {
+            filter_type: design_filter(self.Fs, *specification)
+            for filter_type, specification in FILTERS_SPECIFICATION.items()
         }
 
+    @cached_property
+    def sos(self):
+        # all filters fused into one cascade of second-order sections
+        # with a single state block, used when use_sos is set
+        return design_filters_cascade(self.Fs)
+
     def filter_in_real_time(self, x, filter_type):
         [b, a] = self.ba[filter_type]
         if self.zi[filter_type] is None:
             self.zi[filter_type] = ss.lfilter_zi(b, a) * x
+        if self.kernels is not None:
+            return self.kernels.lfilter_sample(b, a, x, self.zi[filter_type].reshape(-1))
         y, self.zi[filter_type] = ss.lfilter(b, a, [x], zi=self.zi[filter_type])
         return y[0]
 
+    def filter_block_in_real_time(self, x, filter_type):
+        [b, a] = self.ba[filter_type]
+        if self.zi[filter_type] is None:
+            # one column of the state per channel
+            self.zi[filter_type] = np.multiply.outer(ss.lfilter_zi(b, a), x[0])
+        if self.kernels is not None:
+            zi = self.zi[filter_type]
+            # the state is updated in place through the 2-D view
+            return self.kernels.lfilter_block(b, a, x.reshape(len(x), -1), zi.reshape(len(zi), -1)).reshape(x.shape)
+        y, self.zi[filter_type] = ss.lfilter(b, a, x, axis=0, zi=self.zi[filter_type])
+        return y
+
+    def filter_sos_block_in_real_time(self, x):
+        if self.sos_zi is None:
+            self.sos_zi = np.multiply.outer(ss.sosfilt_zi(self.sos), x[0])
+        if self.kernels is not None:
+            x = np.asarray(x, dtype=float)
+            zi = self.sos_zi.reshape(len(self.sos), 2, -1)
+            return self.kernels.sosfilt_block(self.sos, x.reshape(len(x), -1), zi).reshape(x.shape)
+        y, self.sos_zi = ss.sosfilt(self.sos, x, axis=0, zi=self.sos_zi)
+        return y
+
     def use_all_filters(self, data_point):
+        if self.use_sos:
+            if self.kernels is not None:
+                if self.sos_zi is None:
+                    self.sos_zi = ss.sosfilt_zi(self.sos) * data_point
+                return self.kernels.sosfilt_sample(self.sos, data_point, self.sos_zi.reshape(len(self.sos), 2))
+            return self.filter_sos_block_in_real_time([data_point])[0]
         data_point = self.filter_in_real_time(data_point, FilterType.highpass)
         data_point = self.filter_in_real_time(data_point, FilterType.bandstop)
         data_point = self.filter_in_real_time(data_point, FilterType.lowpass)
         return data_point
 
+    def use_all_filters_on_block(self, data_block):
+        '''Filters a block of samples of any length. The filters state is
+        shared with use_all_filters, so blocks and single data points
+        can be mixed and the output is the same as filtering
+        the samples one by one. A 2-D block has one column per channel,
+        all the channels are filtered in one call'''
+        data_block = np.asarray(data_block, dtype=float)
+        if len(data_block) == 0:
+            return data_block
+        if self.use_sos:
+            return self.filter_sos_block_in_real_time(data_block)
+        data_block = self.filter_block_in_real_time(data_block, FilterType.highpass)
+        data_block = self.filter_block_in_real_time(data_block, FilterType.bandstop)
+        data_block = self.filter_block_in_real_time(data_block, FilterType.lowpass)
+        return data_block
+
     @staticmethod
     def moving_average(x, w):
-        z = np.zeros(w // 2 - 1)
-        ma = np.convolve(x, np.ones(w), 'valid') / w
-        con = np.concatenate([z, ma, z])
+        z_length = w // 2 - 1
+        ma = np.convolve(x, np.ones(w), 'valid')
+        con = np.zeros(len(ma) + 2*z_length)
+        np.divide(ma, w, out=con[z_length:z_length + len(ma)])
         return con
 
-    def find_R_peaks(self, s, window_size=21):
-        s_ma = self.moving_average(s, 5)
-        diff_abs2 = np.abs(np.diff(s_ma))**2
-        peaks_indices, _ = ss.find_peaks(diff_abs2, height=5000, distance=66)
+    def slope_energy(self, s):
+        '''Squared slope of the moving average of the signal'''
+        s_ma = self.moving_average(s, self.moving_average_width)
+        diff_abs2 = np.diff(s_ma)
+        np.square(diff_abs2, out=diff_abs2)
+        return diff_abs2
+
+    def find_R_peaks_candidates(self, s):
+        diff_abs2 = self.slope_energy(s)
+        if self.adaptive_threshold:
+            peaks_indices, _ = ss.find_peaks(diff_abs2, distance=self.R_peaks_min_distance)
+            return self.select_R_peaks_adaptively(diff_abs2, peaks_indices)
+        peaks_indices, _ = ss.find_peaks(diff_abs2, height=self.slope_energy_threshold,
+                                         distance=self.R_peaks_min_distance)
+        return peaks_indices
+
+    def create_adaptive_threshold(self):
+        return AdaptiveThreshold(self.Fs, ADAPTIVE_THRESHOLD_FLOOR * self.slope_energy_threshold)
+
+    def select_R_peaks_adaptively(self, slope_energy, peaks_indices):
+        '''The slope energy peaks classified by AdaptiveThreshold
+        learned on the beginning of the signal'''
+        if len(peaks_indices) == 0:
+            return peaks_indices
+        adaptive_threshold = self.create_adaptive_threshold()
+        adaptive_threshold.learn(slope_energy)
+        return adaptive_threshold.select(slope_energy, peaks_indices)
 
-        maximized_peaks_indices = []
+    @staticmethod
+    def refine_R_peaks(s, peaks_indices, window_size=21):
+        '''Moves every peak to the maximum of the signal in the window
+        around it. The windows are taken as a view of the signal,
+        so the maxima of all of them are found at once'''
+        s = np.asarray(s)
+        peaks_indices = np.asarray(peaks_indices, dtype=int)
+        if len(peaks_indices) == 0:
+            return np.array([])
         mid = window_size // 2
-        for i in peaks_indices:
+        width = 2*mid + 1
+        maximized_peaks_indices = np.empty(len(peaks_indices), dtype=int)
+
+        inside = (peaks_indices >= mid) & (peaks_indices + mid + 1 <= len(s))
+        if len(s) >= width:
+            window_start_indices = peaks_indices[inside] - mid
+            windows = np.lib.stride_tricks.sliding_window_view(s, width)[window_start_indices]
+            maximized_peaks_indices[inside] = window_start_indices + np.argmax(windows, axis=1)
+
+        for n in np.flatnonzero(~inside):
+            i = peaks_indices[n]
             # handle edge case of the peak found
             # at the beginning of the signal
             window_start_index = max(0, i - mid)
             # handle edge case of the peak found
             # at the end of the signal
             window_end_index = min(len(s), i + mid + 1)
-            windowed_s = s[window_start_index:window_end_index]
-            argmax_index = np.argmax(np.array(windowed_s))
-            new_peak_index = window_start_index + argmax_index
-            maximized_peaks_indices.append(new_peak_index)
-        return np.array(maximized_peaks_indices)
+            argmax_index = np.argmax(s[window_start_index:window_end_index])
+            maximized_peaks_indices[n] = window_start_index + argmax_index
+        return maximized_peaks_indices
+
+    def find_R_peaks(self, s, window_size=None):
+        if window_size is None:
+            window_size = self.refinement_window_size
+        peaks_indices = self.find_R_peaks_candidates(s)
+        return self.refine_R_peaks(s, peaks_indices, window_size)
 
     def find_hr_from_peaks_indices(self, peaks_indices):
         distances = np.diff(peaks_indices)
@@ -123,92 +401,169 @@ class SignalProcessor:
 
         return measures
 
+    def make_frequency_analysis_on_peaks_indices(self, peaks_indices):
+        '''LF and HF power of the RR intervals and their ratio, NaN when
+        the R peaks cover less than one segment of Welch's method'''
+        peaks_indices = np.asarray(peaks_indices)
+        rr_list = (1000/self.Fs)*np.diff(peaks_indices)  # distances in miliseconds
+        rr_tachogram = resample_rr_intervals(peaks_indices[1:] / self.Fs, rr_list)
+        if len(rr_tachogram) < SPECTRAL_SEGMENT_LENGTH:
+            return frequency_measures(np.nan, np.nan)
+        frequencies, psd = ss.welch(rr_tachogram, fs=RR_RESAMPLING_FREQUENCY, window='hann',
+                                    nperseg=SPECTRAL_SEGMENT_LENGTH,
+                                    noverlap=SPECTRAL_SEGMENT_LENGTH - SPECTRAL_SEGMENT_STEP, detrend='constant')
+        return frequency_measures(*band_powers(frequencies, psd))
+
     def make_ecg_analysis(self, s):
         peaks_indices = self.find_R_peaks(s)
         return self.make_ecg_analysis_on_peaks_indices(peaks_indices)
 
-
-def read_from_file(filename):
-    with open(filename) as f:
-        lines = [float(line.rstrip()) for line in f.readlines()]
-    return np.array(lines)
-
-
-def plot_filter_characteristics(b, a, Fs):
-    W, h = ss.freqz(b, a)
-    f = W * Fs / (2 * np.pi)
-    angle = np.unwrap(np.angle(h))
-    plt.figure()
-    plt.subplot(121)
-    plt.plot(f, abs(h))
-    plt.grid('on')
-    plt.xlim([0, 64])
-    plt.xlabel('Częstotliwość [Hz]') # Frequency Częstotliwość
-    plt.ylabel('Moduł transmitancji') # Transfer function module Moduł transmitancji
-    plt.subplot(122)
-    plt.plot(f, angle, 'g')
-    plt.grid('on')
-    plt.xlim([0, 64])
-    plt.xlabel('Częstotliwość [Hz]') # Frequency Częstotliwość
-    plt.ylabel('Faza') # Phase Faza
-    plt.tight_layout()
-
-
-def plot_all_filters_characteristics(sp):
-    [b, a] = sp.ba[FilterType.highpass]
-    plot_filter_characteristics(b, a, sp.Fs)
-    [b, a] = sp.ba[FilterType.bandstop]
-    plot_filter_characteristics(b, a, sp.Fs)
-    [b, a] = sp.ba[FilterType.lowpass]
-    plot_filter_characteristics(b, a, sp.Fs)
-    plt.show()
+    def make_windowed_ecg_analysis_on_peaks_indices(self, peaks_indices, signal_length, window=300, step=30):
+        '''Computes the measures in sliding windows of window seconds
+        moved by step seconds. A window includes the RR intervals
+        with both R peaks inside it. The measures of all the windows
+        are computed at once from cumulative sums over the RR intervals'''
+        window_length = int(round(window * self.Fs))
+        step_length = int(round(step * self.Fs))
+        windows_number = max(0, (signal_length - window_length) // step_length + 1)
+        starts = np.arange(windows_number) * step_length
+        analysis = np.zeros(windows_number, dtype=WINDOWED_ANALYSIS_DTYPE)
+        analysis['start'] = starts / self.Fs
+        analysis['end'] = (starts + window_length) / self.Fs
+
+        peaks_indices = np.asarray(peaks_indices)
+        rr_list = (1000/self.Fs)*np.diff(peaks_indices)  # distances in miliseconds
+        rr_diff = np.diff(rr_list)
+        # centering makes the variance from the cumulative sums accurate
+        rr_mean = np.mean(rr_list) if len(rr_list) > 0 else 0.0
+        rr_centered = rr_list - rr_mean
+
+        def windows_sums(x, first, number):
+            # sums of number elements of x from first for every window,
+            # the indices of the empty windows may be out of x
+            cumulative_sum = np.concatenate([[0], np.cumsum(x)])
+            first = np.minimum(first, len(x))
+            return cumulative_sum[first + number] - cumulative_sum[first]
+
+        # the first peak in every window and the first one after it
+        first = np.searchsorted(peaks_indices, starts, side='left')
+        last = np.searchsorted(peaks_indices, starts + window_length, side='left')
+        peaks_number = last - first
+        rr_number = np.maximum(peaks_number - 1, 0)
+        rr_diff_number = np.maximum(peaks_number - 2, 0)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rr_mean_centered = windows_sums(rr_centered, first, rr_number) / rr_number
+            rr_variance = windows_sums(rr_centered**2, first, rr_number) / rr_number - rr_mean_centered**2
+            analysis['peaks'] = peaks_number
+            analysis['bpm'] = 60000 / (rr_mean_centered + rr_mean)
+            analysis['sdnn'] = np.sqrt(np.maximum(rr_variance, 0))
+            analysis['rmssd'] = np.sqrt(windows_sums(rr_diff**2, first, rr_diff_number) / rr_diff_number)
+            analysis['pnn50'] = windows_sums(rr_diff > 50.0, first, rr_diff_number) / rr_diff_number
+        return analysis
+
+    def make_windowed_ecg_analysis(self, s, window=300, step=30):
+        peaks_indices = self.find_R_peaks(s)
+        return self.make_windowed_ecg_analysis_on_peaks_indices(peaks_indices, len(s), window, step)
+
+
+def iter_lines_chunks_from_file(filename, start=0, stop=None, chunk_size=TEXT_READ_CHUNK_SIZE):
+    '''Yields chunks of the text file made of complete lines, from
+    the line start to the line stop. The lines outside of this range
+    are only counted, not parsed'''
+    line = 0
+    remainder = b''
+    with open(filename, 'rb') as f:
+        while stop is None or line < stop:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            data = remainder + chunk
+            end = data.rfind(b'\n') + 1
+            data, remainder = data[:end], data[end:]
+            lines_number = data.count(b'\n')
+            if line + lines_number <= start:
+                line += lines_number
+                continue
+            if line < start or (stop is not None and line + lines_number > stop):
+                newlines = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == ord('\n'))
+                first = 0 if line >= start else newlines[start - line - 1] + 1
+                last = len(data) if stop is None or line + lines_number <= stop else newlines[stop - line - 1] + 1
+                data = data[first:last]
+            line += lines_number
+            yield data
+    # the last line without the end of line character
+    if remainder.strip() and start <= line and (stop is None or line < stop):
+        yield remainder
+
+
+def iter_values_from_file(filename, start=0, stop=None, channels=1):
+    '''Yields arrays of the samples parsed chunk by chunk
+    from the line start to the line stop. With many channels the values
+    in a line are separated with commas and the arrays have
+    one column per channel'''
+    if stop is not None and stop <= start:
+        return
+    for data in iter_lines_chunks_from_file(filename, start, stop):
+        yield parse_text_samples(data, channels)
+
+
+def parse_text_samples(data, channels=1):
+    '''Parses the complete lines of a text recording, one sample per line.
+    Raises ValueError when any line is not a number (or a number per channel),
+    as older numpy only warns and stops parsing at the first such line'''
+    if channels > 1:
+        data = data.replace(b',', b' ')
+    values = np.fromstring(data, sep=' ')
+    lines_number = data.count(b'\n') + (len(data) > 0 and not data.endswith(b'\n'))
+    if len(values) != lines_number * channels:
+        raise ValueError(f'Malformed lines in the text recording, {len(values)} values '
+                         f'parsed instead of {lines_number * channels}')
+    return values if channels == 1 else values.reshape(-1, channels)
+
+
+def iter_blocks_from_file(filename, block_size, start=0, stop=None, channels=1):
+    '''Yields the samples from the line start to the line stop
+    in arrays of block_size samples, the last one may be shorter'''
+    pending = np.zeros(0) if channels == 1 else np.zeros((0, channels))
+    for values in iter_values_from_file(filename, start, stop, channels):
+        pending = np.concatenate([pending, values])
+        blocks_number = len(pending) // block_size
+        for i in range(blocks_number):
+            yield pending[i*block_size:(i + 1)*block_size]
+        pending = pending[blocks_number*block_size:]
+    if len(pending) > 0:
+        yield pending
+
+
+def read_from_file(filename, start=0, stop=None, channels=1):
+    '''Reads the samples from the line start to the line stop,
+    the same as read_from_file(filename)[start:stop] for non-negative
+    start and stop, but without parsing the whole file'''
+    empty = np.zeros(0) if channels == 1 else np.zeros((0, channels))
+    return np.concatenate([empty] + list(iter_values_from_file(filename, start, stop, channels)))
 
 
 def main():
-    filename = r'..\data\example_ecg_data1.txt'
-    # filename = r'..\data\example_ecg_data2.txt'
+    data_folder = Path(os.path.dirname(os.path.realpath(__file__)))/'../data/'
+    filename = data_folder/'example_ecg_data1.txt'
+    # filename = data_folder/'example_ecg_data2.txt'
 
-    s = read_from_file(filename)
     Fs = 200
+    s = read_from_file(filename, 149*Fs, 161*Fs)
     sp = SignalProcessor(Fs)
-    # plot_all_filters_characteristics(sp)
-
-    s = s[149*Fs:161*Fs]
 
-    s_filtered = []
-    for x in s:
-        s_filtered.append(sp.use_all_filters(x))
-    s_filtered = np.array(s_filtered)
+    s_filtered = sp.use_all_filters_on_block(s)
 
     peaks_indices = sp.find_R_peaks(s_filtered)
     measures = sp.make_ecg_analysis_on_peaks_indices(peaks_indices)
     for measure, value in measures.items():
         print(f'{measure}: {value:.2f}')
 
-    # Plots
-    x = np.arange(0, len(s))
-
-    plt.figure()
-    plt.subplot(2, 1, 1)
-    plt.plot(x/Fs, convert_units_to_volts(s)*1000)
-    plt.grid('on')
-    plt.ylabel('Amplituda [mV]')
-    plt.subplot(2, 1, 2)
-    plt.plot(x/Fs, convert_units_to_volts(s_filtered)*1000)
-    plt.grid('on')
-    plt.xlabel('Czas [s]')
-    plt.ylabel('Amplituda [mV]')
-    plt.tight_layout()
-
-    plt.figure()
-    plt.plot(x/Fs, convert_units_to_volts(s_filtered)*1000)
-    plt.plot(peaks_indices/Fs, convert_units_to_volts(s_filtered[peaks_indices])*1000, 'x')
-    plt.grid('on')
-    plt.xlabel('Czas [s]')
-    plt.ylabel('Amplituda [mV]')
-    plt.tight_layout()
-
-    plt.show()
+    # matplotlib is imported only when plotting
+    from signal_plots import plot_signal_with_R_peaks
+    # from signal_plots import plot_all_filters_characteristics; plot_all_filters_characteristics(sp)
+    plot_signal_with_R_peaks(s, s_filtered, peaks_indices, Fs)
 
 
 if __name__ == '__main__':